@@ -1,46 +1,627 @@
 # -*- coding: utf-8 -*-
 import atexit
+import heapq
+import itertools
 import os
+import signal
 import sys
 import threading
+import time
+import multiprocessing
 from multiprocessing import Condition
-from cherrypy.process.wspbus import Bus, states
+from cherrypy.process.wspbus import Bus, ChannelFailures, states
 
 from conductor.task import Task
+from conductor.lib.waker import Waker
 
-__all__ = ['SynchronizingBus', 'SynchronizedBus',
-           'SubBusTask', 'NoAtexitBus']
+__all__ = ['DispatchBus', 'WakeupBus', 'AsyncoreBus', 'AsyncioBus',
+           'SynchronizingBus', 'SynchronizedBus', 'SynchronizedAsyncoreBus',
+           'SubBusTask', 'NoAtexitBus', 'ReadinessBarrier']
 
-class SynchronizingBus(Bus):
-    def __init__(self, sync_delay=1):
+# publishing to those channels always wakes the main loop up
+# since they change the state it is waiting for
+STATE_CHANNELS = ('start', 'stop', 'exit', 'graceful')
+
+class DispatchBus(Bus):
+    """
+    Bus keeping the listeners of each channel in a tuple sorted
+    by priority rather than sorting them on every publish.
+
+    The tuple of a channel is built on its first publish and
+    dropped whenever a listener subscribes to or unsubscribes
+    from the channel. Listeners are called in a plain loop until
+    one of them fails, the remaining ones are then called the
+    way ``Bus.publish`` does.
+    """
+    def __init__(self):
         Bus.__init__(self)
-        self.sync_delay = sync_delay
-        self.condition = Condition()
+        self._dispatch = {}
+        self._dispatch_lock = threading.Lock()
+
+    def subscribe(self, channel, callback, priority=None):
+        with self._dispatch_lock:
+            Bus.subscribe(self, channel, callback, priority)
+            self._dispatch.pop(channel, None)
+
+    def unsubscribe(self, channel, callback):
+        with self._dispatch_lock:
+            Bus.unsubscribe(self, channel, callback)
+            self._dispatch.pop(channel, None)
+
+    def dispatch(self, channel):
+        """
+        Returns the listeners of `channel` sorted by priority.
+        """
+        listeners = self._dispatch.get(channel)
+        if listeners is None:
+            with self._dispatch_lock:
+                priorities = self._priorities
+                items = [(priorities[(channel, listener)], listener)
+                         for listener in self.listeners.get(channel, ())]
+                items.sort(key=lambda item: item[0])
+                listeners = tuple([listener for priority, listener in items])
+                self._dispatch[channel] = listeners
+        return listeners
+
+    def publish(self, channel, *args, **kwargs):
+        listeners = self._dispatch.get(channel)
+        if listeners is None:
+            listeners = self.dispatch(channel)
+
+        output = []
+        append = output.append
+        try:
+            for listener in listeners:
+                append(listener(*args, **kwargs))
+            return output
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            exc = ChannelFailures()
+            failed = len(output)
+            output.append(None)
+            self._failed(exc, channel, listeners[failed])
+
+        # slow path, same as Bus.publish
+        for listener in listeners[failed + 1:]:
+            try:
+                output.append(listener(*args, **kwargs))
+            except KeyboardInterrupt:
+                raise
+            except SystemExit:
+                e = sys.exc_info()[1]
+                if e.code == 0:
+                    e.code = 1
+                raise
+            except:
+                self._failed(exc, channel, listener)
+        raise exc
+
+    def _failed(self, exc, channel, listener):
+        # must be called from an except clause
+        exc.handle_exception()
+        if channel != 'log':
+            self.log("Error in %r listener %r" % (channel, listener),
+                     level=40, traceback=True)
+
+class WakeupBus(DispatchBus):
+    """
+    Bus whose main loop sleeps until something happens rather
+    than polling at a fixed interval.
+
+    The loop is woken up when a channel is published to from a
+    thread other than the one blocking on the bus, when the bus
+    changes state, when a timer scheduled with :meth:`call_later`
+    is due or when :meth:`wakeup` is called. It then publishes
+    to ``main`` once.
+
+    The `interval` passed to :meth:`block` becomes the longest
+    the loop stays idle before publishing to ``main`` anyway.
+    Set it to ``None`` for a loop that only ticks when woken up.
+
+    When `instrument` is set to a :class:`conductor.lib.busstats.BusStats`
+    publishes go through it so that its listeners are timed.
+    """
+    # upper bound of a single sleep when the interval is None
+    idle_timeout = 60.0
+    instrument = None
+
+    def __init__(self):
+        DispatchBus.__init__(self)
+        self._waker = None
+        self._waker_pid = None
+        self._waker_lock = threading.RLock()
+        self._loop_thread = None
+        self._timers = []
+        self._timers_lock = threading.Lock()
+        self._timers_seq = itertools.count()
+
+    def wakeup(self):
+        """
+        Wakes the main loop up so that it publishes to ``main``
+        as soon as possible. Safe to call from any thread and
+        from signal handlers.
+        """
+        # the loop may not have created its waker yet, e.g. when
+        # a job started by a start listener is already done
+        self._get_waker().wake()
+
+    def publish(self, channel, *args, **kwargs):
+        try:
+            if self.instrument is not None:
+                return self.instrument.publish(self, channel, args, kwargs)
+            return DispatchBus.publish(self, channel, *args, **kwargs)
+        finally:
+            if channel in STATE_CHANNELS or \
+                   (channel not in ('main', 'log') and self._is_foreign()):
+                self.wakeup()
+
+    def call_later(self, delay, callback, *args, **kwargs):
+        """
+        Schedules `callback` to be called from the main loop
+        in `delay` seconds. Returns a handle that can be passed
+        to :meth:`cancel`.
+        """
+        timer = [time.time() + delay, self._timers_seq.next(),
+                 callback, args, kwargs]
+        self._timers_lock.acquire()
+        try:
+            heapq.heappush(self._timers, timer)
+        finally:
+            self._timers_lock.release()
+        if self._is_foreign():
+            self.wakeup()
+        return timer
+
+    def cancel(self, timer):
+        """
+        Cancels a timer returned by :meth:`call_later`.
+        """
+        timer[2] = None
+
+    def run_timers(self):
+        """
+        Calls the timers that are due.
+        """
+        while self._timers:
+            now = time.time()
+            self._timers_lock.acquire()
+            try:
+                if not self._timers:
+                    break
+                timer = self._timers[0]
+                if timer[2] is not None and timer[0] > now:
+                    break
+                heapq.heappop(self._timers)
+            finally:
+                self._timers_lock.release()
+
+            callback, args, kwargs = timer[2:]
+            if callback is None:
+                continue
+            try:
+                callback(*args, **kwargs)
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except:
+                self.log("Error in timer %r" % (callback,),
+                         level=40, traceback=True)
+
+    def next_timer_delay(self):
+        """
+        Returns the number of seconds until the next timer is due
+        or ``None`` if no timer is scheduled.
+        """
+        self._timers_lock.acquire()
+        try:
+            while self._timers and self._timers[0][2] is None:
+                heapq.heappop(self._timers)
+            if not self._timers:
+                return None
+            return max(0, self._timers[0][0] - time.time())
+        finally:
+            self._timers_lock.release()
+
+    def idle(self, timeout):
+        """
+        Sleeps for at most `timeout` seconds or until
+        the bus is woken up.
+        """
+        self._get_waker().wait(timeout)
+
+    def pump(self, timeout=0):
+        """
+        Runs a single iteration of the main loop, waiting at most
+        `timeout` seconds. Meant for listeners which must let the
+        loop make progress before they can return.
+        """
+        self.idle(timeout)
+        self.run_timers()
+        self.publish('main')
+
+    def wait(self, state, interval=0.1, channel=None):
+        if channel is None:
+            # waiting from a side thread, e.g. start_with_callback
+            return Bus.wait(self, state, interval, channel)
+
+        if isinstance(state, (tuple, list)):
+            wanted = state
+        else:
+            wanted = [state]
+
+        waker = self._get_waker()
+
+        # signals may be delivered to any thread, make sure
+        # they interrupt the poll of the main one
+        previous_fd = None
+        fd = waker.signal_fileno()
+        if fd is not None and hasattr(signal, 'set_wakeup_fd'):
+            try:
+                previous_fd = signal.set_wakeup_fd(fd)
+            except ValueError:
+                # not called from the main thread
+                pass
+
+        self._loop_thread = threading.currentThread()
+        try:
+            while self.state not in wanted:
+                timeout = self.next_timer_delay()
+                if interval is not None and (timeout is None or interval < timeout):
+                    timeout = interval
+                if timeout is None:
+                    timeout = self.idle_timeout
+                self.idle(timeout)
+                self.run_timers()
+                self.publish(channel)
+        finally:
+            self._loop_thread = None
+            if previous_fd is not None:
+                signal.set_wakeup_fd(previous_fd)
+
+    def _get_waker(self):
+        # the waker is created lazily so that a bus built in
+        # a parent process doesn't share its pipe with the
+        # children it forks
+        if self._waker_pid != os.getpid():
+            self._waker_lock.acquire()
+            try:
+                if self._waker_pid != os.getpid():
+                    self._waker = Waker()
+                    self._waker_pid = os.getpid()
+            finally:
+                self._waker_lock.release()
+        return self._waker
+
+    def _is_foreign(self):
+        loop_thread = self._loop_thread
+        return loop_thread is not None and \
+               loop_thread is not threading.currentThread()
+
+class AsyncoreBus(WakeupBus):
+    """
+    Bus which dispatches the sockets of an asyncore map while
+    its main loop is idle.
+
+    Socket readiness, timers and bus wakeups are all waited for
+    in a single poll so that neither delays the others.
+    """
+    def __init__(self, socket_map=None):
+        WakeupBus.__init__(self)
+        self.socket_map = socket_map
+        self._poller = None
+
+    def idle(self, timeout):
+        waker = self._get_waker()
+        if self._poller is None or self._poller.waker is not waker:
+            from conductor.lib.poller import AsyncorePoller
+            self._poller = AsyncorePoller(waker, self.socket_map)
+        self._poller.poll(timeout)
+
+class AsyncioBus(WakeupBus):
+    """
+    Bus run by an asyncio event loop.
+
+    Listeners may be coroutine functions: the coroutines they
+    return are scheduled on the loop as tasks which replace them
+    in the output of :meth:`publish`. ``main`` is published from
+    a loop callback rather than from a blocking poll.
+    """
+    # how long exiting waits for pending listener coroutines
+    shutdown_timeout = 5.0
+
+    def __init__(self, loop=None):
+        WakeupBus.__init__(self)
+        try:
+            import asyncio
+        except ImportError:
+            import trollius as asyncio
+        self.asyncio = asyncio
+        self.loop = loop
+        self.pending = set()
+        self._handle = None
+        self._wanted = None
+        self._channel = None
+        self._interval = None
+
+    def publish(self, channel, *args, **kwargs):
+        output = WakeupBus.publish(self, channel, *args, **kwargs)
+        if self.loop is not None:
+            for index, result in enumerate(output):
+                if self.asyncio.iscoroutine(result):
+                    output[index] = self._spawn(result)
+        return output
+
+    def wakeup(self):
+        if self._loop_thread is None:
+            return
+        if self._is_foreign():
+            self.loop.call_soon_threadsafe(self._rearm, 0)
+        else:
+            self._rearm(0)
+
+    def call_later(self, delay, callback, *args, **kwargs):
+        timer = WakeupBus.call_later(self, delay, callback, *args, **kwargs)
+        if self._loop_thread is not None and not self._is_foreign():
+            self._rearm()
+        return timer
+
+    def wait(self, state, interval=0.1, channel=None):
+        if channel is None:
+            return WakeupBus.wait(self, state, interval, channel)
+
+        if isinstance(state, (tuple, list)):
+            self._wanted = state
+        else:
+            self._wanted = [state]
+        self._channel = channel
+        self._interval = interval
+
+        self._loop_thread = threading.currentThread()
+        routed = self._route_signals()
+        try:
+            self._rearm()
+            self.loop.run_forever()
+        finally:
+            self._loop_thread = None
+            self._restore_signals(routed)
+            if self._handle:
+                self._handle.cancel()
+                self._handle = None
+
+    def drain(self, timeout=None):
+        """
+        Runs the loop until the pending listener coroutines
+        complete or `timeout` seconds have elapsed.
+        """
+        if timeout is None:
+            timeout = self.shutdown_timeout
+        if self.pending:
+            self.loop.run_until_complete(self.asyncio.wait(list(self.pending),
+                                                           timeout=timeout))
+        for task in list(self.pending):
+            self.log("Cancelling pending listener %r" % (task,), level=30)
+            task.cancel()
+
+    def _route_signals(self):
+        # the handlers installed so far, e.g. by the SignalHandler
+        # plugin, are run as loop callbacks: the loop wakes up as soon
+        # as a signal arrives and isn't rearmed from a signal handler
+        routed = []
+        for name in ('SIGTERM', 'SIGHUP', 'SIGUSR1', 'SIGUSR2', 'SIGQUIT'):
+            signum = getattr(signal, name, None)
+            if signum is None:
+                continue
+            handler = signal.getsignal(signum)
+            if not callable(handler):
+                continue
+            try:
+                self.loop.add_signal_handler(signum, handler, signum, None)
+            except (NotImplementedError, RuntimeError, ValueError):
+                # not a Unix loop or not the main thread
+                break
+            routed.append((signum, handler))
+        return routed
+
+    def _restore_signals(self, routed):
+        for signum, handler in routed:
+            self.loop.remove_signal_handler(signum)
+            signal.signal(signum, handler)
+
+    def _spawn(self, coro):
+        if self._is_foreign():
+            if hasattr(self.asyncio, 'run_coroutine_threadsafe'):
+                return self.asyncio.run_coroutine_threadsafe(coro, self.loop)
+            self.loop.call_soon_threadsafe(self._spawn, coro)
+            return coro
+
+        ensure_future = getattr(self.asyncio, 'ensure_future', None) or \
+                        getattr(self.asyncio, 'async')
+        task = ensure_future(coro, loop=self.loop)
+        self.pending.add(task)
+        task.add_done_callback(self._done)
+        return task
+
+    def _done(self, task):
+        self.pending.discard(task)
+        if task.cancelled():
+            return
+        exc = task.exception()
+        if exc is not None:
+            import traceback
+            tb = "".join(traceback.format_exception(exc.__class__, exc,
+                                                    getattr(exc, '__traceback__', None)))
+            self.log("Error in coroutine listener %r\n%s" % (task, tb), level=40)
+
+    def _rearm(self, delay=None):
+        if delay is None:
+            delay = self.next_timer_delay()
+            interval = self._interval
+            if interval is not None and (delay is None or interval < delay):
+                delay = interval
+            if delay is None:
+                delay = self.idle_timeout
+        if self._handle:
+            self._handle.cancel()
+        self._handle = self.loop.call_later(delay, self._tick)
+
+    def _tick(self):
+        self._handle = None
+        if self.state in self._wanted:
+            self.loop.stop()
+            return
+
+        try:
+            self.run_timers()
+            self.publish(self._channel)
+        finally:
+            if self.state in self._wanted:
+                self.loop.stop()
+            elif self._handle is None:
+                self._rearm()
+
+class ReadinessBarrier(object):
+    """
+    Barrier shared by a :class:`SynchronizingBus` and the
+    :class:`SynchronizedBus` of its children.
+
+    Each child calls :meth:`arrive` and waits there until the parent
+    calls :meth:`release`, which returns as soon as `parties` children
+    have arrived. Children arriving after the release don't wait.
+    The pids of the first `max_parties` children to arrive are kept
+    so that the parent can tell which ones are late.
+    """
+    def __init__(self, max_parties=1024):
+        self._cond = Condition()
+        self._arrived = multiprocessing.Value('i', 0, lock=False)
+        self._released = multiprocessing.Value('i', 0, lock=False)
+        self._pids = multiprocessing.Array('i', max_parties, lock=False)
+
+    def arrive(self, timeout=None):
+        """
+        Signals that the calling process is ready and waits at most
+        `timeout` seconds to be released. Returns ``True`` once
+        released and ``False`` on timeout.
+        """
+        deadline = timeout is not None and time.time() + timeout
+        self._cond.acquire()
+        try:
+            index = self._arrived.value
+            if index < len(self._pids):
+                self._pids[index] = os.getpid()
+            self._arrived.value = index + 1
+            self._cond.notify_all()
+            while not self._released.value:
+                if deadline is False:
+                    self._cond.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+        finally:
+            self._cond.release()
+
+    def release(self, parties, timeout=None):
+        """
+        Waits at most `timeout` seconds for `parties` processes
+        to arrive, releases them and returns the pids of those
+        which arrived.
+        """
+        deadline = timeout is not None and time.time() + timeout
+        self._cond.acquire()
+        try:
+            while self._arrived.value < parties:
+                if deadline is False:
+                    self._cond.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            self._released.value = 1
+            self._cond.notify_all()
+            return list(self._pids[:min(self._arrived.value, len(self._pids))])
+        finally:
+            self._cond.release()
+
+    @property
+    def arrived(self):
+        return self._arrived.value
+
+    @property
+    def released(self):
+        return bool(self._released.value)
+
+class SynchronizingBus(WakeupBus):
+    """
+    Bus starting along with the :class:`SynchronizedBus` of the
+    children it shares its `condition`, a :class:`ReadinessBarrier`,
+    with.
+
+    When it starts, the bus waits for `parties` children, by default
+    the child processes running at that time, to be ready to start
+    and releases them all as soon as the last one is. After
+    `sync_timeout` seconds, the children which aren't ready yet are
+    logged and the others are released anyway, the late ones then
+    starting as soon as they are ready.
+    """
+    def __init__(self, sync_timeout=30.0):
+        WakeupBus.__init__(self)
+        self.sync_timeout = sync_timeout
+        self.parties = None
+        self.condition = ReadinessBarrier()
 
     def start(self):
-        import time
-        time.sleep(self.sync_delay)
-        self.log("Releasing children")
-        self.condition.acquire()
-        self.condition.notify_all()
-        self.condition.release()
-        Bus.start(self)
-
-class SynchronizedBus(Bus):
+        parties = self.parties
+        if parties is None:
+            parties = len(multiprocessing.active_children())
+        started = time.time()
+        self.log("Waiting for %d children" % parties)
+        arrived = self.condition.release(parties, self.sync_timeout)
+        if len(arrived) < parties:
+            late = [child for child in multiprocessing.active_children()
+                    if child.pid not in arrived]
+            self.log("Only %d of %d children ready after %.1fs, late: %s" % \
+                     (len(arrived), parties, time.time() - started,
+                      ", ".join(["%s (%s)" % (child.name, child.pid) for child in late])),
+                     level=30)
+        else:
+            self.log("Released %d children after %.3fs" % (len(arrived), time.time() - started))
+        WakeupBus.start(self)
+
+class SynchronizedBus(WakeupBus):
+    """
+    Bus which starts once its parent :class:`SynchronizingBus` releases
+    it through `cond`. With a plain condition rather than a
+    :class:`ReadinessBarrier`, it waits to be notified.
+    """
     def __init__(self, cond):
-        Bus.__init__(self)
+        WakeupBus.__init__(self)
         self.condition = cond
         
     def start(self):
         self.log("Syncing on main process")
-        self.condition.acquire()
-        self.condition.wait()
-        self.condition.release()
-        Bus.start(self)
+        if hasattr(self.condition, 'arrive'):
+            self.condition.arrive()
+        else:
+            self.condition.acquire()
+            self.condition.wait()
+            self.condition.release()
+        super(SynchronizedBus, self).start()
+
+class SynchronizedAsyncoreBus(SynchronizedBus, AsyncoreBus):
+    """
+    :class:`SynchronizedBus` polling asyncore sockets
+    like an :class:`AsyncoreBus`.
+    """
+    def __init__(self, cond, socket_map=None):
+        AsyncoreBus.__init__(self, socket_map)
+        self.condition = cond
 
-class NoAtexitBus(Bus):
+class NoAtexitBus(DispatchBus):
     def start(self):
-        Bus.start(self)
+        DispatchBus.start(self)
 
         handler = (self._clean_exit, (), {})
         if handler in atexit._exithandlers:
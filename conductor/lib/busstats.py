@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+__docformat__ = "restructuredtext en"
+import bisect
+import sys
+import threading
+import time
+
+from cherrypy.process.wspbus import Bus, ChannelFailures
+
+from conductor.lib.bus import DispatchBus
+
+__all__ = ['BusStats']
+
+# upper bounds of the histogram buckets, from 1us to about 8s
+BUCKETS = tuple([2 ** i / 1000000.0 for i in range(0, 24)])
+
+def listener_name(listener):
+    """
+    Returns a readable name for `listener`.
+    """
+    owner = getattr(listener, 'im_self', None)
+    name = getattr(listener, '__name__', None)
+    if owner is not None and name:
+        return "%s.%s" % (owner.__class__.__name__, name)
+    if name:
+        return "%s.%s" % (getattr(listener, '__module__', '?'), name)
+    return repr(listener)
+
+class _ListenerStats(object):
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.over_budget = 0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def add(self, elapsed):
+        self.calls += 1
+        self.total += elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+        self.buckets[bisect.bisect_left(BUCKETS, elapsed)] += 1
+
+    def percentile(self, ratio):
+        # upper bound of the bucket holding the percentile
+        wanted = self.calls * ratio
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= wanted:
+                if index < len(BUCKETS):
+                    return min(BUCKETS[index], self.max)
+                return self.max
+        return self.max
+
+    def stats(self):
+        return {'calls': self.calls,
+                'total': self.total,
+                'mean': self.calls and self.total / self.calls or 0.0,
+                'p50': self.percentile(0.5),
+                'p99': self.percentile(0.99),
+                'max': self.max,
+                'over_budget': self.over_budget}
+
+class BusStats(object):
+    """
+    Records how often each channel of a bus is published to and
+    how long each of its listeners takes.
+
+    Only one publish out of ``1 / sample_rate`` of each channel
+    is timed, the others only being counted. A listener taking
+    more than `budget` seconds is logged. `channels` restricts
+    the timing to those channels.
+
+    It is installed on a :class:`conductor.lib.bus.WakeupBus` by
+    :meth:`conductor.process.Process.instrument_bus`.
+    """
+    def __init__(self, sample_rate=1.0, budget=None, channels=None):
+        self.sample_every = max(1, int(round(1.0 / sample_rate)))
+        self.budget = budget
+        self.channels = channels and frozenset(channels) or None
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+        self.published = {}
+        self.sampled = {}
+        self.listeners = {}
+
+    def publish(self, bus, channel, args, kwargs):
+        """
+        Publishes to `channel` of `bus`, timing its listeners
+        when the publish is sampled.
+        """
+        published = self.published.get(channel, 0) + 1
+        self.published[channel] = published
+        if (published - 1) % self.sample_every or channel == 'log' or \
+               (self.channels is not None and channel not in self.channels):
+            if isinstance(bus, DispatchBus):
+                return DispatchBus.publish(bus, channel, *args, **kwargs)
+            return Bus.publish(bus, channel, *args, **kwargs)
+
+        if channel not in bus.listeners:
+            return []
+        self.sampled[channel] = self.sampled.get(channel, 0) + 1
+
+        # same as Bus.publish, timing each listener
+        exc = ChannelFailures()
+        output = []
+        if hasattr(bus, 'dispatch'):
+            listeners = bus.dispatch(channel)
+        else:
+            items = [(bus._priorities[(channel, listener)], listener)
+                     for listener in bus.listeners[channel]]
+            items.sort(key=lambda item: item[0])
+            listeners = [listener for priority, listener in items]
+        clock = time.time
+        for listener in listeners:
+            started = clock()
+            try:
+                output.append(listener(*args, **kwargs))
+            except KeyboardInterrupt:
+                raise
+            except SystemExit:
+                e = sys.exc_info()[1]
+                if exc and e.code == 0:
+                    e.code = 1
+                raise
+            except:
+                exc.handle_exception()
+                bus.log("Error in %r listener %r" % (channel, listener),
+                        level=40, traceback=True)
+            finally:
+                self.record(bus, channel, listener, clock() - started)
+        if exc:
+            raise exc
+        return output
+
+    def record(self, bus, channel, listener, elapsed):
+        key = (channel, listener)
+        with self.lock:
+            stats = self.listeners.get(key)
+            if stats is None:
+                stats = self.listeners[key] = _ListenerStats(listener_name(listener))
+            stats.add(elapsed)
+            over = self.budget is not None and elapsed > self.budget
+            if over:
+                stats.over_budget += 1
+        if over:
+            bus.log("Listener %s of %r took %.1f ms, over its budget of %.1f ms" % \
+                    (stats.name, channel, elapsed * 1000, self.budget * 1000), level=30)
+
+    def stats(self):
+        """
+        Returns, for each channel, the number of publishes, how many
+        of them were timed and the timings of each listener.
+        """
+        with self.lock:
+            channels = {}
+            for channel, published in self.published.items():
+                channels[channel] = {'published': published,
+                                     'sampled': self.sampled.get(channel, 0),
+                                     'listeners': {}}
+            for (channel, listener), stats in self.listeners.items():
+                channels[channel]['listeners'][stats.name] = stats.stats()
+            return {'since': self.started,
+                    'sample_rate': 1.0 / self.sample_every,
+                    'channels': channels}
+
+    def report(self):
+        """
+        Returns the stats as lines of text, the slowest
+        listeners first.
+        """
+        stats = self.stats()
+        lines = ["Bus stats over %.1fs, sampling 1 publish out of %d" % \
+                 (time.time() - stats['since'], self.sample_every)]
+        channels = stats['channels'].items()
+        channels.sort(key=lambda item: -item[1]['published'])
+        for channel, channel_stats in channels:
+            lines.append("%s: %d published, %d sampled" % \
+                         (channel, channel_stats['published'], channel_stats['sampled']))
+            listeners = channel_stats['listeners'].items()
+            listeners.sort(key=lambda item: -item[1]['total'])
+            for name, s in listeners:
+                lines.append("  %-50s %8d calls  mean %8.3f ms  p99 %8.3f ms  max %8.3f ms%s" % \
+                             (name, s['calls'], s['mean'] * 1000, s['p99'] * 1000,
+                              s['max'] * 1000,
+                              s['over_budget'] and "  %d over budget" % s['over_budget'] or ""))
+        return lines
@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+__docformat__ = "restructuredtext en"
+import sys
+import threading
+import time
+from collections import deque
+
+from conductor.task import Task
+
+__all__ = ['ExecutorTask', 'FutureTask', 'Future', 'CancelledError']
+
+class CancelledError(Exception):
+    """
+    Raised by :meth:`Future.result` when the job was
+    cancelled before it ran.
+    """
+
+class Future(object):
+    """
+    Result of a job run by an :class:`ExecutorTask`.
+
+    Callbacks added with :meth:`add_done_callback` are called with
+    the future from the bus thread once the job is done, or right
+    away when it is done already.
+    """
+    def __init__(self, func=None, args=(), kwargs=None, reply_channel=None):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.reply_channel = reply_channel
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        # formatted traceback of a job failing in another process
+        self.traceback = None
+
+        self._event = threading.Event()
+        self._result = None
+        self._exc_info = None
+        self._cancelled = False
+        self._callbacks = []
+        # set by the task queueing the future
+        self._canceller = None
+
+    def done(self):
+        return self._event.isSet()
+
+    def cancelled(self):
+        return self._cancelled
+
+    def cancel(self):
+        """
+        Cancels the job unless it started already.
+        """
+        if self._canceller is not None:
+            return self._canceller(self)
+        if self.started is not None or self.done():
+            return False
+        self._set_cancelled()
+        return True
+
+    def result(self, timeout=None):
+        """
+        Returns the result of the job, raising its exception if it
+        failed. Waits at most `timeout` seconds for it, don't wait
+        from the bus thread since it delivers the results.
+        """
+        if not self._event.wait(timeout) and not self.done():
+            raise RuntimeError("Job not done after %s seconds" % timeout)
+        if self._cancelled:
+            raise CancelledError()
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self):
+        if self._exc_info:
+            return self._exc_info[1]
+
+    def add_done_callback(self, callback):
+        if self.done():
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exc):
+        self._exc_info = (exc.__class__, exc, None)
+        self._finish()
+
+    def run(self):
+        self.started = time.time()
+        try:
+            self._result = self.func(*self.args, **self.kwargs)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self._exc_info = sys.exc_info()
+        self._finish()
+
+    def _set_cancelled(self):
+        self._cancelled = True
+        self._finish()
+
+    def _finish(self):
+        self.finished = time.time()
+        self._event.set()
+
+class FutureTask(Task):
+    """
+    Base of the tasks running jobs away from the bus thread. Their
+    finished futures are handed to :meth:`_job_done` which wakes the
+    bus up so that :meth:`deliver`, subscribed to ``main``, calls
+    their callbacks from the bus thread.
+    """
+    def __init__(self, bus=None):
+        Task.__init__(self, bus)
+        self.done = deque()
+
+    def deliver(self):
+        """
+        Calls the callbacks of the finished jobs and publishes
+        them to their reply channel, from the bus thread. Returns
+        whether there were any.
+        """
+        done = self.done
+        delivered = bool(done)
+        while done:
+            future = done.popleft()
+            for callback in future._callbacks:
+                try:
+                    callback(future)
+                except (KeyboardInterrupt, SystemExit):
+                    raise
+                except:
+                    self._log("Error in the callback %r of job %r" % (callback, future.func),
+                              level=40, traceback=True)
+            future._callbacks = []
+            if future.reply_channel:
+                self.bus.publish(future.reply_channel, future)
+        return delivered
+
+    def _job_done(self, future):
+        # may be called from any thread
+        self.done.append(future)
+        wakeup = getattr(self.bus, 'wakeup', None)
+        if wakeup:
+            wakeup()
+
+class ExecutorTask(FutureTask):
+    """
+    Runs blocking jobs in a pool of `size` threads so that bus
+    listeners don't have to.
+
+    ``"execute"`` takes a callable with its `args` and `kwargs`
+    and returns a :class:`Future`. Once the job is done, its
+    callbacks are called from the bus thread and, when `reply_channel`
+    is given, the future is published to it:
+
+    .. code-block :: python
+
+        future = self.bus.publish("execute", pickle.dump, args=(data, f)).pop()
+        future.add_done_callback(self.dumped)
+
+    At most `max_queued` jobs wait for a thread, ``"execute"``
+    raising ``RuntimeError`` beyond, unless set to 0. When the
+    task stops, queued jobs are run for at most `stop_timeout`
+    seconds and cancelled afterwards. ``"get-executor-stats"``
+    returns the queue depth and the time jobs waited and ran.
+    """
+    def __init__(self, bus=None, size=4):
+        FutureTask.__init__(self, bus)
+        self.size = size
+        self.max_queued = 0
+        self.stop_timeout = 10.0
+
+        self.lock = threading.Condition()
+        self.queue = deque()
+        self.threads = []
+        self.active = 0
+        self._running = False
+
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.rejected = 0
+        self.peak_queued = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.run_time = 0.0
+        self.max_run_time = 0.0
+
+    def start_task(self):
+        self._running = True
+        for i in range(0, self.size):
+            thread = threading.Thread(target=self._work, name="executor-%d" % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        self.bus.subscribe("execute", self.execute)
+        self.bus.subscribe("get-executor-stats", self.stats)
+        self.bus.subscribe("main", self.deliver)
+    # before the tasks which submit jobs from their start_task
+    start_task.priority = 6
+
+    def stop_task(self):
+        self.bus.unsubscribe("execute", self.execute)
+        self.bus.unsubscribe("get-executor-stats", self.stats)
+        with self.lock:
+            self._running = False
+            self.lock.notifyAll()
+
+        deadline = time.time() + self.stop_timeout
+        for thread in self.threads:
+            thread.join(max(0, deadline - time.time()))
+        self.threads = []
+
+        with self.lock:
+            queued, self.queue = self.queue, deque()
+        for future in queued:
+            future._set_cancelled()
+            self.cancelled += 1
+            self.done.append(future)
+        if queued:
+            self._log("Cancelled %d queued jobs" % len(queued), level=30)
+        self.deliver()
+        self.bus.unsubscribe("main", self.deliver)
+    stop_task.priority = 94
+
+    def execute(self, func, args=(), kwargs=None, reply_channel=None):
+        future = Future(func, args, kwargs, reply_channel)
+        future._canceller = self._cancel
+        with self.lock:
+            if not self._running:
+                raise RuntimeError("The executor is stopped")
+            if self.max_queued and len(self.queue) >= self.max_queued:
+                self.rejected += 1
+                raise RuntimeError("Too many queued jobs")
+            self.queue.append(future)
+            self.submitted += 1
+            self.peak_queued = max(self.peak_queued, len(self.queue))
+            self.lock.notify()
+        return future
+
+    def stats(self):
+        with self.lock:
+            started = self.completed + self.failed + self.active
+            finished = self.completed + self.failed
+            return {'size': self.size,
+                    'queued': len(self.queue),
+                    'peak_queued': self.peak_queued,
+                    'active': self.active,
+                    'submitted': self.submitted,
+                    'completed': self.completed,
+                    'failed': self.failed,
+                    'cancelled': self.cancelled,
+                    'rejected': self.rejected,
+                    'mean_wait_time': started and self.wait_time / started or 0.0,
+                    'max_wait_time': self.max_wait_time,
+                    'mean_run_time': finished and self.run_time / finished or 0.0,
+                    'max_run_time': self.max_run_time}
+
+    def _cancel(self, future):
+        # takes the future out of the queue unless a thread got it
+        with self.lock:
+            try:
+                self.queue.remove(future)
+            except ValueError:
+                return False
+            self.cancelled += 1
+        future._set_cancelled()
+        self._job_done(future)
+        return True
+
+    def _work(self):
+        lock = self.lock
+        while 1:
+            with lock:
+                while not self.queue and self._running:
+                    lock.wait()
+                if not self.queue:
+                    return
+                future = self.queue.popleft()
+                if future.cancelled():
+                    continue
+                self.active += 1
+                waited = time.time() - future.submitted
+                self.wait_time += waited
+                self.max_wait_time = max(self.max_wait_time, waited)
+
+            future.run()
+
+            with lock:
+                self.active -= 1
+                elapsed = future.finished - future.started
+                self.run_time += elapsed
+                self.max_run_time = max(self.max_run_time, elapsed)
+                if future._exc_info:
+                    self.failed += 1
+                else:
+                    self.completed += 1
+            self._job_done(future)
+
+if __name__ == '__main__':
+    from conductor.process import Process
+
+    class SleepyTask(Task):
+        def start_task(self):
+            self.bus.subscribe("slept", self.slept)
+            self.pending = 8
+            for i in range(0, 8):
+                self.bus.publish("execute", self.sleep, args=(i,), reply_channel="slept")
+
+        def sleep(self, i):
+            time.sleep(0.5)
+            return i
+
+        def slept(self, future):
+            self._log("job %d done after waiting %.2fs" % \
+                      (future.result(), future.started - future.submitted))
+            self.pending -= 1
+            if not self.pending:
+                self._log(self.bus.publish("get-executor-stats").pop())
+                self.bus.exit()
+
+    import logging
+    logging.basicConfig(level=logging.INFO)
+    p = Process()
+    p.interval = None
+    p.logger = logging.getLogger()
+    p.use_executor(size=4)
+    p.register_task(SleepyTask())
+    p.start()
+    p.join()
@@ -1,25 +1,90 @@
 # -*- coding: utf-8 -*-
+import time
+
 from Axon.Component import component
+from Axon.ThreadedComponent import threadedcomponent
 from Axon.Ipc import shutdownMicroprocess, producerFinished
 
-__all__ = ['KeepSchedulerAlive']
+__all__ = ['KeepSchedulerAlive', 'Ticker']
 
-class KeepSchedulerAlive(component):
+class Ticker(threadedcomponent):
+    """
+    Sends the current time to its outbox every `interval` seconds.
+
+    The component runs in its own thread and sleeps between ticks
+    so that whoever it is linked to can stay paused in between.
+    """
     Inboxes = {"inbox"    : "UNUSED",
                "control"  : "stops the component"}
-    
+
+    Outboxes = {"outbox"  : "ticks",
+                "signal"  : "Shutdown signal"}
+
+    def __init__(self, interval):
+        super(Ticker, self).__init__()
+        self.interval = interval
+
+    def main(self):
+        deadline = time.time() + self.interval
+        while 1:
+            if self.dataReady("control"):
+                mes = self.recv("control")
+                if isinstance(mes, shutdownMicroprocess) or \
+                       isinstance(mes, producerFinished):
+                    self.send(mes, "signal")
+                    break
+
+            now = time.time()
+            if now >= deadline:
+                self.send(now, "outbox")
+                deadline += self.interval
+                if deadline <= now:
+                    # don't try to catch up with ticks missed
+                    # while the process was busy
+                    deadline = now + self.interval
+            else:
+                self.pause(deadline - now)
+
+class KeepSchedulerAlive(component):
+    """
+    Publishes to the ``main`` channel of `bus` `frequency` times per
+    second from within the Axon scheduler.
+
+    The component is paused between ticks, which come from a
+    :class:`Ticker` child, so it doesn't keep the scheduler busy.
+    """
+    Inboxes = {"inbox"    : "ticks",
+               "control"  : "stops the component"}
+
     Outboxes = {"outbox"  : "UNUSED",
                 "signal"  : "Shutdown signal"}
 
-    def __init__(self, bus):
+    def __init__(self, bus, frequency=50.0):
         super(KeepSchedulerAlive, self).__init__()
         self.bus = bus
+        self.frequency = frequency
+        self._stopping = False
+
+    def shutdown(self):
+        """
+        Asks the component to stop on its next tick. Suitable
+        as a listener of the bus ``exit`` channel.
+        """
+        self._stopping = True
 
     def main(self):
+        ticker = Ticker(interval=1.0 / self.frequency)
+        self.link((ticker, 'outbox'), (self, 'inbox'))
+        self.link((self, 'signal'), (ticker, 'control'))
+        self.addChildren(ticker)
+        ticker.activate()
         yield 1
-        self.link((self, 'outbox'), (self, 'inbox'))
-        self.send(None, "outbox")
+
         while 1:
+            if self._stopping:
+                self.send(shutdownMicroprocess(), "signal")
+                break
+
             if self.dataReady("control"):
                 mes = self.recv("control")
                 if isinstance(mes, shutdownMicroprocess) or \
@@ -28,13 +93,15 @@ class KeepSchedulerAlive(component):
                     break
 
             if self.dataReady("inbox"):
-                self.recv("inbox")
+                # ticks may have piled up while the scheduler
+                # was busy, a single publish catches up with them
+                while self.dataReady("inbox"):
+                    self.recv("inbox")
                 self.bus.publish("main")
-                self.send(None, "outbox")
 
             if not self.anyReady():
                 self.pause()
-  
+
             yield 1
 
         self.bus = None
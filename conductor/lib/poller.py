@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+import asyncore
+import errno
+import select
+
+__all__ = ['AsyncorePoller']
+
+POLLIN = getattr(select, 'POLLIN', 1)
+POLLPRI = getattr(select, 'POLLPRI', 2)
+POLLOUT = getattr(select, 'POLLOUT', 4)
+POLLERR = getattr(select, 'POLLERR', 8)
+POLLHUP = getattr(select, 'POLLHUP', 16)
+POLLNVAL = getattr(select, 'POLLNVAL', 32)
+
+class AsyncorePoller(object):
+    """
+    Waits for the sockets of an asyncore map to be ready, or for
+    `waker` to be woken up, and dispatches the ready sockets
+    to their asyncore dispatcher.
+
+    epoll is used when available, then poll and finally select.
+    Unlike ``asyncore.poll2``, the epoll and poll objects are kept
+    across calls and a socket is only re-registered when its
+    interest changes.
+    """
+    def __init__(self, waker, socket_map=None):
+        self.waker = waker
+        if socket_map is None:
+            socket_map = asyncore.socket_map
+        self.map = socket_map
+        self._registered = {}
+
+        if hasattr(select, 'epoll'):
+            self._pollster = select.epoll()
+            self._timeout = lambda timeout: timeout
+        elif hasattr(select, 'poll'):
+            self._pollster = select.poll()
+            self._timeout = lambda timeout: int(timeout * 1000)
+        else:
+            self._pollster = None
+
+        if self._pollster is not None:
+            self._pollster.register(waker.fileno(), POLLIN)
+
+    def poll(self, timeout):
+        """
+        Waits at most `timeout` seconds and dispatches the sockets
+        which are ready.
+        """
+        if self._pollster is None:
+            return self._select(timeout)
+
+        self._update()
+        try:
+            events = self._pollster.poll(self._timeout(timeout))
+        except (select.error, IOError, OSError), e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return
+
+        waker_fd = self.waker.fileno()
+        for fd, flags in events:
+            if fd == waker_fd:
+                self.waker.consume()
+                continue
+            obj = self.map.get(fd)
+            if obj is not None:
+                asyncore.readwrite(obj, flags)
+
+    def close(self):
+        if self._pollster is not None and hasattr(self._pollster, 'close'):
+            self._pollster.close()
+        self._registered.clear()
+
+    def _update(self):
+        registered = self._registered
+        pollster = self._pollster
+        for fd, obj in self.map.items():
+            flags = 0
+            if obj.readable():
+                flags |= POLLIN | POLLPRI
+            # accepting sockets should not be writable
+            if obj.writable() and not obj.accepting:
+                flags |= POLLOUT
+            if flags:
+                flags |= POLLERR | POLLHUP | POLLNVAL
+
+            current = registered.get(fd)
+            if current is not None and current[1] is obj:
+                if current[0] == flags:
+                    continue
+                if flags:
+                    try:
+                        pollster.modify(fd, flags)
+                        registered[fd] = (flags, obj)
+                        continue
+                    except (IOError, OSError):
+                        # the descriptor was closed in the meantime
+                        pass
+
+            if current is not None:
+                self._unregister(fd)
+            if flags:
+                try:
+                    pollster.register(fd, flags)
+                except (IOError, OSError):
+                    continue
+                registered[fd] = (flags, obj)
+
+        if len(registered) > len(self.map):
+            for fd in [fd for fd in registered if fd not in self.map]:
+                self._unregister(fd)
+
+    def _unregister(self, fd):
+        del self._registered[fd]
+        try:
+            self._pollster.unregister(fd)
+        except (KeyError, IOError, OSError):
+            pass
+
+    def _select(self, timeout):
+        r = [self.waker]
+        w = []
+        e = []
+        for fd, obj in self.map.items():
+            is_r = obj.readable()
+            is_w = obj.writable() and not obj.accepting
+            if is_r:
+                r.append(fd)
+            if is_w:
+                w.append(fd)
+            if is_r or is_w:
+                e.append(fd)
+
+        try:
+            r, w, e = select.select(r, w, e, timeout)
+        except (select.error, IOError, OSError), err:
+            if err.args[0] != errno.EINTR:
+                raise
+            return
+
+        for fd in r:
+            if fd is self.waker:
+                self.waker.consume()
+                continue
+            obj = self.map.get(fd)
+            if obj is not None:
+                asyncore.read(obj)
+
+        for fd in w:
+            obj = self.map.get(fd)
+            if obj is not None:
+                asyncore.write(obj)
+
+        for fd in e:
+            obj = self.map.get(fd)
+            if obj is not None:
+                asyncore._exception(obj)
@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-
+__docformat__ = "restructuredtext en"
+import itertools
+import multiprocessing
+import os
+import select
+import threading
+import time
+import traceback
+from collections import deque
+
+from conductor.process import SynchronizedProcess
+from conductor.task import Task
+from conductor.lib.bus import ReadinessBarrier
+from conductor.lib.executor import FutureTask, Future
+
+__all__ = ['ProcessPoolTask', 'JobWorkerProcess', 'JobWorkerTask', 'WorkerLost']
+
+class WorkerLost(Exception):
+    """
+    Set on the future of a job whose worker process died
+    while running it.
+    """
+
+class JobWorkerTask(Task):
+    """
+    Runs, from the bus thread of a worker process, the jobs received
+    on `conn` and sends their results back on it.
+    """
+    def __init__(self, conn, bus=None):
+        Task.__init__(self, bus)
+        self.conn = conn
+        self.jobs = deque()
+        self.reader = None
+
+    def start_task(self):
+        self.bus.subscribe("main", self.run_jobs)
+        self.reader = threading.Thread(target=self._read)
+        self.reader.daemon = True
+        self.reader.start()
+        self.conn.send(('ready', os.getpid()))
+
+    def stop_task(self):
+        self.bus.unsubscribe("main", self.run_jobs)
+        self.conn.close()
+
+    def run_jobs(self):
+        jobs = self.jobs
+        ran = bool(jobs)
+        while jobs:
+            job = jobs.popleft()
+            if job is None:
+                self.bus.exit()
+                return True
+            job_id, func, args, kwargs = job
+            try:
+                reply = (job_id, True, func(*args, **kwargs))
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except Exception, e:
+                reply = (job_id, False, e, traceback.format_exc())
+            try:
+                self.conn.send(reply)
+            except Exception, e:
+                # most likely a result which can't be pickled
+                self.conn.send((job_id, False, RuntimeError(repr(e)), traceback.format_exc()))
+        return ran
+
+    def _read(self):
+        while 1:
+            try:
+                job = self.conn.recv()
+            except (EOFError, IOError):
+                job = None
+            self.jobs.append(job)
+            self.bus.wakeup()
+            if job is None:
+                break
+
+class JobWorkerProcess(SynchronizedProcess):
+    """
+    Warm worker process of a :class:`ProcessPoolTask`, released
+    by `condition` and running the jobs received on `conn`.
+    `parent_conn`, the other end of the pipe, is closed in the
+    worker so that it notices when the pool goes away.
+    """
+    def __init__(self, condition, conn, parent_conn=None):
+        SynchronizedProcess.__init__(self, condition)
+        self.interval = None
+        self.parent_conn = parent_conn
+        self.notatexit()
+        self.register_task(JobWorkerTask(conn))
+
+    def run(self):
+        if self.parent_conn is not None:
+            self.parent_conn.close()
+        SynchronizedProcess.run(self)
+
+class _Worker(object):
+    def __init__(self, process, conn):
+        self.process = process
+        self.conn = conn
+        self.ready = False
+        self.retiring = False
+        self.future = None
+        self.jobs = 0
+
+class ProcessPoolTask(FutureTask):
+    """
+    Runs CPU bound jobs in a pool of `size` warm
+    :class:`JobWorkerProcess` children so that they use all the
+    cores rather than compete for the GIL of the bus thread.
+
+    ``"execute-in-process"`` takes a module level function with its
+    `args` and `kwargs`, all of which are pickled to the worker, and
+    returns a :class:`conductor.lib.executor.Future` whose callbacks
+    are called from the bus thread, as with the ``"execute"`` channel
+    of :class:`conductor.lib.executor.ExecutorTask`.
+
+    Each worker runs one job at a time, the others waiting in the
+    task. At most `max_queued` jobs wait, ``"execute-in-process"``
+    raising ``RuntimeError`` beyond, unless set to 0. A worker is
+    replaced by a new one after `max_jobs_per_worker` jobs, and as
+    soon as it dies, its job then failing with :class:`WorkerLost`.
+    ``"get-process-pool-stats"`` returns the pool counters.
+    """
+    def __init__(self, bus=None, size=None):
+        FutureTask.__init__(self, bus)
+        self.size = size or multiprocessing.cpu_count()
+        self.max_queued = 1000
+        self.max_jobs_per_worker = 1000
+        self.stop_timeout = 10.0
+        self.logger = None
+
+        self.lock = threading.RLock()
+        # released up front, the workers report when they are ready
+        self.barrier = ReadinessBarrier()
+        self.barrier.release(0)
+        self.workers = []
+        self.queue = deque()
+        self.dispatcher = None
+        self._running = False
+        self._ids = itertools.count()
+
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.rejected = 0
+        self.lost = 0
+        self.recycled = 0
+        self.peak_queued = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.run_time = 0.0
+        self.max_run_time = 0.0
+
+    def start_task(self):
+        self._running = True
+        for i in range(0, self.size):
+            self._spawn()
+        self.dispatcher = threading.Thread(target=self._dispatch)
+        self.dispatcher.daemon = True
+        self.dispatcher.start()
+        self.bus.subscribe("execute-in-process", self.execute)
+        self.bus.subscribe("get-process-pool-stats", self.stats)
+        self.bus.subscribe("main", self.deliver)
+    start_task.priority = 6
+
+    def stop_task(self):
+        self.bus.unsubscribe("execute-in-process", self.execute)
+        self.bus.unsubscribe("get-process-pool-stats", self.stats)
+        with self.lock:
+            self._running = False
+            queued, self.queue = self.queue, deque()
+            for worker in self.workers:
+                self._retire(worker)
+        for future in queued:
+            future._set_cancelled()
+            self.cancelled += 1
+            self.done.append(future)
+        if queued:
+            self._log("Cancelled %d queued jobs" % len(queued), level=30)
+
+        deadline = time.time() + self.stop_timeout
+        for worker in list(self.workers):
+            worker.process.join(max(0, deadline - time.time()))
+            if worker.process.is_alive():
+                self._log("Terminating worker %d" % worker.process.pid, level=30)
+                worker.process.terminate()
+        self.dispatcher.join(1.0)
+
+        with self.lock:
+            for worker in self.workers:
+                self._lose(worker)
+            self.workers = []
+        self.deliver()
+        self.bus.unsubscribe("main", self.deliver)
+    stop_task.priority = 94
+
+    def execute(self, func, args=(), kwargs=None, reply_channel=None):
+        future = Future(func, args, kwargs, reply_channel)
+        future._canceller = self._cancel
+        with self.lock:
+            if not self._running:
+                raise RuntimeError("The process pool is stopped")
+            if self.max_queued and len(self.queue) >= self.max_queued:
+                self.rejected += 1
+                raise RuntimeError("Too many queued jobs")
+            self.submitted += 1
+            self.queue.append(future)
+            self.peak_queued = max(self.peak_queued, len(self.queue))
+            self._send_jobs()
+        return future
+
+    def stats(self):
+        with self.lock:
+            started = self.completed + self.failed + self.lost
+            return {'size': self.size,
+                    'ready': len([w for w in self.workers if w.ready and not w.retiring]),
+                    'busy': len([w for w in self.workers if w.future]),
+                    'queued': len(self.queue),
+                    'peak_queued': self.peak_queued,
+                    'submitted': self.submitted,
+                    'completed': self.completed,
+                    'failed': self.failed,
+                    'cancelled': self.cancelled,
+                    'rejected': self.rejected,
+                    'lost': self.lost,
+                    'recycled': self.recycled,
+                    'mean_wait_time': started and self.wait_time / started or 0.0,
+                    'max_wait_time': self.max_wait_time,
+                    'mean_run_time': started and self.run_time / started or 0.0,
+                    'max_run_time': self.max_run_time}
+
+    def _spawn(self):
+        parent_conn, child_conn = multiprocessing.Pipe()
+        process = JobWorkerProcess(self.barrier, child_conn, parent_conn)
+        process.logger = self.logger
+        process.start()
+        child_conn.close()
+        self.workers.append(_Worker(process, parent_conn))
+
+    def _retire(self, worker):
+        if not worker.retiring:
+            worker.retiring = True
+            try:
+                worker.conn.send(None)
+            except (IOError, OSError):
+                pass
+
+    def _lose(self, worker):
+        # the worker is gone, along with the job it was running
+        future = worker.future
+        if future is not None:
+            worker.future = None
+            self.lost += 1
+            future.set_exception(WorkerLost("Worker %s died running %r" % \
+                                            (worker.process.pid, future.func)))
+            self._job_done(future)
+        worker.conn.close()
+
+    def _cancel(self, future):
+        # takes the future out of the queue unless a worker got it
+        with self.lock:
+            try:
+                self.queue.remove(future)
+            except ValueError:
+                return False
+            self.cancelled += 1
+        future._set_cancelled()
+        self._job_done(future)
+        return True
+
+    def _send_jobs(self):
+        # called with the lock held
+        for worker in self.workers:
+            while self.queue and self.queue[0].cancelled():
+                self.queue.popleft()
+            if not self.queue:
+                return
+            if worker.ready and not worker.retiring and worker.future is None:
+                future = self.queue.popleft()
+                future.started = time.time()
+                waited = future.started - future.submitted
+                self.wait_time += waited
+                self.max_wait_time = max(self.max_wait_time, waited)
+                worker.future = future
+                worker.jobs += 1
+                try:
+                    worker.conn.send((self._ids.next(), future.func,
+                                      future.args, future.kwargs))
+                except (IOError, OSError):
+                    self._lose(worker)
+                    continue
+                except Exception, e:
+                    # the job can't be pickled
+                    worker.future = None
+                    self.failed += 1
+                    future.set_exception(e)
+                    self._job_done(future)
+
+    def _received(self, worker, reply):
+        # called with the lock held
+        if reply[0] == 'ready':
+            worker.ready = True
+            return
+
+        future, worker.future = worker.future, None
+        if future is None:
+            return
+        elapsed = time.time() - future.started
+        self.run_time += elapsed
+        self.max_run_time = max(self.max_run_time, elapsed)
+        if reply[1]:
+            self.completed += 1
+            future.set_result(reply[2])
+        else:
+            self.failed += 1
+            future.traceback = reply[3]
+            future.set_exception(reply[2])
+        self._job_done(future)
+
+        if self.max_jobs_per_worker and worker.jobs >= self.max_jobs_per_worker \
+               and self._running:
+            self.recycled += 1
+            self._retire(worker)
+            self._spawn()
+
+    def _dispatch(self):
+        while 1:
+            with self.lock:
+                workers = [w for w in self.workers if not w.conn.closed]
+                if not self.workers:
+                    return
+
+            try:
+                readable = select.select([w.conn for w in workers], [], [], 0.5)[0]
+            except (select.error, IOError, ValueError):
+                readable = []
+
+            with self.lock:
+                for worker in workers:
+                    if worker.conn.closed:
+                        continue
+                    if worker.conn in readable:
+                        try:
+                            while worker.conn.poll():
+                                self._received(worker, worker.conn.recv())
+                            continue
+                        except (EOFError, IOError):
+                            pass
+                    elif worker.process.is_alive():
+                        continue
+
+                    worker.process.join(0.1)
+                    if not worker.retiring:
+                        self._log("Worker %s exited with %s" % \
+                                  (worker.process.pid, worker.process.exitcode), level=30)
+                    self._lose(worker)
+                    if worker in self.workers:
+                        self.workers.remove(worker)
+                    if self._running and not worker.retiring:
+                        self._spawn()
+
+                if not self._running and not self.workers:
+                    return
+                self._send_jobs()
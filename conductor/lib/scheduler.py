@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+__docformat__ = "restructuredtext en"
+import math
+import time
+
+from conductor.task import Task
+
+__all__ = ['Timer', 'TimerWheel', 'SchedulerTask']
+
+class Timer(object):
+    """
+    Callback registered with a :class:`TimerWheel`.
+    """
+    def __init__(self, callback, args=(), kwargs=None, period=None):
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.period = period
+        self.expires = 0
+        self.cancelled = False
+        self._entry = None
+
+    def __call__(self):
+        return self.callback(*self.args, **self.kwargs)
+
+class TimerWheel(object):
+    """
+    Hierarchical timing wheel.
+
+    The first level has `slots` buckets of `resolution` seconds,
+    each following level has `slots` buckets covering a full turn
+    of the level below. Adding or cancelling a timer costs O(1)
+    and advancing the wheel only visits the buckets that expire:
+    their timers are either due or cascaded one level down.
+
+    Timers further away than the whole wheel are parked in the
+    last bucket of the top level and cascaded again later.
+    """
+    def __init__(self, resolution=0.01, slots=64, levels=4, now=None):
+        self.resolution = resolution
+        self.slots = slots
+        self.levels = levels
+        self.origin = now if now is not None else time.time()
+        self.current = 0
+        self.count = 0
+        # buckets hold [timer, expires] entries, a cancelled
+        # entry has its timer set to None and is dropped lazily
+        self._wheels = [[[] for _ in range(slots)] for _ in range(levels)]
+
+    def add(self, timer, deadline):
+        """
+        Adds `timer` so that it is returned by the first call to
+        :meth:`advance` made at or after `deadline`. A timer which
+        is already in the wheel is moved.
+        """
+        self.cancel(timer)
+        expires = int(math.ceil((deadline - self.origin) / self.resolution))
+        # the current tick has already been processed
+        timer.expires = max(expires, self.current + 1)
+        timer.cancelled = False
+        timer._entry = [timer, timer.expires]
+        self.count += 1
+        self._insert(timer._entry)
+        return timer
+
+    def cancel(self, timer):
+        """
+        Cancels `timer`.
+        """
+        timer.cancelled = True
+        entry = timer._entry
+        if entry is not None and entry[0] is not None:
+            entry[0] = None
+            self.count -= 1
+        timer._entry = None
+
+    def advance(self, now=None):
+        """
+        Moves the wheel up to `now` and returns the timers that
+        expired on the way, in expiration order.
+        """
+        if now is None:
+            now = time.time()
+        target = int((now - self.origin) / self.resolution)
+        slots = self.slots
+        wheels = self._wheels
+        due = []
+
+        while self.current < target:
+            if not self.count:
+                # nothing left to expire, jump ahead
+                self.current = target
+                break
+
+            self.current += 1
+            tick = self.current
+
+            span = 1
+            for level in range(1, self.levels):
+                span *= slots
+                if tick % span:
+                    break
+                index = (tick // span) % slots
+                bucket = wheels[level][index]
+                if bucket:
+                    wheels[level][index] = []
+                    for entry in bucket:
+                        if entry[0] is not None:
+                            self._insert(entry)
+
+            index = tick % slots
+            bucket = wheels[0][index]
+            if bucket:
+                wheels[0][index] = []
+                for entry in bucket:
+                    timer = entry[0]
+                    if timer is not None:
+                        entry[0] = None
+                        timer._entry = None
+                        self.count -= 1
+                        due.append(timer)
+
+        return due
+
+    def next_expiry(self):
+        """
+        Returns the earliest time at which :meth:`advance` may return
+        a timer or have to cascade one, ``None`` if the wheel is empty.
+        """
+        if not self.count:
+            return None
+        bucket0 = self._wheels[0]
+        tick = self.current
+        for _ in range(self.slots):
+            tick += 1
+            if bucket0[tick % self.slots] or tick % self.slots == 0:
+                break
+        return self.origin + tick * self.resolution
+
+    def _insert(self, entry):
+        slots = self.slots
+        expires = entry[1]
+        delta = expires - self.current
+        if delta <= 0:
+            # cascaded onto the tick being processed, level 0
+            # is emptied right after the cascades
+            self._wheels[0][self.current % slots].append(entry)
+            return
+
+        span = 1
+        for level in range(self.levels):
+            if delta < span * slots:
+                self._wheels[level][(expires // span) % slots].append(entry)
+                return
+            span *= slots
+
+        # beyond the wheel: park it in the furthest bucket of the
+        # top level, it'll be re-inserted once it cascades
+        span //= slots
+        index = (self.current // span + slots - 1) % slots
+        self._wheels[-1][index].append(entry)
+
+class SchedulerTask(Task):
+    """
+    Calls functions back at a given period or deadline from
+    the process main loop.
+
+    Tasks register a callback by publishing to ``"schedule"``::
+
+        timer = self.bus.publish("schedule", self.poll, period=5.0).pop()
+
+    and cancel it by publishing the returned timer to
+    ``"cancel-schedule"``. Only the callbacks which are due are
+    called on a ``main`` tick. When the bus supports ``call_later``
+    the task also arms a bus timer so that a wakeup-driven
+    process ticks on time.
+    """
+    def __init__(self, bus=None, resolution=0.01):
+        Task.__init__(self, bus)
+        self.resolution = resolution
+        self.wheel = None
+        self._armed = None
+        self._armed_at = None
+
+    def start_task(self):
+        self.wheel = TimerWheel(self.resolution)
+        self.bus.subscribe('schedule', self.schedule)
+        self.bus.subscribe('cancel-schedule', self.cancel)
+        self.bus.subscribe('main', self.run_due)
+    start_task.priority = 5
+
+    def stop_task(self):
+        self.bus.unsubscribe('schedule', self.schedule)
+        self.bus.unsubscribe('cancel-schedule', self.cancel)
+        self.bus.unsubscribe('main', self.run_due)
+        self._disarm()
+        self.wheel = None
+    stop_task.priority = 95
+
+    def schedule(self, callback, period=None, deadline=None, args=(), kwargs=None):
+        """
+        Calls `callback` at `deadline` (a timestamp) or, if it isn't
+        provided, `period` seconds from now. When `period` is set
+        the callback is then called every `period` seconds.
+        """
+        if not self.wheel:
+            return
+
+        if deadline is None:
+            if period is None:
+                raise ValueError("Either a period or a deadline must be provided")
+            deadline = time.time() + period
+
+        timer = Timer(callback, args, kwargs, period)
+        self.wheel.add(timer, deadline)
+        self._arm()
+        return timer
+
+    def cancel(self, timer):
+        if self.wheel:
+            self.wheel.cancel(timer)
+
+    def run_due(self):
+        """
+        Runs the timers which expired and returns
+        whether there were any.
+        """
+        if not self.wheel:
+            return False
+
+        now = time.time()
+        due = self.wheel.advance(now)
+        for timer in due:
+            try:
+                timer()
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except:
+                self._log("Error in scheduled callback %r" % (timer.callback,),
+                          level=40, traceback=True)
+
+            if timer.period and not timer.cancelled and self.wheel:
+                deadline = self.wheel.origin + timer.expires * self.resolution + timer.period
+                if deadline <= now:
+                    # we're late, skip the missed runs
+                    deadline = now + timer.period
+                self.wheel.add(timer, deadline)
+
+        self._arm()
+        return bool(due)
+
+    def _arm(self):
+        call_later = getattr(self.bus, 'call_later', None)
+        if not call_later or not self.wheel:
+            return
+
+        expiry = self.wheel.next_expiry()
+        if expiry is None:
+            return
+        if self._armed is not None and self._armed_at <= expiry \
+               and self._armed_at > time.time():
+            return
+
+        self._disarm()
+        self._armed_at = expiry
+        self._armed = call_later(max(0, expiry - time.time()), self._wakeup)
+
+    def _disarm(self):
+        if self._armed is not None:
+            self.bus.cancel(self._armed)
+            self._armed = None
+            self._armed_at = None
+
+    def _wakeup(self):
+        # the bus publishes to main right after its timers
+        self._armed = None
+        self._armed_at = None
+
+if __name__ == '__main__':
+    from conductor.process import Process
+
+    class TickTask(Task):
+        def start_task(self):
+            self._fast = self._schedule(self.tick, 0.5)
+            self._slow = self._schedule(self.tock, 2.0)
+
+        def stop_task(self):
+            self._unschedule(self._fast, self.tick)
+            self._unschedule(self._slow, self.tock)
+
+        def tick(self):
+            self._log("tick")
+
+        def tock(self):
+            self._log("tock")
+
+    import logging
+    logging.basicConfig(level=logging.INFO)
+    p = Process()
+    p.interval = None
+    p.logger = logging.getLogger()
+    p.register_task(TickTask())
+    p.start()
+    p.join()
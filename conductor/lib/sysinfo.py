@@ -23,6 +23,7 @@ class SysInfoTask(Task):
         self.dump = timedump.Timedump()
 
         self._last = 0
+        self._timer = None
         self._p = psutil.Process(os.getpid())
         
     def _get_storage(self):
@@ -36,14 +37,16 @@ class SysInfoTask(Task):
 
     def start_task(self):
         if self.monitoring_freq > 0:
-            self.bus.subscribe('main', self.monitor_task)
+            self._timer = self._schedule(self._monitor, self.monitoring_freq,
+                                         fallback=self.monitor_task)
         self.bus.subscribe('sysinfo', self._dump_sysinfo)
         self.bus.subscribe('getsysinfo', self._gather_sysinfo)
 
     def stop_task(self):
         self.bus.unsubscribe('sysinfo', self._dump_sysinfo)
         self.bus.unsubscribe('getsysinfo', self._gather_sysinfo)
-        self.bus.unsubscribe('main', self.monitor_task)
+        self._unschedule(self._timer, self._monitor, fallback=self.monitor_task)
+        self._timer = None
         from cherrypy.process import wspbus
         if self.bus.state == wspbus.states.EXITING:
             self.dump.done()
@@ -52,9 +55,12 @@ class SysInfoTask(Task):
         now = int(time.time())
         if now - self._last >= self.monitoring_freq:
             self._last = now
-            self._dump_sysinfo(complete=True, cpu_times=True, 
-                               cpu_usage=True, memory_info=True, 
-                               memory_usage=True, gc_count=False)
+            self._monitor()
+
+    def _monitor(self):
+        self._dump_sysinfo(complete=True, cpu_times=True, 
+                           cpu_usage=True, memory_info=True, 
+                           memory_usage=True, gc_count=False)
 
     def _gather_sysinfo(self, cpu_times=False, cpu_usage=True, 
                         memory_info=False, memory_usage=True, 
@@ -122,6 +128,7 @@ class ConsoleSysInfoTask(Task):
         self.monitoring_freq = 0
 
         self._last = 0
+        self._timer = None
         self._p = psutil.Process(os.getpid())
         
     def start(self):
@@ -134,10 +141,12 @@ class ConsoleSysInfoTask(Task):
 
     def start_task(self):
         if self.monitoring_freq > 0:
-            self.bus.subscribe('main', self.monitor_task)
+            self._timer = self._schedule(self._dump_sysinfo, self.monitoring_freq,
+                                         fallback=self.monitor_task)
 
     def stop_task(self):
-        self.bus.unsubscribe('main', self.monitor_task)
+        self._unschedule(self._timer, self._dump_sysinfo, fallback=self.monitor_task)
+        self._timer = None
 
     def monitor_task(self):
         now = int(time.time())
@@ -7,10 +7,17 @@ __all__ = ['kill_proc']
 try:
     from os import kill
     from signal import SIGTERM
-    def kill_proc(pid): return kill(pid, SIGTERM)
+    # Windows has no SIGKILL, os.kill terminates the process anyway
+    SIGKILL = getattr(signal, 'SIGKILL', SIGTERM)
+    def kill_proc(pid, force=False):
+        """
+        Asks the process `pid` to terminate, or kills it
+        right away when `force` is set.
+        """
+        return kill(pid, force and SIGKILL or SIGTERM)
 except ImportError:
     # http://www.python.org/doc/faq/windows/#how-do-i-emulate-os-kill-in-windows
-    def kill_proc(pid):
+    def kill_proc(pid, force=False):
         """kill function for Win32"""
         import win32api
         handle = win32api.OpenProcess(1, 0, pid)
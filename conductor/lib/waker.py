@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+import errno
+import os
+import select
+import socket
+
+__all__ = ['Waker']
+
+class Waker(object):
+    """
+    Self-pipe used to interrupt a thread sleeping in ``select``
+    or ``poll``.
+
+    Calling :meth:`wake` from any thread (or from a signal handler)
+    makes the read end of the pipe readable, which returns the
+    sleeping thread from its poll. Successive wakes are coalesced
+    until the sleeper calls :meth:`consume`.
+    """
+    def __init__(self):
+        self._pending = False
+
+        if os.name == 'posix':
+            import fcntl
+            self._reader, self._writer = os.pipe()
+            for fd in (self._reader, self._writer):
+                flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+                fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+                flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+                fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+            self._read = lambda: os.read(self._reader, 4096)
+            self._write = lambda: os.write(self._writer, 'x')
+            self._close = lambda: (os.close(self._reader), os.close(self._writer))
+        else:
+            # select() only works with sockets on Windows
+            server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server.bind(('127.0.0.1', 0))
+            server.listen(1)
+            writer = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            writer.connect(server.getsockname())
+            reader, _ = server.accept()
+            server.close()
+            reader.setblocking(0)
+            writer.setblocking(0)
+            self._reader, self._writer = reader, writer
+            self._read = lambda: reader.recv(4096)
+            self._write = lambda: writer.send('x')
+            self._close = lambda: (reader.close(), writer.close())
+
+    def fileno(self):
+        """
+        Returns the file descriptor to watch for readability.
+        """
+        if isinstance(self._reader, socket.socket):
+            return self._reader.fileno()
+        return self._reader
+
+    def signal_fileno(self):
+        """
+        Returns the file descriptor that can be handed to
+        ``signal.set_wakeup_fd`` or ``None`` on platforms
+        where this isn't supported.
+        """
+        if isinstance(self._writer, socket.socket):
+            return None
+        return self._writer
+
+    def wake(self):
+        """
+        Wakes up the thread sleeping on this waker.
+        """
+        if self._pending:
+            return
+        self._pending = True
+        try:
+            self._write()
+        except (IOError, OSError, socket.error):
+            # the pipe is full, the sleeper will wake up anyway
+            pass
+
+    def consume(self):
+        """
+        Drains the pipe. Must be called by the sleeping thread
+        once it has been woken up.
+        """
+        try:
+            self._read()
+        except (IOError, OSError, socket.error):
+            pass
+        self._pending = False
+
+    def wait(self, timeout):
+        """
+        Sleeps until :meth:`wake` is called or `timeout`
+        seconds have elapsed.
+        """
+        if not self._pending:
+            try:
+                select.select([self], [], [], timeout)
+            except (select.error, IOError, OSError), e:
+                # a signal handler ran, the caller checks its state anyway
+                if e.args[0] != errno.EINTR:
+                    raise
+        self.consume()
+
+    def close(self):
+        self._close()
@@ -2,6 +2,8 @@
 __docformat__ = "restructuredtext en"
 import os
 import sys
+import threading
+import time
 import logging
 
 try:
@@ -17,20 +19,34 @@ except ImportError:
             return os.getpid()
 
 __all__ = ['Process', 'AxonProcess', 'CherryPyProcess',
-           'TornadoProcess', 'AsyncoreProcess']
+           'TornadoProcess', 'AsyncoreProcess', 'AsyncioProcess',
+           'SynchronizingProcess', 'SynchronizedProcess',
+           'SynchronizedAsyncoreProcess']
 
 class Process(_Process):
     """
     Represents a process that can run tasks.
+
+    The process blocks on its bus which publishes to ``main``
+    whenever it is woken up (see :class:`conductor.lib.bus.WakeupBus`)
+    and at the latest every `interval` seconds. Setting `interval`
+    to ``None`` makes the process entirely wakeup-driven.
+
+    A :class:`conductor.lib.scheduler.SchedulerTask` is registered
+    along with the first task so that tasks can run periodic work
+    through the ``schedule`` channel rather than on every tick.
     """
     def __init__(self):
         _Process.__init__(self)
         self.logger = None
         self.daemon = False
         self.interval = 0.1
+        self.scheduler = None
+        self.executor = None
+        self.process_pool = None
 
-        from cherrypy.process.wspbus import Bus
-        self.bus = Bus()
+        from conductor.lib.bus import WakeupBus
+        self.bus = WakeupBus()
         self.bus.subscribe('log', self.log)
 
     def notatexit(self):
@@ -46,6 +62,11 @@ class Process(_Process):
         """
         Subscribes `task` with `self.bus`.
         """
+        if self.scheduler is None or self.scheduler.bus is not self.bus:
+            from conductor.lib.scheduler import SchedulerTask
+            self.scheduler = SchedulerTask(self.bus)
+            self.scheduler.subscribe()
+
         self.log('Registering task: %s' % task.__class__)
         task.proc = self
         task.bus = self.bus
@@ -61,6 +82,71 @@ class Process(_Process):
         task.unsubscribe()
         task.bus = None
 
+    def instrument_bus(self, sample_rate=1.0, budget=None, channels=None,
+                       dump_on_exit=True):
+        """
+        Times the listeners of the process's bus with a
+        :class:`conductor.lib.busstats.BusStats` which is returned.
+
+        The stats are then returned by ``"get-bus-stats"`` and
+        logged when the bus exits if `dump_on_exit` is set.
+        """
+        if not hasattr(self.bus, 'instrument'):
+            raise TypeError("%s can't be instrumented" % self.bus.__class__.__name__)
+
+        from conductor.lib.busstats import BusStats
+        stats = BusStats(sample_rate, budget, channels)
+        self.bus.instrument = stats
+        self.bus.subscribe('get-bus-stats', stats.stats)
+        if dump_on_exit:
+            def dump():
+                for line in stats.report():
+                    self.log(line)
+            self.bus.subscribe('exit', dump, priority=90)
+        return stats
+
+    def use_executor(self, size=None, conf=None):
+        """
+        Registers a :class:`conductor.lib.executor.ExecutorTask`
+        running ``"execute"`` jobs in `size` threads, which is
+        returned.
+
+        When `size` isn't given, it is read from the ``size`` option
+        of the ``executor`` section of `conf`, a
+        :class:`conductor.lib.conf.Config`, and defaults to 4.
+        """
+        if size is None:
+            size = conf and conf.get('executor', 'size') or 4
+
+        from conductor.lib.executor import ExecutorTask
+        self.executor = ExecutorTask(size=size)
+        if conf:
+            self.executor.max_queued = conf.get('executor', 'max_queued', 0)
+        self.register_task(self.executor)
+        return self.executor
+
+    def use_process_pool(self, size=None, conf=None):
+        """
+        Registers a :class:`conductor.lib.processpool.ProcessPoolTask`
+        running ``"execute-in-process"`` jobs in `size` worker
+        processes, which is returned.
+
+        When `size` isn't given, it is read from the ``size`` option
+        of the ``process_pool`` section of `conf` and defaults to the
+        number of CPUs.
+        """
+        if size is None:
+            size = conf and conf.get('process_pool', 'size')
+
+        from conductor.lib.processpool import ProcessPoolTask
+        self.process_pool = ProcessPoolTask(size=size)
+        self.process_pool.logger = self.logger
+        if conf:
+            self.process_pool.max_queued = conf.get('process_pool', 'max_queued', 1000)
+            self.process_pool.max_jobs_per_worker = conf.get('process_pool', 'max_jobs_per_worker', 1000)
+        self.register_task(self.process_pool)
+        return self.process_pool
+
     def run(self):
         """
         Start the bus and blocks on the bus.
@@ -109,55 +195,46 @@ class SynchronizedProcess(Process):
         from conductor.lib.bus import SynchronizedBus
         self.bus = SynchronizedBus(cond=condition)
         self.bus.subscribe('log', self.log)
+
+class SynchronizedAsyncoreProcess(SynchronizedProcess):
+    """
+    Synchronized process running asyncore tasks
+    (see :class:`AsyncoreProcess`).
+    """
+    def __init__(self, condition):
+        SynchronizedProcess.__init__(self, condition)
+        from conductor.lib.bus import SynchronizedAsyncoreBus
+        self.bus = SynchronizedAsyncoreBus(cond=condition)
+        self.bus.subscribe('log', self.log)
             
 class AsyncoreProcess(Process):
     """
     Represents a process that can run asyncore tasks.
     
-    The blocking model is based on the asyncore loop.
+    The blocking model is based on the asyncore loop: the bus polls
+    the asyncore sockets while it waits between ``main`` ticks
+    and is woken up by bus events (see :class:`conductor.lib.bus.AsyncoreBus`).
     """
     def __init__(self):
         Process.__init__(self)
-        self.timeout = 30.0
-        self.interval = 0.02
-
-        import select
-        if hasattr(select, "poll"):
-            from asyncore import poll2
-            self.poll = poll2
-        else:
-            from asyncore import poll
-            self.poll = poll
-        
-    def run(self):
-        """
-        Start the bus and blocks on the Axon scheduler.
-        """
-        self.log("AsyncoreProcess PID: %d" % (self.pid or os.getpid(),))
-
-        self.bus.subscribe('main', self.loop_once)
-        
-        from cherrypy.process import plugins
-        sig = plugins.SignalHandler(self.bus)
-        if sys.platform[:4] == 'java':
-            # See http://bugs.jython.org/issue1313
-            sig.handlers['SIGINT'] = self._jython_handle_SIGINT
-        sig.subscribe()
-        self.bus.start()
-        self.bus.block(interval=self.interval)
-
-    def loop_once(self):
-        self.poll(self.timeout)
+        from conductor.lib.bus import AsyncoreBus
+        self.bus = AsyncoreBus()
+        self.bus.subscribe('log', self.log)
             
 class AxonProcess(Process):
     """
     Represents a process that can run Axon/Kamaelia tasks.
     
     The blocking model is based on the Axon.
+
+    The bus publishes to ``main`` `frequency` times per second
+    while `interval` is the `slowmo` value the Axon scheduler
+    is run with.
     """
     def __init__(self):
         Process.__init__(self)
         self.interval = 0.02
+        self.frequency = 50.0
 
     def run(self):
         """
@@ -166,8 +243,9 @@ class AxonProcess(Process):
         self.log("AxonProcess PID: %d" % (self.pid or os.getpid(),))
 
         from conductor.lib.keepalive import KeepSchedulerAlive
-        self.keepalive = KeepSchedulerAlive(bus=self.bus)
+        self.keepalive = KeepSchedulerAlive(bus=self.bus, frequency=self.frequency)
         self.keepalive.activate()
+        self.bus.subscribe('exit', self.keepalive.shutdown)
 
         from cherrypy.process import plugins
         sig = plugins.SignalHandler(self.bus)
@@ -182,20 +260,36 @@ class AxonProcess(Process):
             scheduler.run.runThreads(slowmo = self.interval)
         except KeyboardInterrupt:
             pass
-        self.bus.exit()
+
+        from cherrypy.process.wspbus import states
+        if self.bus.state != states.EXITING:
+            self.bus.exit()
 
 class TornadoProcess(Process):
     """
     Represents a process that can run Tornado tasks.
     
     The blocking model is based on the Tornado's ioloop.
+
+    The bus publishes to ``main`` from an ioloop timeout every
+    `interval` seconds so that the ioloop can idle between ticks,
+    and right away when the bus is woken up. When `max_interval` is
+    set, the cadence adapts: it is multiplied by `backoff` after each
+    tick where no ``main`` listener returned a true value, which they
+    do when they found work, up to `max_interval`, and goes back to
+    `interval` as soon as one of them does or the bus is woken up.
     """
     def __init__(self):
         Process.__init__(self)
+        self.interval = 0.02
+        self.max_interval = None
+        self.backoff = 2.0
+        self._tick = None
+        self._timeout = None
 
     def run(self):
         """
-        Start the bus and blocks on the Axon scheduler.
+        Start the bus and blocks on the Tornado ioloop.
         """
         self.log("TornadoProcess PID: %d" % (self.pid or os.getpid(),))
 
@@ -208,20 +302,99 @@ class TornadoProcess(Process):
 
         self.bus.start()
 
+        from tornado import ioloop
+        waker = self.bus._get_waker()
         try:
-            from tornado import ioloop
             self.ioloop = ioloop.IOLoop.instance()
+            self._tick = self.interval
+            self.ioloop.add_handler(waker.fileno(), self._woken, ioloop.IOLoop.READ)
+            self.bus._loop_thread = threading.currentThread()
             self.ioloop.add_callback(self.publish_main)
             self.ioloop.start()
         except KeyboardInterrupt:
             pass
+        self.bus._loop_thread = None
+        self.ioloop.remove_handler(waker.fileno())
 
         ioloop.IOLoop.instance().stop()
-        self.bus.exit()
+
+        from cherrypy.process.wspbus import states
+        if self.bus.state != states.EXITING:
+            self.bus.exit()
 
     def publish_main(self):
-        self.bus.publish("main")
-        self.ioloop.add_callback(self.publish_main)
+        from cherrypy.process.wspbus import states
+        self._timeout = None
+        if self.bus.state == states.EXITING:
+            self.ioloop.stop()
+            return
+
+        busy = True
+        try:
+            self.bus.run_timers()
+            busy = any(self.bus.publish("main"))
+        finally:
+            if self.max_interval:
+                if busy:
+                    self._tick = self.interval
+                else:
+                    self._tick = min(self._tick * self.backoff, self.max_interval)
+            delay = self._tick
+            timer = self.bus.next_timer_delay()
+            if timer is not None and timer < delay:
+                delay = timer
+            self._timeout = self.ioloop.add_timeout(time.time() + delay,
+                                                    self.publish_main)
+
+    def _woken(self, fd, events):
+        self.bus._get_waker().consume()
+        self._tick = self.interval
+        if self._timeout is not None:
+            self.ioloop.remove_timeout(self._timeout)
+        self.publish_main()
+
+class AsyncioProcess(Process):
+    """
+    Represents a process that runs its bus on an asyncio event loop
+    (or trollius on Python 2).
+
+    Bus listeners, including the `start_task` and `stop_task` methods
+    of tasks, may be coroutine functions. Their coroutines are run as
+    tasks on the loop and, when the process exits, the loop keeps
+    running for up to `shutdown_timeout` seconds to let them finish.
+    """
+    def __init__(self):
+        Process.__init__(self)
+        self.shutdown_timeout = 5.0
+
+        from conductor.lib.bus import AsyncioBus
+        self.bus = AsyncioBus()
+        self.bus.subscribe('log', self.log)
+
+    def run(self):
+        """
+        Start the bus and blocks on the event loop.
+        """
+        self.log("AsyncioProcess PID: %d" % (self.pid or os.getpid(),))
+
+        asyncio = self.bus.asyncio
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.bus.loop = self.loop
+
+        from cherrypy.process import plugins
+        sig = plugins.SignalHandler(self.bus)
+        if sys.platform[:4] == 'java':
+            # See http://bugs.jython.org/issue1313
+            sig.handlers['SIGINT'] = self._jython_handle_SIGINT
+        sig.subscribe()
+
+        try:
+            self.bus.start()
+            self.bus.block(interval=self.interval)
+        finally:
+            self.bus.drain(self.shutdown_timeout)
+            self.loop.close()
 
 class CherryPyProcess(Process):
     """
@@ -1,15 +1,21 @@
 # -*- coding: utf-8 -*-
 import threading
+import time
+import weakref
+from collections import deque
+
 from carrot.messaging import Publisher
 from carrot.connection import BrokerConnection
 
 from conductor.task import Task
 
-__all__ = ['AMQPBrokerTask', 'BrokerPool', 'AMQPBrokerSettings']
+__all__ = ['AMQPBrokerTask', 'BrokerPool', 'AMQPBrokerSettings',
+           'PoolExhausted', 'ChannelPool', 'BrokerChannel']
 
 class AMQPBrokerSettings(object):
     """
-    AMQP connection settings.
+    AMQP connection settings. `backend_cls` is the carrot
+    backend, a class or its dotted name, amqplib by default.
     """
     def __init__(self):
         self.hostname = None
@@ -17,41 +23,132 @@ class AMQPBrokerSettings(object):
         self.username = None
         self.password = None
         self.vhost = "/"
+        self.backend_cls = None
 
 class AMQPBrokerTask(Task):
+    """
+    Manages a :class:`BrokerPool` of at most `pool_size` connections.
+
+    When the connections are all in use, ``"get-amqp-broker"`` raises
+    :exc:`PoolExhausted` right away when published from the bus thread,
+    which is where they are released, and waits at most
+    `checkout_timeout` seconds for one otherwise. Connections idle for
+    more than `idle_timeout` seconds are closed, `min_size` of them
+    are kept. ``"get-amqp-pool-stats"`` returns the pool counters.
+
+    When `channels_per_connection` is greater than 1, the task hands
+    out :class:`BrokerChannel` instances instead, up to that number
+    of them sharing each connection (see :class:`ChannelPool`).
+    """
     def __init__(self, bus=None):
         Task.__init__(self, bus)
         self.settings = AMQPBrokerSettings()
         self.pool_size = 10
+        self.min_size = 0
+        self.idle_timeout = 300.0
+        self.checkout_timeout = 5.0
+        self.channels_per_connection = 1
         self.pool = None
+        self.channels = None
+        self._timer = None
 
     def start_task(self):
         self.bus.log("Starting AMQP broker management task")
         self.pool = BrokerPool(self.settings.hostname, self.settings.port,
                                self.settings.username, self.settings.password,
-                               self.settings.vhost, self.pool_size)
-        with self.pool.lock:
-            pass
+                               self.settings.vhost, self.pool_size,
+                               min_size=self.min_size, idle_timeout=self.idle_timeout,
+                               backend_cls=self.settings.backend_cls)
+        if self.channels_per_connection > 1:
+            self.channels = ChannelPool(self.pool, self.channels_per_connection)
 
         self.bus.subscribe("get-amqp-broker", self.get_broker)
         self.bus.subscribe("release-amqp-broker", self.release_broker)
+        self.bus.subscribe("discard-amqp-broker", self.discard_broker)
+        self.bus.subscribe("get-amqp-pool-stats", self.pool_stats)
+        if self.idle_timeout:
+            self._timer = self._schedule(self.pool.evict_idle, self.idle_timeout / 2.0,
+                                         fallback=self.evict_task)
     start_task.priority = 10
         
     def stop_task(self):
         self.bus.log("Stopping AMQP broker management task")
+        if self.idle_timeout:
+            self._unschedule(self._timer, self.pool.evict_idle, fallback=self.evict_task)
+            self._timer = None
         self.bus.unsubscribe("get-amqp-broker", self.get_broker)
         self.bus.unsubscribe("release-amqp-broker", self.release_broker)
+        self.bus.unsubscribe("discard-amqp-broker", self.discard_broker)
+        self.bus.unsubscribe("get-amqp-pool-stats", self.pool_stats)
+        if self.channels:
+            self.channels.release_all()
+            self.channels = None
         self.pool.release_all()
     stop_task.priority = 90
 
-    def get_broker(self):
-        return self.pool.get()
+    def get_broker(self, timeout=None):
+        if timeout is None:
+            # waiting from the bus thread would only block
+            # the releases until the timeout
+            is_foreign = getattr(self.bus, '_is_foreign', None)
+            if is_foreign is not None and is_foreign():
+                timeout = self.checkout_timeout
+            else:
+                timeout = 0
+        if self.channels:
+            return self.channels.get(timeout)
+        return self.pool.get(timeout)
 
     def release_broker(self, broker):
-        self.pool.release(broker)
+        if isinstance(broker, BrokerChannel):
+            self.channels.release(broker)
+        else:
+            self.pool.release(broker)
+
+    def discard_broker(self, broker):
+        if isinstance(broker, BrokerChannel):
+            self.channels.discard(broker)
+        else:
+            self.pool.discard(broker)
+
+    def pool_stats(self):
+        stats = self.pool.stats()
+        if self.channels:
+            stats['channels'] = self.channels.stats()
+        return stats
+
+    def evict_task(self):
+        self.pool.evict_idle()
+
+class PoolExhausted(Exception):
+    """
+    Raised when no broker connection could be checked out
+    of a :class:`BrokerPool` in time.
+    """
+
+class _Waiter(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.broker = None
+        # set when the waiter was given room to create a broker
+        self.create = False
 
 class BrokerPool(object):
-    def __init__(self, hostname, port, username, password, vhost, pool_size=10):
+    """
+    Pool of broker connections.
+
+    Connections are created lazily, up to `pool_size` of them, and
+    the ones idle for more than `idle_timeout` seconds are closed by
+    :meth:`evict_idle` as long as `min_size` connections remain.
+
+    When all the connections are in use, :meth:`get` waits for one to
+    be released. Waiters are served in their arrival order. Before
+    being handed out, an idle connection is checked with
+    `health_check`, a callable taking the connection and returning
+    whether it can be used.
+    """
+    def __init__(self, hostname, port, username, password, vhost, pool_size=10,
+                 min_size=0, idle_timeout=300.0, backend_cls=None):
         self.lock = threading.Lock()
         
         self.hostname = hostname
@@ -59,48 +156,531 @@ class BrokerPool(object):
         self.username = username
         self.password = password
         self.vhost = vhost
+        self.backend_cls = backend_cls
 
-        self._brokers = []
-        self._checkedout_brokers = []
+        self.max_size = pool_size
+        self.min_size = min_size
+        self.idle_timeout = idle_timeout
+        self.health_check = self.is_healthy
 
-        self.add_many(pool_size)
+        # idle brokers with the time they were released at,
+        # the most recently released one is reused first
+        self._brokers = deque()
+        self._checkedout_brokers = set()
+        self._waiters = deque()
+        self._size = 0
+
+        self.created = 0
+        self.discarded = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.peak_in_use = 0
+
+        self.add_many(min_size)
+
+    def create(self):
+        """
+        Returns a new broker connection. The connection itself is
+        only established once it is used.
+        """
+        kwargs = {}
+        if self.backend_cls:
+            kwargs['backend_cls'] = self.backend_cls
+        return BrokerConnection(hostname=self.hostname, port=self.port,
+                                userid=self.username, password=self.password,
+                                virtual_host=self.vhost, **kwargs)
 
     def add_many(self, limit):
-        with self.lock:
-            for _ in range(0, limit):
-                broker = BrokerConnection(hostname=self.hostname, port=self.port,
-                                          userid=self.username, password=self.password,
-                                          virtual_host=self.vhost)
-                self._brokers.append(broker)
+        for _ in range(0, limit):
+            self.add()
 
     def add(self):
-        broker = BrokerConnection(hostname=self.hostname, port=self.port,
-                                  userid=self.username, password=self.password,
-                                  virtual_host=self.vhost)
+        """
+        Adds an idle broker connection to the pool unless
+        it is full already.
+        """
         with self.lock:
-            self._brokers.append(broker)
+            if self._size >= self.max_size:
+                return
+            self._size += 1
+        self._created(self.create())
 
-    def get(self):
-        with self.lock:
-            broker = self._brokers.pop()
-            self._checkedout_brokers.append(broker)
-            return broker
+    def get(self, timeout=None):
+        """
+        Checks a broker connection out of the pool.
+
+        If none is available and the pool is full, waits at most
+        `timeout` seconds (forever if ``None``) for one to be
+        released and raises :exc:`PoolExhausted` otherwise.
+        """
+        started = time.time()
+        waiter = None
+        create = False
+        while 1:
+            broker = self._checkout_idle()
+            if broker is not None:
+                break
+            with self.lock:
+                if self._brokers:
+                    # released while we were checking
+                    continue
+                if self._size < self.max_size:
+                    self._size += 1
+                    create = True
+                elif timeout is not None and timeout <= 0:
+                    self.timeouts += 1
+                    raise PoolExhausted()
+                else:
+                    waiter = _Waiter()
+                    self._waiters.append(waiter)
+                    self.waits += 1
+                break
+
+        if waiter is not None:
+            waiter.event.wait(timeout)
+            with self.lock:
+                if not waiter.event.isSet():
+                    self._waiters.remove(waiter)
+                    self.timeouts += 1
+                    raise PoolExhausted()
+                waited = time.time() - started
+                self.wait_time += waited
+                self.max_wait_time = max(self.max_wait_time, waited)
+            broker = waiter.broker
+            create = waiter.create
+
+        if create:
+            try:
+                broker = self.create()
+            except:
+                with self.lock:
+                    self._size -= 1
+                    self._wake_creator()
+                raise
+            with self.lock:
+                self.created += 1
+                self._checkout(broker)
+
+        return broker
 
     def release(self, broker):
+        """
+        Puts `broker` back into the pool or hands it over
+        to the oldest waiter.
+        """
+        with self.lock:
+            if broker not in self._checkedout_brokers:
+                return
+            self._checkedout_brokers.discard(broker)
+            if self._waiters:
+                waiter = self._waiters.popleft()
+                waiter.broker = broker
+                self._checkout(broker)
+                waiter.event.set()
+            else:
+                self._brokers.append((broker, time.time()))
+
+    def discard(self, broker):
+        """
+        Closes a checked out `broker` which can't be used anymore
+        and frees its room in the pool.
+        """
         with self.lock:
-            self._brokers.append(broker)
-            if broker in self._checkedout_brokers:
-                self._checkedout_brokers.remove(broker)
+            if broker not in self._checkedout_brokers:
+                return
+            self._checkedout_brokers.discard(broker)
+            self._discarded()
+        self._close(broker)
+
+    def evict_idle(self, now=None):
+        """
+        Closes the connections idle for more than `idle_timeout`
+        seconds while keeping at least `min_size` connections.
+        """
+        if now is None:
+            now = time.time()
+        evicted = []
+        with self.lock:
+            expired = now - self.idle_timeout
+            while self._brokers and self._size > self.min_size:
+                broker, released = self._brokers[0]
+                if released > expired:
+                    break
+                self._brokers.popleft()
+                self._discarded()
+                evicted.append(broker)
+
+        for broker in evicted:
+            self._close(broker)
+        return len(evicted)
 
     def release_all(self):
         with self.lock:
-            for broker in self._brokers:
-                broker.close()
-            self._brokers = []
+            brokers = [broker for broker, released in self._brokers]
+            brokers.extend(self._checkedout_brokers)
+            self._brokers.clear()
+            self._checkedout_brokers.clear()
+            self._size = 0
 
-            for broker in self._checkedout_brokers:
-                broker.close()
-            self._checkedout_brokers = []
+        for broker in brokers:
+            self._close(broker)
+
+    def is_healthy(self, broker):
+        """
+        Default health check, a connection is unhealthy when
+        it was closed or lost its transport.
+        """
+        if broker._closed:
+            return False
+        connection = broker._connection
+        if connection is not None and getattr(connection, 'transport', True) is None:
+            return False
+        return True
+
+    def stats(self):
+        """
+        Returns the pool utilisation counters.
+        """
+        with self.lock:
+            return {'size': self._size,
+                    'max_size': self.max_size,
+                    'idle': len(self._brokers),
+                    'in_use': len(self._checkedout_brokers),
+                    'peak_in_use': self.peak_in_use,
+                    'waiting': len(self._waiters),
+                    'created': self.created,
+                    'discarded': self.discarded,
+                    'checkouts': self.checkouts,
+                    'waits': self.waits,
+                    'timeouts': self.timeouts,
+                    'wait_time': self.wait_time,
+                    'max_wait_time': self.max_wait_time}
+
+    def _checkout(self, broker):
+        self._checkedout_brokers.add(broker)
+        self.checkouts += 1
+        self.peak_in_use = max(self.peak_in_use, len(self._checkedout_brokers))
+
+    def _checkout_idle(self):
+        # the health check and the closing of the unhealthy
+        # connections happen outside of the lock
+        while 1:
+            with self.lock:
+                if not self._brokers:
+                    return None
+                broker, released = self._brokers.pop()
+            try:
+                healthy = self.health_check(broker)
+            except Exception:
+                healthy = False
+            with self.lock:
+                if healthy:
+                    self._checkout(broker)
+                    return broker
+                self._discarded()
+            self._close(broker)
+
+    def _created(self, broker):
+        with self.lock:
+            self.created += 1
+            if self._waiters:
+                waiter = self._waiters.popleft()
+                waiter.broker = broker
+                self._checkout(broker)
+                waiter.event.set()
+            else:
+                self._brokers.append((broker, time.time()))
+
+    def _discarded(self):
+        # must be called with the lock held
+        self._size -= 1
+        self.discarded += 1
+        self._wake_creator()
+
+    def _wake_creator(self):
+        # must be called with the lock held, lets the oldest
+        # waiter create a broker in the room that was freed
+        if self._waiters and self._size < self.max_size:
+            waiter = self._waiters.popleft()
+            waiter.create = True
+            self._size += 1
+            waiter.event.set()
+
+    def _close(self, broker):
+        try:
+            broker.close()
+        except Exception:
+            pass
+
+class _ConsumerTracking(object):
+    """
+    Mixed into the backend class of a :class:`BrokerChannel` to keep
+    the consumers declared on its channel so that they can be
+    cancelled while the logical connection is paused and declared
+    again when it resumes.
+    """
+    def __init__(self, *args, **kwargs):
+        super(_ConsumerTracking, self).__init__(*args, **kwargs)
+        self.declared_consumers = {}
+
+    def declare_consumer(self, queue, no_ack, callback, consumer_tag, nowait=False):
+        self.declared_consumers[consumer_tag] = (queue, no_ack, callback)
+        if not self.connection.paused:
+            return super(_ConsumerTracking, self).declare_consumer(
+                queue, no_ack, callback, consumer_tag, nowait=nowait)
+
+    def cancel(self, consumer_tag):
+        if self.declared_consumers.pop(consumer_tag, None) is not None \
+               and self.connection.paused:
+            # cancelled already
+            return
+        return super(_ConsumerTracking, self).cancel(consumer_tag)
+
+    def cancel_consumers(self):
+        for consumer_tag in self.declared_consumers.keys():
+            super(_ConsumerTracking, self).cancel(consumer_tag)
+
+    def redeclare_consumers(self):
+        for consumer_tag, (queue, no_ack, callback) in self.declared_consumers.items():
+            super(_ConsumerTracking, self).declare_consumer(queue, no_ack,
+                                                            callback, consumer_tag)
+
+_tracking_classes = {}
+
+def _tracking(backend_cls):
+    cls = _tracking_classes.get(backend_cls)
+    if cls is None:
+        cls = type(backend_cls.__name__, (_ConsumerTracking, backend_cls), {})
+        _tracking_classes[backend_cls] = cls
+    return cls
+
+class BrokerChannel(object):
+    """
+    Logical broker connection handed out by a :class:`ChannelPool`.
+
+    It is used like a ``carrot.connection.BrokerConnection`` but
+    shares its socket with the other channels of the same
+    connection: the publishers and consumers created with it open
+    their own AMQP channel on that socket and closing it only
+    closes those channels.
+    """
+    def __init__(self, pool, broker):
+        self.pool = pool
+        self.broker = broker
+        self.backends = weakref.WeakKeyDictionary()
+        self.paused = False
+
+    def __getattr__(self, name):
+        return getattr(self.broker, name)
+
+    def create_backend(self):
+        backend = _tracking(self.broker.get_backend_cls())(connection=self)
+        self.backends[backend] = True
+        return backend
+
+    def reopen(self):
+        """
+        Closes the AMQP channels of this logical connection after a
+        channel error. They are opened again the next time they are
+        used while the socket stays up.
+        """
+        for backend in self.backends.keys():
+            backend.declared_consumers.clear()
+            try:
+                backend.close()
+            except Exception:
+                pass
+        self.pool._reopened()
+
+    def pause(self):
+        """
+        Stops the broker from sending messages to the consumers of
+        this logical connection only, by cancelling them until
+        :meth:`resume` declares them again. Messages delivered
+        already still have to be acknowledged.
+
+        ``channel.flow`` isn't used since brokers such as RabbitMQ
+        close the whole connection when a client asks for it.
+        """
+        if self.paused:
+            return
+        self.paused = True
+        for backend in self.backends.keys():
+            backend.cancel_consumers()
+
+    def resume(self):
+        if not self.paused:
+            return
+        self.paused = False
+        for backend in self.backends.keys():
+            backend.redeclare_consumers()
+
+    def close(self):
+        for backend in self.backends.keys():
+            backend.declared_consumers.clear()
+            try:
+                backend.close()
+            except Exception:
+                pass
+        self.backends.clear()
+
+class ChannelPool(object):
+    """
+    Multiplexes logical connections, :class:`BrokerChannel` instances,
+    over the connections of `pool`, a :class:`BrokerPool`.
+
+    A connection is checked out of `pool` when all the ones already
+    used carry `channels_per_connection` logical connections and is
+    given back once its last logical connection is released. When
+    the pool is exhausted, :meth:`get` waits for a logical connection
+    to be released like :meth:`BrokerPool.get` does.
+
+    Discarding a logical connection only closes its channels unless
+    the connection itself is unhealthy, in which case the connection
+    is discarded from `pool` along with all its logical connections.
+    """
+    def __init__(self, pool, channels_per_connection=64):
+        self.lock = threading.Lock()
+        self.pool = pool
+        self.channels_per_connection = channels_per_connection
+
+        # physical broker -> set of its logical connections
+        self._brokers = {}
+        self._waiters = deque()
+
+        self.opened = 0
+        self.reopened = 0
+        self.discarded = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.peak_in_use = 0
+
+    def get(self, timeout=None):
+        """
+        Returns a :class:`BrokerChannel` on the least loaded
+        connection which has room for it.
+        """
+        with self.lock:
+            channel = self._open()
+            if channel is not None:
+                return channel
+            if timeout is not None and timeout <= 0:
+                self.timeouts += 1
+                raise PoolExhausted()
+            waiter = _Waiter()
+            self._waiters.append(waiter)
+            self.waits += 1
+
+        waiter.event.wait(timeout)
+        with self.lock:
+            if not waiter.event.isSet():
+                self._waiters.remove(waiter)
+                self.timeouts += 1
+                raise PoolExhausted()
+        return waiter.broker
+
+    def release(self, channel):
+        """
+        Closes the channels of `channel` and frees its room on its
+        connection for the oldest waiter or another :meth:`get`.
+        """
+        channel.close()
+        with self.lock:
+            channels = self._brokers.get(channel.broker)
+            if channels is None or channel not in channels:
+                return
+            channels.discard(channel)
+            if self._waiters:
+                waiter = self._waiters.popleft()
+                waiter.broker = self._add(channel.broker)
+                waiter.event.set()
+            elif not channels:
+                del self._brokers[channel.broker]
+                self.pool.release(channel.broker)
+
+    def discard(self, channel):
+        """
+        Releases a `channel` which failed, discarding its
+        connection only when it is unhealthy.
+        """
+        try:
+            healthy = self.pool.health_check(channel.broker)
+        except Exception:
+            healthy = False
+        if healthy:
+            self.release(channel)
+            return
+
+        with self.lock:
+            channels = self._brokers.pop(channel.broker, None)
+            if channels is None:
+                return
+            self.discarded += len(channels)
+        for other in channels:
+            other.close()
+        self.pool.discard(channel.broker)
+
+        # the room freed in the pool may serve the waiters
+        with self.lock:
+            while self._waiters:
+                opened = self._open()
+                if opened is None:
+                    break
+                waiter = self._waiters.popleft()
+                waiter.broker = opened
+                waiter.event.set()
+
+    def release_all(self):
+        with self.lock:
+            channels = []
+            for broker, opened in self._brokers.items():
+                channels.extend(opened)
+            self._brokers.clear()
+        for channel in channels:
+            channel.close()
+
+    def stats(self):
+        with self.lock:
+            in_use = sum([len(c) for c in self._brokers.values()])
+            return {'connections': len(self._brokers),
+                    'in_use': in_use,
+                    'peak_in_use': self.peak_in_use,
+                    'channels_per_connection': self.channels_per_connection,
+                    'waiting': len(self._waiters),
+                    'opened': self.opened,
+                    'reopened': self.reopened,
+                    'discarded': self.discarded,
+                    'waits': self.waits,
+                    'timeouts': self.timeouts}
+
+    def _open(self):
+        # must be called with the lock held
+        candidates = [(len(channels), broker) for broker, channels in self._brokers.items()
+                      if len(channels) < self.channels_per_connection]
+        if candidates:
+            return self._add(min(candidates)[1])
+        try:
+            broker = self.pool.get(0)
+        except PoolExhausted:
+            return None
+        self._brokers[broker] = set()
+        return self._add(broker)
+
+    def _add(self, broker):
+        # must be called with the lock held
+        channel = BrokerChannel(self, broker)
+        self._brokers[broker].add(channel)
+        self.opened += 1
+        self.peak_in_use = max(self.peak_in_use,
+                               sum([len(c) for c in self._brokers.values()]))
+        return channel
+
+    def _reopened(self):
+        with self.lock:
+            self.reopened += 1
 
 if __name__ == "__main__":
     from conductor.process import Process
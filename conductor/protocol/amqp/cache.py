@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+import threading
+from collections import OrderedDict
+
+__all__ = ['MessagingCache']
+
+class _Entry(object):
+    def __init__(self, key, value):
+        self.key = key
+        self.value = value
+        self.refs = 0
+
+class MessagingCache(object):
+    """
+    Least recently used cache of carrot publishers or consumers
+    keyed by their broker connection and declaration parameters.
+
+    Every :meth:`get` takes a reference on the returned object which
+    :meth:`release` gives back. Once the cache holds more than `size`
+    objects, the least recently used ones which aren't referenced
+    anymore are closed. `round_trips` is the number of declarations
+    made on the broker when creating an object, which a hit saves.
+    """
+    def __init__(self, factory, size=64, round_trips=1):
+        self.factory = factory
+        self.size = size
+        self.round_trips = round_trips
+        self.lock = threading.Lock()
+
+        self._entries = OrderedDict()
+        self._objects = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.uncacheable = 0
+
+    def get(self, broker, **kwargs):
+        """
+        Returns the object created by ``factory(broker, **kwargs)``,
+        creating it unless it is in the cache already.
+        """
+        try:
+            key = (id(broker), tuple(sorted(kwargs.items())))
+            hash(key)
+        except TypeError:
+            # unhashable declaration parameters
+            with self.lock:
+                self.uncacheable += 1
+            return self.factory(broker, **kwargs)
+
+        with self.lock:
+            entry = self._entries.get(key)
+            if entry is not None and not broker._closed:
+                self._entries[key] = self._entries.pop(key)
+                entry.refs += 1
+                self.hits += 1
+                return entry.value
+            self.misses += 1
+
+        value = self.factory(broker, **kwargs)
+        stale = []
+        with self.lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                del self._objects[id(previous.value)]
+                if not previous.refs:
+                    stale.append(previous.value)
+            entry = _Entry(key, value)
+            entry.refs = 1
+            self._entries[key] = entry
+            self._objects[id(value)] = entry
+            stale.extend(self._evict())
+
+        self._close(stale)
+        return value
+
+    def release(self, value):
+        """
+        Gives back a reference taken by :meth:`get`. Objects which
+        were never cached are closed straight away.
+        """
+        with self.lock:
+            entry = self._objects.get(id(value))
+            if entry is not None and entry.value is value:
+                entry.refs = max(0, entry.refs - 1)
+                stale = self._evict()
+            else:
+                stale = [value]
+        self._close(stale)
+
+    def clear(self):
+        """
+        Closes all the cached objects.
+        """
+        with self.lock:
+            stale = [entry.value for entry in self._entries.values()]
+            self._entries.clear()
+            self._objects.clear()
+        self._close(stale)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self._entries),
+                    'in_use': len([e for e in self._entries.values() if e.refs]),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': lookups and float(self.hits) / lookups or 0.0,
+                    'evictions': self.evictions,
+                    'uncacheable': self.uncacheable,
+                    'round_trips_saved': self.hits * self.round_trips}
+
+    def _evict(self):
+        # must be called with the lock held
+        stale = []
+        excess = len(self._entries) - self.size
+        if excess > 0:
+            for key, entry in self._entries.items():
+                if not entry.refs:
+                    del self._entries[key]
+                    del self._objects[id(entry.value)]
+                    stale.append(entry.value)
+                    self.evictions += 1
+                    excess -= 1
+                    if not excess:
+                        break
+        return stale
+
+    def _close(self, values):
+        for value in values:
+            try:
+                value.close()
+            except Exception:
+                pass
@@ -1,12 +1,158 @@
 # -*- coding: utf-8 -*-
+import socket
+import threading
+from collections import deque
+
 from carrot.messaging import Consumer
 from conductor.task import Task
+from conductor.protocol.amqp.cache import MessagingCache
+
+__all__ = ["ConsumerTask", "PushConsumer"]
+
+class PushConsumer(threading.Thread):
+    """
+    Consumes messages from a queue in its own thread and hands
+    them over to the bus thread in batches.
+
+    The thread owns its `broker` connection: it declares the consumer
+    (`kwargs` are passed to ``carrot.messaging.Consumer``) with a
+    prefetch window of `prefetch_count` messages and waits for
+    deliveries. Received messages are queued and the bus woken
+    up, :meth:`deliver` then publishes them to `channel` by lists of
+    at most `batch_size` messages from the bus thread. Messages
+    are acknowledged, still by the consumer thread, once the
+    listeners returned. When a listener fails, the batch is
+    requeued if `requeue_on_error` is set and rejected otherwise.
+
+    The prefetch window bounds the number of messages
+    held by the process.
+    """
+    def __init__(self, bus, broker, channel, prefetch_count=100,
+                 batch_size=100, **kwargs):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.bus = bus
+        self.broker = broker
+        self.channel = channel
+        self.prefetch_count = prefetch_count
+        self.batch_size = batch_size
+        self.requeue_on_error = True
+        self.poll_timeout = 0.01
+        self.kwargs = kwargs
+
+        self.lock = threading.Lock()
+        self.inbox = deque()
+        self.acks = deque()
+        self.received = 0
+        self.delivered = 0
+        self.failed = 0
+
+        self._stopping = threading.Event()
+
+    def run(self):
+        consumer = Consumer(self.broker, **self.kwargs)
+        try:
+            consumer.qos(prefetch_count=self.prefetch_count)
+            consumer.register_callback(self._received)
+            consumer.consume()
+            connection = self.broker.connection
+            while not self._stopping.isSet():
+                self._settle()
+                try:
+                    connection.drain_events(timeout=self.poll_timeout)
+                except socket.timeout:
+                    pass
+            self._drain()
+            self._settle()
+        except:
+            self.bus.log("AMQP push consumer on %r failed" % (self.channel,),
+                         level=40, traceback=True)
+        finally:
+            try:
+                consumer.close()
+            except Exception:
+                pass
+
+    def stop(self, timeout=None):
+        """
+        Stops consuming and waits at most `timeout` seconds for the
+        thread to finish. Messages which weren't delivered yet are
+        left unacknowledged so that the broker redelivers them.
+        """
+        self._stopping.set()
+        self.join(timeout)
+
+    def deliver(self):
+        """
+        Publishes the received messages to the bus and returns
+        whether there were any. Must be called from the bus thread,
+        see :class:`ConsumerTask`.
+        """
+        delivered = bool(self.inbox)
+        while self.inbox:
+            with self.lock:
+                count = min(self.batch_size, len(self.inbox))
+                batch = [self.inbox.popleft() for _ in range(count)]
+
+            try:
+                self.bus.publish(self.channel, batch)
+                self.acks.append((batch, 'ack'))
+                self.delivered += len(batch)
+            except:
+                self.failed += len(batch)
+                self.bus.log("Couldn't process AMQP messages from %r" % (self.channel,),
+                             level=40, traceback=True)
+                self.acks.append((batch, self.requeue_on_error and 'requeue' or 'reject'))
+        return delivered
+
+    def stats(self):
+        return {'received': self.received,
+                'delivered': self.delivered,
+                'failed': self.failed,
+                'queued': len(self.inbox),
+                'unacked': sum([len(batch) for batch, action in list(self.acks)])}
 
-__all__ = ["ConsumerTask"]
+    def _received(self, message_data, message):
+        with self.lock:
+            self.inbox.append(message)
+            self.received += 1
+            if len(self.inbox) > 1:
+                # the bus was woken up already
+                return
+        wakeup = getattr(self.bus, 'wakeup', None)
+        if wakeup:
+            wakeup()
+
+    def _drain(self):
+        # called by the consumer thread once it stopped consuming
+        pass
+
+    def _settle(self):
+        while self.acks:
+            batch, action = self.acks.popleft()
+            for message in batch:
+                getattr(message, action)()
 
 class ConsumerTask(Task):
+    """
+    Provides carrot consumers on the ``"get-amqp-consumer"`` channel.
+
+    When `cache_size` is set, consumers are cached per broker
+    connection and parameters (see :class:`conductor.protocol.amqp.publisher.PublisherTask`)
+    and should be given back to ``"release-amqp-consumer"``.
+
+    ``"get-amqp-push-consumer"`` starts a :class:`PushConsumer`
+    delivering messages to a bus channel. It is stopped by
+    ``"release-amqp-push-consumer"`` or when the task stops.
+    ``"get-amqp-worker-consumer"`` starts a
+    :class:`conductor.protocol.amqp.workers.WorkerPoolConsumer`
+    which is released the same way.
+    """
     def __init__(self, bus=None):
         Task.__init__(self, bus)
+        self.cache_size = 0
+        self.cache = None
+        self.push_consumers = []
 
     def start(self):
         Task.start(self)
@@ -18,11 +164,92 @@ class ConsumerTask(Task):
     
     def start_task(self):
         self.bus.log("Starting AMQP consumer provider task")
+        if self.cache_size:
+            # exchange, queue and binding declarations
+            self.cache = MessagingCache(Consumer, self.cache_size, round_trips=3)
         self.bus.subscribe("get-amqp-consumer", self.get_consumer)
-        
+        self.bus.subscribe("release-amqp-consumer", self.release_consumer)
+        self.bus.subscribe("get-amqp-consumer-stats", self.stats)
+        self.bus.subscribe("get-amqp-push-consumer", self.get_push_consumer)
+        self.bus.subscribe("release-amqp-push-consumer", self.release_push_consumer)
+        self.bus.subscribe("get-amqp-worker-consumer", self.get_worker_consumer)
+    start_task.priority = 12
+
     def stop_task(self):
         self.bus.log("Stopping AMQP consumer provider task")
         self.bus.unsubscribe("get-amqp-consumer", self.get_consumer)
+        self.bus.unsubscribe("release-amqp-consumer", self.release_consumer)
+        self.bus.unsubscribe("get-amqp-consumer-stats", self.stats)
+        self.bus.unsubscribe("get-amqp-push-consumer", self.get_push_consumer)
+        self.bus.unsubscribe("release-amqp-push-consumer", self.release_push_consumer)
+        self.bus.unsubscribe("get-amqp-worker-consumer", self.get_worker_consumer)
+        for consumer in self.push_consumers[:]:
+            self.release_push_consumer(consumer)
+        if self.cache:
+            self.cache.clear()
+            self.cache = None
+    stop_task.priority = 88
         
     def get_consumer(self, broker, **kwargs):
+        if self.cache:
+            return self.cache.get(broker, **kwargs)
         return Consumer(broker, **kwargs)
+
+    def release_consumer(self, consumer):
+        if self.cache:
+            self.cache.release(consumer)
+        else:
+            consumer.close()
+
+    def get_push_consumer(self, broker, channel, prefetch_count=100,
+                          batch_size=100, **kwargs):
+        consumer = PushConsumer(self.bus, broker, channel, prefetch_count,
+                                batch_size, **kwargs)
+        if not self.push_consumers:
+            self.bus.subscribe("main", self.deliver)
+        self.push_consumers.append(consumer)
+        consumer.start()
+        return consumer
+
+    def get_worker_consumer(self, broker, handler, workers=4, mode='thread',
+                            key=None, prefetch_count=100, **kwargs):
+        from conductor.protocol.amqp.workers import WorkerPoolConsumer
+        consumer = WorkerPoolConsumer(self.bus, broker, handler, workers, mode,
+                                      key, prefetch_count, **kwargs)
+        if not self.push_consumers:
+            self.bus.subscribe("main", self.deliver)
+        self.push_consumers.append(consumer)
+        consumer.start()
+        return consumer
+
+    def release_push_consumer(self, consumer, timeout=5.0):
+        """
+        Stops `consumer` and waits for its thread for `timeout`
+        seconds, plus the time a worker pool consumer may spend
+        draining its workers. Returns whether the thread exited,
+        a consumer still running stays registered so that its
+        connection isn't released while it settles messages.
+        """
+        if consumer not in self.push_consumers:
+            return True
+        timeout += getattr(consumer, 'drain_timeout', 0) + consumer.poll_timeout
+        consumer.stop(timeout)
+        if consumer.isAlive():
+            self.bus.log("AMQP push consumer on %r still running after %.1fs" % \
+                         (consumer.channel, timeout), level=30)
+            return False
+        self.push_consumers.remove(consumer)
+        if not self.push_consumers:
+            self.bus.unsubscribe("main", self.deliver)
+        return True
+
+    def deliver(self):
+        delivered = False
+        for consumer in self.push_consumers:
+            if consumer.inbox:
+                delivered = consumer.deliver() or delivered
+        return delivered
+
+    def stats(self):
+        if self.cache:
+            return self.cache.stats()
@@ -0,0 +1,474 @@
+# -*- coding: utf-8 -*-
+import itertools
+import socket
+import threading
+import time
+from collections import deque
+
+from carrot.backends.base import BaseBackend, BaseMessage
+
+__all__ = ['MemoryBroker', 'MemoryBackend', 'get_memory_broker']
+
+_brokers = {}
+_brokers_lock = threading.Lock()
+
+def get_memory_broker(virtual_host='/'):
+    """
+    Returns the in-process broker of `virtual_host`,
+    creating it if needed.
+    """
+    with _brokers_lock:
+        broker = _brokers.get(virtual_host)
+        if broker is None:
+            broker = _brokers[virtual_host] = MemoryBroker()
+        return broker
+
+def _topic_matches(pattern, words):
+    if not pattern:
+        return not words
+    if pattern[0] == '#':
+        for i in range(len(words) + 1):
+            if _topic_matches(pattern[1:], words[i:]):
+                return True
+        return False
+    if not words:
+        return False
+    return pattern[0] in ('*', words[0]) and _topic_matches(pattern[1:], words[1:])
+
+class _Message(object):
+    def __init__(self, body, content_type=None, content_encoding=None,
+                 priority=None, delivery_mode=None):
+        self.body = body
+        self.content_type = content_type
+        self.content_encoding = content_encoding
+        self.priority = priority
+        self.delivery_mode = delivery_mode
+        self.headers = None
+        self.exchange = None
+        self.routing_key = None
+        self.redelivered = False
+
+class MemoryBroker(object):
+    """
+    In-process stand-in for an AMQP broker supporting the subset
+    of AMQP used by the AMQP tasks: direct, fanout and topic
+    exchanges, the default exchange, queues and bindings, basic
+    get, consume with a prefetch window and acknowledgements.
+
+    Each synchronous operation (declarations, get, transaction
+    commits...) takes `latency` seconds to mimic the round-trip to
+    a remote broker while publishes don't wait.
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.latency = 0.0
+        self.exchanges = {'': 'direct'}
+        self.bindings = {}
+        self.queues = {}
+
+        self.published = 0
+        self.delivered = 0
+        self.acked = 0
+        self.unroutable = 0
+
+    def round_trip(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def declare_queue(self, queue):
+        with self.condition:
+            self.queues.setdefault(queue, deque())
+
+    def delete_queue(self, queue):
+        with self.condition:
+            self.queues.pop(queue, None)
+            for bindings in self.bindings.values():
+                bindings[:] = [b for b in bindings if b[1] != queue]
+
+    def purge_queue(self, queue):
+        with self.condition:
+            messages = self.queues.get(queue)
+            if messages is None:
+                return 0
+            count = len(messages)
+            messages.clear()
+            return count
+
+    def declare_exchange(self, exchange, type='direct'):
+        with self.condition:
+            self.exchanges.setdefault(exchange, type)
+
+    def bind(self, queue, exchange, routing_key):
+        pattern = None
+        if self.exchanges.get(exchange) == 'topic':
+            pattern = routing_key.split('.')
+        with self.condition:
+            bindings = self.bindings.setdefault(exchange, [])
+            binding = (routing_key, queue, pattern)
+            if binding[:2] not in [b[:2] for b in bindings]:
+                bindings.append(binding)
+
+    def route(self, message, exchange, routing_key):
+        """
+        Puts `message` on the queues bound to `exchange`
+        with a matching `routing_key`.
+        """
+        with self.condition:
+            self.published += 1
+            if exchange:
+                type = self.exchanges.get(exchange, 'direct')
+                queues = []
+                for key, queue, pattern in self.bindings.get(exchange, ()):
+                    if type == 'fanout' or \
+                       (pattern is not None and _topic_matches(pattern, routing_key.split('.'))) or \
+                       (pattern is None and key == routing_key):
+                        if queue not in queues:
+                            queues.append(queue)
+            else:
+                queues = [routing_key]
+
+            routed = False
+            for queue in queues:
+                messages = self.queues.get(queue)
+                if messages is not None:
+                    messages.append(message)
+                    routed = True
+            if not routed:
+                self.unroutable += 1
+            else:
+                self.condition.notifyAll()
+
+    def get(self, queue):
+        with self.condition:
+            messages = self.queues.get(queue)
+            if messages:
+                self.delivered += 1
+                return messages.popleft()
+
+    def requeue(self, queue, message):
+        message.redelivered = True
+        with self.condition:
+            messages = self.queues.get(queue)
+            if messages is not None:
+                messages.appendleft(message)
+                self.condition.notifyAll()
+
+    def stats(self):
+        with self.condition:
+            return {'published': self.published,
+                    'delivered': self.delivered,
+                    'acked': self.acked,
+                    'unroutable': self.unroutable,
+                    'queued': dict([(name, len(messages)) for name, messages
+                                    in self.queues.items()])}
+
+class MemoryChannel(object):
+    """
+    Channel of a :class:`MemoryConnection` holding its consumers,
+    prefetch window and unacknowledged messages.
+    """
+    def __init__(self, connection, channel_id):
+        self.connection = connection
+        self.broker = connection.broker
+        self.channel_id = channel_id
+        self.is_open = True
+        self.prefetch_count = 0
+        self.consumers = {}
+        self.unacked = {}
+        self._tags = itertools.count(1)
+        self._transaction = None
+
+    def next_tag(self):
+        return self._tags.next()
+
+    def can_deliver(self):
+        return self.is_open and \
+            (not self.prefetch_count or len(self.unacked) < self.prefetch_count)
+
+    def ack(self, delivery_tag):
+        if self.unacked.pop(delivery_tag, None) is not None:
+            with self.broker.condition:
+                self.broker.acked += 1
+                self.broker.condition.notifyAll()
+
+    def reject(self, delivery_tag, requeue):
+        entry = self.unacked.pop(delivery_tag, None)
+        if entry is None:
+            return
+        if requeue:
+            self.broker.requeue(*entry)
+        else:
+            with self.broker.condition:
+                self.broker.condition.notifyAll()
+
+    def publish(self, message, exchange, routing_key):
+        if self._transaction is not None:
+            self._transaction.append((message, exchange, routing_key))
+        else:
+            self.broker.route(message, exchange, routing_key)
+
+    def tx_select(self):
+        self.broker.round_trip()
+        if self._transaction is None:
+            self._transaction = []
+
+    def tx_commit(self):
+        self.broker.round_trip()
+        transaction, self._transaction = self._transaction or [], []
+        for message, exchange, routing_key in transaction:
+            self.broker.route(message, exchange, routing_key)
+
+    def tx_rollback(self):
+        self.broker.round_trip()
+        self._transaction = []
+
+    def close(self):
+        if not self.is_open:
+            return
+        self.is_open = False
+        self.consumers.clear()
+        unacked, self.unacked = self.unacked, {}
+        for delivery_tag in sorted(unacked):
+            self.broker.requeue(*unacked[delivery_tag])
+        self.connection.channels.pop(self.channel_id, None)
+
+class MemoryConnection(object):
+    """
+    Connection to a :class:`MemoryBroker` on which consumers
+    receive their messages through :meth:`drain_events`.
+    """
+    def __init__(self, broker):
+        self.broker = broker
+        self.channels = {}
+        self.transport = True
+        self._ids = itertools.count(1)
+        self._turn = 0
+
+    def channel(self):
+        channel = MemoryChannel(self, self._ids.next())
+        self.channels[channel.channel_id] = channel
+        return channel
+
+    def drain_events(self, timeout=None):
+        """
+        Delivers a message to one of the consumers, waiting at most
+        `timeout` seconds for one and raising ``socket.timeout``
+        otherwise like amqplib does.
+        """
+        deadline = timeout is not None and time.time() + timeout or None
+        broker = self.broker
+        with broker.condition:
+            while 1:
+                delivery = self._next_delivery()
+                if delivery is not None:
+                    break
+                if deadline is None:
+                    broker.condition.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise socket.timeout()
+                broker.condition.wait(remaining)
+
+        channel, delivery_tag, queue, message, callback, consumer_tag = delivery
+        callback((message, channel, delivery_tag, queue, consumer_tag))
+
+    def close(self):
+        for channel in self.channels.values():
+            channel.close()
+        self.transport = None
+
+    def _next_delivery(self):
+        # must be called with the broker condition held, consumers
+        # are served in turn so that none of them starves the others
+        candidates = []
+        for channel in self.channels.values():
+            if channel.can_deliver():
+                for consumer_tag, (queue, no_ack, callback) in channel.consumers.items():
+                    candidates.append((channel, consumer_tag, queue, no_ack, callback))
+        if not candidates:
+            return None
+
+        self._turn += 1
+        count = len(candidates)
+        for i in range(count):
+            channel, consumer_tag, queue, no_ack, callback = candidates[(self._turn + i) % count]
+            messages = self.broker.queues.get(queue)
+            if messages:
+                message = messages.popleft()
+                self.broker.delivered += 1
+                delivery_tag = channel.next_tag()
+                if not no_ack:
+                    channel.unacked[delivery_tag] = (queue, message)
+                return channel, delivery_tag, queue, message, callback, consumer_tag
+
+class MemoryMessage(BaseMessage):
+    """
+    Message received from a :class:`MemoryBroker`.
+    """
+    def __init__(self, backend, raw_message, **kwargs):
+        message, channel, delivery_tag, queue, consumer_tag = raw_message
+        self.channel = channel
+        kwargs.update({'body': message.body,
+                       'delivery_tag': delivery_tag,
+                       'content_type': message.content_type,
+                       'content_encoding': message.content_encoding,
+                       'delivery_info': {'exchange': message.exchange,
+                                         'routing_key': message.routing_key,
+                                         'consumer_tag': consumer_tag,
+                                         'redelivered': message.redelivered,
+                                         'queue': queue}})
+        BaseMessage.__init__(self, backend, **kwargs)
+
+    def ack(self):
+        # acknowledged on the channel the message was received on
+        if self.acknowledged:
+            raise self.MessageStateError(
+                "Message already acknowledged with state: %s" % self._state)
+        self.channel.ack(self.delivery_tag)
+        self._state = "ACK"
+
+    def reject(self):
+        if self.acknowledged:
+            raise self.MessageStateError(
+                "Message already acknowledged with state: %s" % self._state)
+        self.channel.reject(self.delivery_tag, False)
+        self._state = "REJECTED"
+
+    def requeue(self):
+        if self.acknowledged:
+            raise self.MessageStateError(
+                "Message already acknowledged with state: %s" % self._state)
+        self.channel.reject(self.delivery_tag, True)
+        self._state = "REQUEUED"
+
+class MemoryBackend(BaseBackend):
+    """
+    carrot backend talking to the :class:`MemoryBroker` of the
+    connection's virtual host so that publishers and consumers can
+    be used without an AMQP broker, in tests or benchmarks:
+
+    .. code-block :: python
+
+        broker_task.settings.backend_cls = "conductor.protocol.amqp.memory.MemoryBackend"
+    """
+    Message = MemoryMessage
+    default_port = 5672
+
+    def __init__(self, connection, **kwargs):
+        BaseBackend.__init__(self, connection, **kwargs)
+        self._channel = None
+
+    @property
+    def channel(self):
+        if self._channel is None or not self._channel.is_open:
+            self._channel = self.connection.connection.channel()
+        return self._channel
+
+    @property
+    def broker(self):
+        return get_memory_broker(getattr(self.connection, 'virtual_host', '/'))
+
+    def establish_connection(self):
+        broker = self.broker
+        broker.round_trip()
+        return MemoryConnection(broker)
+
+    def close_connection(self, connection):
+        connection.close()
+
+    def queue_exists(self, queue):
+        self.broker.round_trip()
+        return queue in self.broker.queues
+
+    def queue_declare(self, queue, durable=True, exclusive=False,
+                      auto_delete=False, warn_if_exists=False, arguments=None):
+        self.broker.round_trip()
+        self.broker.declare_queue(queue)
+
+    def queue_delete(self, queue, if_unused=False, if_empty=False):
+        self.broker.round_trip()
+        self.broker.delete_queue(queue)
+
+    def queue_purge(self, queue, **kwargs):
+        self.broker.round_trip()
+        return self.broker.purge_queue(queue)
+
+    def exchange_declare(self, exchange, type, durable, auto_delete):
+        self.broker.round_trip()
+        self.broker.declare_exchange(exchange, type)
+
+    def queue_bind(self, queue, exchange, routing_key, arguments=None):
+        self.broker.round_trip()
+        self.broker.bind(queue, exchange, routing_key)
+
+    def message_to_python(self, raw_message):
+        return self.Message(backend=self, raw_message=raw_message)
+
+    def get(self, queue, no_ack=False):
+        broker = self.broker
+        broker.round_trip()
+        message = broker.get(queue)
+        if message is None:
+            return None
+        channel = self.channel
+        delivery_tag = channel.next_tag()
+        if not no_ack:
+            channel.unacked[delivery_tag] = (queue, message)
+        return self.message_to_python((message, channel, delivery_tag, queue, None))
+
+    def declare_consumer(self, queue, no_ack, callback, consumer_tag, nowait=False):
+        if not nowait:
+            self.broker.round_trip()
+        channel = self.channel
+        with self.broker.condition:
+            channel.consumers[consumer_tag] = (queue, no_ack, callback)
+            self.broker.condition.notifyAll()
+
+    def consume(self, limit=None):
+        for total_message_count in itertools.count():
+            if limit and total_message_count >= limit:
+                raise StopIteration
+            if not self.channel.is_open:
+                raise StopIteration
+            self.connection.connection.drain_events()
+            yield True
+
+    def cancel(self, consumer_tag):
+        if self._channel is not None:
+            with self.broker.condition:
+                self._channel.consumers.pop(consumer_tag, None)
+
+    def close(self):
+        if self._channel is not None:
+            with self.broker.condition:
+                self._channel.close()
+        self._channel = None
+
+    def ack(self, delivery_tag):
+        self.channel.ack(delivery_tag)
+
+    def reject(self, delivery_tag):
+        self.channel.reject(delivery_tag, False)
+
+    def requeue(self, delivery_tag):
+        self.channel.reject(delivery_tag, True)
+
+    def prepare_message(self, message_data, delivery_mode, priority=None,
+                        content_type=None, content_encoding=None):
+        return _Message(message_data, content_type, content_encoding,
+                        priority, delivery_mode)
+
+    def publish(self, message, exchange, routing_key, mandatory=None,
+                immediate=None, headers=None):
+        message.headers = headers
+        message.exchange = exchange
+        message.routing_key = routing_key
+        self.channel.publish(message, exchange, routing_key)
+
+    def qos(self, prefetch_size, prefetch_count, apply_global=False):
+        self.broker.round_trip()
+        channel = self.channel
+        with self.broker.condition:
+            channel.prefetch_count = prefetch_count
+
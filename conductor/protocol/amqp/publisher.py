@@ -1,22 +1,280 @@
 # -*- coding: utf-8 -*-
+import os.path
+import threading
+import time
+from collections import deque
+
+from carrot.connection import BrokerConnection
 from carrot.messaging import Publisher
 from conductor.task import Task
+from conductor.protocol.amqp.cache import MessagingCache
+
+__all__ = ["PublisherTask", "BatchPublisher"]
+
+class BatchPublisher(object):
+    """
+    Buffers the messages sent through a carrot `publisher` and sends
+    them in batches, once `max_batch` messages are buffered or the
+    oldest one is `max_age` seconds old, or on :meth:`flush`.
+
+    With `confirm` set, the channel is put in transactional mode and
+    each batch is committed at once so that a single round-trip
+    confirms the whole batch. A failed batch is put back in front
+    of the buffer and sent again on the next flush.
+
+    At most `max_buffer` messages are buffered: :meth:`send` flushes
+    the buffer itself when it is full so that producers are slowed
+    down to the rate at which the broker takes the messages.
+    """
+    def __init__(self, publisher, max_batch=100, max_age=0.05,
+                 max_buffer=10000, confirm=False):
+        self.publisher = publisher
+        self.max_batch = max_batch
+        self.max_age = max_age
+        self.max_buffer = max_buffer
+        self.confirm = confirm
+
+        self.lock = threading.RLock()
+        self._buffer = deque()
+        self._transactional = False
+
+        self.sent = 0
+        self.batches = 0
+        self.failures = 0
+        self.forced_flushes = 0
+        self.flush_time = 0.0
+
+    def send(self, message_data, **kwargs):
+        """
+        Buffers a message, takes the same parameters as
+        ``carrot.messaging.Publisher.send``.
+        """
+        with self.lock:
+            if len(self._buffer) >= self.max_buffer:
+                self.forced_flushes += 1
+                self.flush()
+            self._buffer.append((time.time(), message_data, kwargs))
+
+    def due(self, now=None):
+        """
+        Tells if a batch should be sent.
+        """
+        buffer = self._buffer
+        if not buffer:
+            return False
+        if len(buffer) >= self.max_batch:
+            return True
+        if now is None:
+            now = time.time()
+        return now - buffer[0][0] >= self.max_age
+
+    def flush(self):
+        """
+        Sends all the buffered messages, `max_batch` at a time.
+        """
+        with self.lock:
+            while self._buffer:
+                self._send_batch()
+
+    def flush_due(self):
+        """
+        Sends the batches which are due and returns
+        whether there were any.
+        """
+        sent = False
+        with self.lock:
+            while self.due():
+                self._send_batch()
+                sent = True
+        return sent
+
+    def close(self):
+        self.flush()
+
+    def stats(self):
+        with self.lock:
+            return {'buffered': len(self._buffer),
+                    'sent': self.sent,
+                    'batches': self.batches,
+                    'failures': self.failures,
+                    'forced_flushes': self.forced_flushes,
+                    'flush_time': self.flush_time}
 
-__all__ = ["PublisherTask"]
+    def _send_batch(self):
+        buffer = self._buffer
+        batch = [buffer.popleft() for _ in range(min(self.max_batch, len(buffer)))]
+        started = time.time()
+        channel = None
+        sent = 0
+        try:
+            if self.confirm:
+                channel = self.publisher.backend.channel
+                if not self._transactional:
+                    channel.tx_select()
+                    self._transactional = True
+            for queued, message_data, kwargs in batch:
+                self.publisher.send(message_data, **kwargs)
+                sent += 1
+            if channel is not None:
+                channel.tx_commit()
+        except:
+            self.failures += 1
+            if channel is not None:
+                # nothing of the batch was committed
+                sent = 0
+                try:
+                    channel.tx_rollback()
+                except Exception:
+                    self._transactional = False
+            elif self.confirm:
+                self._transactional = False
+            self.sent += sent
+            buffer.extendleft(reversed(batch[sent:]))
+            raise
+
+        self.sent += len(batch)
+        self.batches += 1
+        self.flush_time += time.time() - started
+
+def _connect_like(broker):
+    # a new connection with the settings of `broker`,
+    # a logical connection passes those of its socket
+    return BrokerConnection(hostname=broker.hostname, userid=broker.userid,
+                            password=broker.password, virtual_host=broker.virtual_host,
+                            port=broker.port, insist=broker.insist,
+                            connect_timeout=broker.connect_timeout, ssl=broker.ssl,
+                            backend_cls=broker.backend_cls)
 
 class PublisherTask(Task):
+    """
+    Provides carrot publishers on the ``"get-amqp-publisher"`` channel.
+
+    When `cache_size` is set, publishers are cached per broker
+    connection and parameters so that asking for the same publisher
+    again doesn't declare its exchange once more. Publishers should
+    then be given back to ``"release-amqp-publisher"`` rather than
+    closed.
+
+    ``"get-amqp-spooling-publisher"`` returns a
+    :class:`conductor.protocol.amqp.spool.SpoolingPublisher` spooling
+    to the `name` subdirectory of `spool_directory`, which must be
+    set, and publishing over a connection of its own opened with the
+    settings of the given broker. It is stopped
+    by ``"release-amqp-spooling-publisher"`` or when the task stops,
+    waiting at most `spool_stop_timeout` seconds for its drainer.
+    ``"get-amqp-spool-stats"`` returns the stats of the spools by name.
+    """
     def __init__(self, bus=None):
         Task.__init__(self, bus)
+        self.cache_size = 0
+        self.cache = None
+        self.batchers = []
+        self.spool_directory = None
+        self.spool_stop_timeout = 5.0
+        self.spoolers = {}
 
     def start_task(self):
         self.bus.log("Starting AMQP publisher provider task")
+        if self.cache_size:
+            self.cache = MessagingCache(Publisher, self.cache_size, round_trips=1)
         self.bus.subscribe("get-amqp-publisher", self.get_publisher)
+        self.bus.subscribe("release-amqp-publisher", self.release_publisher)
+        self.bus.subscribe("get-amqp-publisher-stats", self.stats)
+        self.bus.subscribe("get-amqp-batch-publisher", self.get_batch_publisher)
+        self.bus.subscribe("release-amqp-batch-publisher", self.release_batch_publisher)
+        self.bus.subscribe("get-amqp-spooling-publisher", self.get_spooling_publisher)
+        self.bus.subscribe("release-amqp-spooling-publisher", self.release_spooling_publisher)
+        self.bus.subscribe("get-amqp-spool-stats", self.spool_stats)
     start_task.priority = 11
         
     def stop_task(self):
         self.bus.log("Stopping AMQP publisher provider task")
         self.bus.unsubscribe("get-amqp-publisher", self.get_publisher)
+        self.bus.unsubscribe("release-amqp-publisher", self.release_publisher)
+        self.bus.unsubscribe("get-amqp-publisher-stats", self.stats)
+        self.bus.unsubscribe("get-amqp-batch-publisher", self.get_batch_publisher)
+        self.bus.unsubscribe("release-amqp-batch-publisher", self.release_batch_publisher)
+        self.bus.unsubscribe("get-amqp-spooling-publisher", self.get_spooling_publisher)
+        self.bus.unsubscribe("release-amqp-spooling-publisher", self.release_spooling_publisher)
+        self.bus.unsubscribe("get-amqp-spool-stats", self.spool_stats)
+        for batcher in self.batchers[:]:
+            self.release_batch_publisher(batcher)
+        for spooler in self.spoolers.values():
+            self.release_spooling_publisher(spooler)
+        if self.cache:
+            self.cache.clear()
+            self.cache = None
         
     def get_publisher(self, broker, **kwargs):
+        if self.cache:
+            return self.cache.get(broker, **kwargs)
         return Publisher(broker, **kwargs)
     stop_task.priority = 89
+
+    def release_publisher(self, publisher):
+        if self.cache:
+            self.cache.release(publisher)
+        else:
+            publisher.close()
+
+    def get_batch_publisher(self, broker, max_batch=100, max_age=0.05,
+                            max_buffer=10000, confirm=False, **kwargs):
+        # never a cached publisher: other tasks sending through it
+        # would end up in the transactions of the batches
+        batcher = BatchPublisher(Publisher(broker, **kwargs),
+                                 max_batch=max_batch, max_age=max_age,
+                                 max_buffer=max_buffer, confirm=confirm)
+        if not self.batchers:
+            self.bus.subscribe("main", self.flush_batches)
+        self.batchers.append(batcher)
+        return batcher
+
+    def release_batch_publisher(self, batcher):
+        if batcher not in self.batchers:
+            return
+        self.batchers.remove(batcher)
+        if not self.batchers:
+            self.bus.unsubscribe("main", self.flush_batches)
+        try:
+            batcher.flush()
+        except:
+            self.bus.log("Couldn't flush AMQP batch publisher", level=40, traceback=True)
+        batcher.publisher.close()
+
+    def get_spooling_publisher(self, broker, name, max_memory=1000, **kwargs):
+        from conductor.protocol.amqp.spool import SpoolingPublisher
+        if not self.spool_directory:
+            raise ValueError("No spool_directory set for the AMQP spools")
+        if name in self.spoolers:
+            raise ValueError("AMQP spool %r is in use already" % name)
+        # created by the drainer thread, the exchange declaration
+        # would block the bus otherwise
+        factory = lambda: Publisher(_connect_like(broker), **kwargs)
+        spooler = SpoolingPublisher(factory, os.path.join(self.spool_directory, name),
+                                    max_memory=max_memory)
+        spooler.name = name
+        self.spoolers[name] = spooler
+        spooler.start()
+        return spooler
+
+    def release_spooling_publisher(self, spooler):
+        if self.spoolers.get(spooler.name) is not spooler:
+            return
+        del self.spoolers[spooler.name]
+        spooler.stop(self.spool_stop_timeout)
+
+    def spool_stats(self):
+        return dict([(name, spooler.stats()) for name, spooler in self.spoolers.items()])
+
+    def flush_batches(self):
+        flushed = False
+        for batcher in self.batchers:
+            try:
+                flushed = batcher.flush_due() or flushed
+            except:
+                self.bus.log("Couldn't flush AMQP batch publisher", level=40, traceback=True)
+        return flushed
+
+    def stats(self):
+        if self.cache:
+            return self.cache.stats()
@@ -0,0 +1,440 @@
+# -*- coding: utf-8 -*-
+import os
+import os.path
+import struct
+import threading
+import time
+from collections import deque
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+__all__ = ['SpoolLog', 'SpoolingPublisher']
+
+_header = struct.Struct('>I')
+
+class SpoolLog(object):
+    """
+    Segmented append-only log of records stored in `directory`.
+
+    Records are appended to the last segment file until it grows
+    beyond `segment_size` bytes, a new segment is then started.
+    They are read back in order by :meth:`read` and the position
+    of the reader is only saved, and the segments it went through
+    deleted, on :meth:`commit`. Records which weren't committed are
+    read again when the log is opened once more.
+
+    With `fsync` set, every append is synced to disk.
+    """
+    def __init__(self, directory, segment_size=16 * 1024 * 1024, fsync=False):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.lock = threading.Lock()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self._segments = sorted([int(name[:-4]) for name in os.listdir(directory)
+                                 if name.endswith('.log')])
+        self._writer = None
+        self._written = 0
+        # committed position and the one reached by read()
+        self._cursor = self._load_cursor()
+        self._position = self._cursor
+        self._reader = None
+        self._pending = 0
+
+        self.appended = 0
+        self.committed = 0
+        self.depth = self._count()
+
+    def append(self, record):
+        data = pickle.dumps(record, 2)
+        with self.lock:
+            if self._writer is None or self._written >= self.segment_size:
+                self._rotate()
+            self._writer.write(_header.pack(len(data)) + data)
+            self._writer.flush()
+            if self.fsync:
+                os.fsync(self._writer.fileno())
+            self._written += _header.size + len(data)
+            self.appended += 1
+            self.depth += 1
+
+    def prepend(self, records):
+        """
+        Puts `records` in front of the records which
+        weren't committed yet.
+        """
+        data = ''.join([_header.pack(len(d)) + d for d in
+                        [pickle.dumps(record, 2) for record in records]])
+        with self.lock:
+            segment, offset = self._cursor
+            if segment not in self._segments:
+                later = [s for s in self._segments if s > segment]
+                segment, offset = later and later[0] or None, 0
+            self._close_reader()
+
+            if segment is not None:
+                if segment == self._segments[-1] and self._writer is not None:
+                    self._writer.close()
+                    self._writer = None
+                f = open(self._path(segment), 'rb')
+                try:
+                    f.seek(offset)
+                    data += f.read()
+                finally:
+                    f.close()
+                # the segments before the cursor were removed on commit
+                index = self._segments.index(segment)
+                self._segments[index] = segment - 1
+            else:
+                segment = self._segments and self._segments[-1] + 1 or 1
+                self._segments.append(segment - 1)
+
+            f = open(self._path(segment - 1), 'wb')
+            try:
+                f.write(data)
+            finally:
+                f.close()
+            self._remove(segment)
+            self._cursor = self._position = (segment - 1, 0)
+            self._save_cursor()
+            self.appended += len(records)
+            self.depth += len(records)
+
+    def read(self, limit=100):
+        """
+        Returns at most `limit` records following the ones
+        read already.
+        """
+        records = []
+        with self.lock:
+            while len(records) < limit:
+                record = self._next()
+                if record is None:
+                    break
+                records.append(record)
+            self._pending += len(records)
+        return records
+
+    def commit(self):
+        """
+        Marks the records read so far as done.
+        """
+        with self.lock:
+            segment, offset = self._position
+            while self._segments and self._segments[0] < segment:
+                self._remove(self._segments.pop(0))
+            self._cursor = self._position
+            self._save_cursor()
+            self.committed += self._pending
+            self.depth -= self._pending
+            self._pending = 0
+
+    def rewind(self):
+        """
+        Goes back to the last committed record so that the records
+        read since are read again.
+        """
+        with self.lock:
+            self._position = self._cursor
+            self._pending = 0
+            self._close_reader()
+
+    def clear(self):
+        """
+        Removes the segments once all the records were committed.
+        """
+        with self.lock:
+            if self.depth:
+                return
+            self._close_reader()
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+            for segment in self._segments:
+                self._remove(segment)
+            self._segments = []
+            self._cursor = self._position = (0, 0)
+            self._save_cursor()
+
+    def close(self):
+        with self.lock:
+            self._close_reader()
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
+    def size(self):
+        """
+        Returns the number of bytes used by the segments.
+        """
+        with self.lock:
+            return sum([os.path.getsize(self._path(segment))
+                        for segment in self._segments])
+
+    def _next(self):
+        # must be called with the lock held
+        segment, offset = self._position
+        if segment not in self._segments:
+            later = [s for s in self._segments if s > segment]
+            if not later:
+                return None
+            segment, offset = later[0], 0
+            self._position = (segment, offset)
+            self._close_reader()
+
+        if self._reader is None:
+            self._reader = open(self._path(segment), 'rb')
+        self._reader.seek(offset)
+        header = self._reader.read(_header.size)
+        if len(header) == _header.size:
+            length, = _header.unpack(header)
+            data = self._reader.read(length)
+            if len(data) == length:
+                self._position = (segment, offset + _header.size + length)
+                return pickle.loads(data)
+
+        # end of the segment, or a record being written
+        if segment == self._segments[-1]:
+            return None
+        self._position = (self._segments[self._segments.index(segment) + 1], 0)
+        self._close_reader()
+        return self._next()
+
+    def _rotate(self):
+        if self._writer is not None:
+            self._writer.close()
+        segment = self._segments and self._segments[-1] + 1 or 1
+        self._segments.append(segment)
+        self._writer = open(self._path(segment), 'ab')
+        self._written = 0
+
+    def _remove(self, segment):
+        try:
+            os.remove(self._path(segment))
+        except OSError:
+            pass
+
+    def _close_reader(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+    def _count(self):
+        count = 0
+        while self._next() is not None:
+            count += 1
+        self._position = self._cursor
+        self._close_reader()
+        return count
+
+    def _path(self, segment):
+        return os.path.join(self.directory, '%020d.log' % segment)
+
+    def _load_cursor(self):
+        try:
+            f = open(os.path.join(self.directory, 'cursor'))
+            try:
+                segment, offset = f.read().split()
+                return int(segment), int(offset)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return self._segments and self._segments[0] or 0, 0
+
+    def _save_cursor(self):
+        path = os.path.join(self.directory, 'cursor')
+        f = open(path + '.tmp', 'w')
+        try:
+            f.write('%d %d' % self._cursor)
+        finally:
+            f.close()
+        os.rename(path + '.tmp', path)
+
+class SpoolingPublisher(object):
+    """
+    Publishes messages from a background thread so that
+    :meth:`send` never waits for the broker.
+
+    Messages are queued in memory, up to `max_memory` of them, and
+    sent by the drainer thread with the publisher returned by
+    `factory`, whose connection must be its own. When the broker can't keep up, because it blocked
+    the connection or went away, the messages which don't fit in
+    memory anymore are appended to a :class:`SpoolLog` in `directory`
+    instead. The drainer replays them in order once the memory queue
+    is empty and the following messages keep going to the log until
+    it is drained.
+
+    When sending fails, the publisher and its connection are closed,
+    the drainer waits from `retry_delay` up to `max_retry_delay`
+    seconds and creates a new publisher, on a new connection,
+    with `factory`.
+
+    Messages spooled to disk survive a restart: the ones which
+    weren't sent are sent by the next spooling publisher using the
+    same directory. On :meth:`stop`, messages still in memory are
+    spooled as well, the one the drainer was sending may then be
+    sent twice.
+    """
+    def __init__(self, factory, directory, max_memory=1000,
+                 segment_size=16 * 1024 * 1024, fsync=False):
+        self.factory = factory
+        self.max_memory = max_memory
+        self.batch_size = 100
+        self.retry_delay = 0.1
+        self.max_retry_delay = 5.0
+        self.log = SpoolLog(directory, segment_size, fsync)
+
+        self.lock = threading.Lock()
+        self._memory = deque()
+        self._spooling = self.log.depth > 0
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._publisher = None
+
+        self.sent = 0
+        self.spooled = 0
+        self.replayed = 0
+        self.failures = 0
+        self.last_error = None
+        self._rate = deque()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._drain)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def send(self, message_data, **kwargs):
+        """
+        Queues a message, takes the same parameters as
+        ``carrot.messaging.Publisher.send``.
+        """
+        with self.lock:
+            if self._spooling or len(self._memory) >= self.max_memory:
+                self._spooling = True
+                self.log.append((message_data, kwargs))
+                self.spooled += 1
+            else:
+                self._memory.append((message_data, kwargs))
+        self._wakeup.set()
+
+    def stop(self, timeout=None):
+        """
+        Stops the drainer, waiting at most `timeout` seconds for
+        it to send the message it is busy with, and spools the
+        messages left in memory.
+        """
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        with self.lock:
+            if self._memory:
+                # they are older than the spooled messages
+                self.log.prepend(list(self._memory))
+                self.spooled += len(self._memory)
+                self._memory.clear()
+        self.log.close()
+        self._close_publisher()
+
+    def stats(self):
+        """
+        Returns the number of messages waiting in memory and on disk
+        along with the rate, in messages per second, at which they
+        were sent over the last few seconds.
+        """
+        samples = list(self._rate)
+        rate = 0.0
+        if len(samples) > 1 and samples[-1][0] > samples[0][0]:
+            rate = (samples[-1][1] - samples[0][1]) / (samples[-1][0] - samples[0][0])
+        return {'memory': len(self._memory),
+                'depth': self.log.depth,
+                'spooling': self._spooling,
+                'sent': self.sent,
+                'spooled': self.spooled,
+                'replayed': self.replayed,
+                'failures': self.failures,
+                'last_error': self.last_error,
+                'drain_rate': rate,
+                'disk_bytes': self.log.size()}
+
+    def _drain(self):
+        delay = self.retry_delay
+        while not self._stopping.isSet():
+            try:
+                busy = self._send_memory() or self._send_spooled()
+            except Exception, e:
+                self.failures += 1
+                self.last_error = str(e) or e.__class__.__name__
+                self.log.rewind()
+                self._close_publisher()
+                self._stopping.wait(delay)
+                delay = min(delay * 2, self.max_retry_delay)
+                continue
+
+            delay = self.retry_delay
+            self._sample()
+            if not busy:
+                self._wakeup.wait(0.5)
+                self._wakeup.clear()
+
+    def _send_memory(self):
+        # messages are only removed from memory once sent
+        count = 0
+        while self._memory and count < self.batch_size:
+            message_data, kwargs = self._memory[0]
+            self._get_publisher().send(message_data, **kwargs)
+            self._memory.popleft()
+            self.sent += 1
+            count += 1
+        return count
+
+    def _send_spooled(self):
+        if not self._spooling:
+            return 0
+        records = self.log.read(self.batch_size)
+        if not records:
+            with self.lock:
+                # nothing was appended since the read
+                if not self.log.read(1):
+                    self._spooling = False
+                    self.log.clear()
+                    return 0
+            self.log.rewind()
+            return 1
+
+        publisher = self._get_publisher()
+        for message_data, kwargs in records:
+            publisher.send(message_data, **kwargs)
+        self.log.commit()
+        self.sent += len(records)
+        self.replayed += len(records)
+        return len(records)
+
+    def _get_publisher(self):
+        if self._publisher is None:
+            self._publisher = self.factory()
+        return self._publisher
+
+    def _close_publisher(self):
+        publisher, self._publisher = self._publisher, None
+        if publisher is None:
+            return
+        for close in (publisher.close, publisher.connection.close):
+            try:
+                close()
+            except Exception:
+                pass
+
+    def _sample(self):
+        now = time.time()
+        rate = self._rate
+        if not rate or now - rate[-1][0] >= 0.5:
+            rate.append((now, self.sent))
+            while now - rate[0][0] > 10.0:
+                rate.popleft()
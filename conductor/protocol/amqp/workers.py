@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+import itertools
+import multiprocessing
+import threading
+import time
+from Queue import Queue, Empty
+
+from carrot import serialization
+
+from conductor.protocol.amqp.consumer import PushConsumer
+
+__all__ = ['WorkerPoolConsumer', 'ThreadWorkers', 'ProcessWorkers']
+
+def _properties(message):
+    info = message.delivery_info or {}
+    return {'routing_key': info.get('routing_key'),
+            'exchange': info.get('exchange'),
+            'content_type': message.content_type,
+            'content_encoding': message.content_encoding}
+
+class ThreadWorkers(object):
+    """
+    Runs `handler` in `size` threads, each processing the
+    messages it's given in order.
+    """
+    def __init__(self, handler, size, done):
+        self.handler = handler
+        self.done = done
+        self.queues = [Queue() for _ in range(size)]
+        self.threads = [threading.Thread(target=self._work, args=(queue,))
+                        for queue in self.queues]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, index, message):
+        self.queues[index].put(message)
+
+    def stop(self, timeout=None):
+        for queue in self.queues:
+            queue.put(None)
+        deadline = None if timeout is None else time.time() + timeout
+        for thread in self.threads:
+            thread.join(None if deadline is None else max(0, deadline - time.time()))
+
+    def _work(self, queue):
+        while 1:
+            message = queue.get()
+            if message is None:
+                break
+            try:
+                self.handler(message.payload, _properties(message))
+            except:
+                self.done(message, False)
+            else:
+                self.done(message, True)
+
+def _process_worker(handler, inbox, results):
+    while 1:
+        item = inbox.get()
+        if item is None:
+            break
+        seq, body, properties = item
+        try:
+            payload = serialization.decode(body, properties['content_type'],
+                                           properties['content_encoding'])
+            handler(payload, properties)
+        except:
+            results.put((seq, False))
+        else:
+            results.put((seq, True))
+
+class ProcessWorkers(object):
+    """
+    Runs `handler` in `size` child processes, each processing the
+    messages it's given in order. Only the message body and properties
+    are sent to the children which decode the payload themselves.
+
+    A child which dies is replaced. The message it was handling
+    fails and the ones waiting for it go to its replacement.
+    """
+    def __init__(self, handler, size, done, log=None):
+        self.handler = handler
+        self.done = done
+        self.log = log
+        self.respawned = 0
+        self.lock = threading.Lock()
+        self.results = multiprocessing.Queue()
+        self.queues = [None] * size
+        self.processes = [None] * size
+        for index in range(size):
+            self._spawn(index)
+
+        self._stopping = False
+        self._messages = {}
+        self._seq = itertools.count()
+        self._collector = threading.Thread(target=self._collect)
+        self._collector.daemon = True
+        self._collector.start()
+
+    def submit(self, index, message):
+        with self.lock:
+            seq = self._seq.next()
+            self._messages[seq] = (index, message)
+            self.queues[index].put((seq, message.body, _properties(message)))
+
+    def stop(self, timeout=None):
+        with self.lock:
+            self._stopping = True
+            for queue in self.queues:
+                queue.put(None)
+        deadline = None if timeout is None else time.time() + timeout
+        for process in self.processes:
+            process.join(None if deadline is None else max(0, deadline - time.time()))
+            if process.is_alive():
+                process.terminate()
+        self.results.put(None)
+        self._collector.join(1.0)
+
+    def _spawn(self, index):
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=_process_worker,
+                                          args=(self.handler, queue, self.results))
+        process.daemon = True
+        process.start()
+        self.queues[index] = queue
+        self.processes[index] = process
+
+    def _collect(self):
+        checked = time.time()
+        while 1:
+            try:
+                result = self.results.get(timeout=0.5)
+            except Empty:
+                result = ()
+            if result is None:
+                break
+            if result:
+                self._settle(*result)
+            if time.time() - checked >= 0.5:
+                checked = time.time()
+                self._check()
+
+    def _settle(self, seq, ok):
+        with self.lock:
+            message = self._messages.pop(seq, None)
+        if message is not None:
+            self.done(message[1], ok)
+
+    def _check(self):
+        for index, process in enumerate(self.processes):
+            if self._stopping:
+                return
+            if process.is_alive():
+                continue
+            # settles what the child sent before dying
+            while 1:
+                try:
+                    result = self.results.get_nowait()
+                except Empty:
+                    break
+                if result is None:
+                    self.results.put(None)
+                    break
+                self._settle(*result)
+
+            with self.lock:
+                if self._stopping:
+                    return
+                seqs = sorted([seq for seq, (i, message) in self._messages.items()
+                               if i == index])
+                lost = seqs and self._messages.pop(seqs[0])[1]
+                self._spawn(index)
+                self.respawned += 1
+                for seq in seqs[1:]:
+                    message = self._messages[seq][1]
+                    self.queues[index].put((seq, message.body, _properties(message)))
+            if self.log:
+                self.log("AMQP worker %s exited with %s, %d messages handed to %s" % \
+                         (process.pid, process.exitcode, len(seqs[1:]),
+                          self.processes[index].pid), level=30)
+            if lost:
+                self.done(lost, False)
+
+class WorkerPoolConsumer(PushConsumer):
+    """
+    Consumes messages like a :class:`conductor.protocol.amqp.consumer.PushConsumer`
+    but hands them over to a pool of `workers` threads (`mode` set to
+    ``"thread"``) or child processes (``"process"``) rather than to
+    the bus thread.
+
+    `handler` is called with the message payload and a dictionary of its
+    properties (``routing_key``, ``exchange``, ``content_type``...).
+    Messages are dispatched by the hash of their key, the routing
+    key by default or whatever `key` returns when given the message,
+    so that messages with the same key are processed in order by
+    the same worker. A message is acknowledged once processed.
+
+    The prefetch window bounds the number of messages in flight.
+    """
+    def __init__(self, bus, broker, handler, workers=4, mode='thread',
+                 key=None, prefetch_count=100, **kwargs):
+        PushConsumer.__init__(self, bus, broker, None, prefetch_count, **kwargs)
+        self.handler = handler
+        self.workers = workers
+        self.mode = mode
+        self.key = key or (lambda message: (message.delivery_info or {}).get('routing_key'))
+        self.drain_timeout = 10.0
+        self.pool = None
+        self.in_flight = 0
+
+    def start(self):
+        if self.mode == 'process':
+            self.pool = ProcessWorkers(self.handler, self.workers, self._done,
+                                       log=self.bus.log)
+        else:
+            self.pool = ThreadWorkers(self.handler, self.workers, self._done)
+        PushConsumer.start(self)
+
+    def deliver(self):
+        # messages never go through the bus thread
+        return False
+
+    def stats(self):
+        stats = PushConsumer.stats(self)
+        stats['in_flight'] = self.in_flight
+        stats['respawned'] = getattr(self.pool, 'respawned', 0)
+        return stats
+
+    def _received(self, message_data, message):
+        index = hash(self.key(message)) % self.workers
+        with self.lock:
+            self.received += 1
+            self.in_flight += 1
+        self.pool.submit(index, message)
+
+    def _done(self, message, ok):
+        with self.lock:
+            self.in_flight -= 1
+            if ok:
+                self.delivered += 1
+            else:
+                self.failed += 1
+        if ok:
+            self.acks.append(([message], 'ack'))
+        else:
+            self.acks.append(([message], self.requeue_on_error and 'requeue' or 'reject'))
+
+    def _drain(self):
+        self.pool.stop(self.drain_timeout)
@@ -27,6 +27,7 @@ class TornadoServerTask(Task):
         self.bus.log("Starting the Tornado HTTP server")
         self.bus.subscribe('get-http-server', self.get_server)
         self.server.listen(self.port)
+    start_task.priority = 20
 
     def stop_task(self):
         self.bus.log("Stopping the Tornado HTTP server")
@@ -42,6 +43,7 @@ class TornadoApplicationTask(WebApplicationTask):
     def start_task(self):
         self.server = self.bus.publish('get-http-server').pop()
         WebApplicationTask.start_task(self)
+    start_task.priority = 30
         
     def stop_task(self):
         WebApplicationTask.stop_task(self)
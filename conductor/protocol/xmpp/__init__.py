@@ -11,9 +11,10 @@ from headstock.lib.stanza import Stanza
 from headstock.lib.utils import generate_unique
 
 from conductor.task import Task
+from conductor.protocol.xmpp.supervisor import XMPPSupervisorTask
 
 
-__all__ = ['XMPPProcessTask', 'XMPPClientSettings']
+__all__ = ['XMPPProcessTask', 'XMPPClientSettings', 'XMPPSupervisorTask']
 
 CONNECTING = 0
 CONNECTED = 1
@@ -37,6 +38,14 @@ class XMPPClientSettings(object):
         self.log_dir = None
         self.log_stdout = False
 
+class _SessionWatcher(object):
+    # client extension telling its task when the session is ready
+    def __init__(self, task):
+        self.task = task
+
+    def ready(self, client):
+        self.task.connected()
+
 class XMPPProcessTask(Task):
     """
     XMPP processing task.
@@ -48,29 +57,38 @@ class XMPPProcessTask(Task):
         Task.__init__(self, bus)
         self.client = None
         self.settings = XMPPClientSettings()
+        # how often the client is checked and restarted if it died
+        # when no XMPPSupervisorTask is registered with the process
+        self.watch_period = 0.1
+        # how long the client is given to stop before being forced to
+        self.stop_timeout = 10.0
+        self._watch = None
+        self._supervised = False
 
     def start_task(self):
         """
-        Starts the XMPP process task.
+        Starts the XMPP process task, unless a ramp controller
+        listening to ``"ramp-xmpp-client"`` takes care of
+        launching it later on.
+        """
+        if any(self.bus.publish('ramp-xmpp-client', self)):
+            return
+        self.launch()
+
+    def launch(self):
+        """
+        Setups and starts the client.
         """
         self.setup_client()
         self.start_client()
+        if self.client:
+            self._supervise()
 
     def stop_task(self):
+        self._unsupervise()
         if self._check():
-            if self.settings.unregister:
-                self.bus.unsubscribe('main', self._restart)
-                self._log("Unregistering XMPP client")
-                self.unregister()
-                self.bus.publish("main")
-                self._log("Stopping XMPP client")
-                while self._check():
-                    self.bus.publish("main")
-                    time.sleep(0.005)
-                self.client = None
-                self._log("XMPP client stopped")
-            else:
-                self.stop_client()
+            self.disconnect()
+            self.wait_stopped(time.time() + self.stop_timeout)
             
     def setup_client(self):
         """
@@ -78,15 +96,32 @@ class XMPPProcessTask(Task):
         """
         self._log("Setting up XMPP client")
         self.init_client()
+        self.client.register(_SessionWatcher(self))
         self.add_extensions()
 
+    def connected(self):
+        """
+        Called once the client session is established. Publishes
+        the task to ``"xmpp-client-connected"`` and starts the
+        scenario.
+        """
+        self.bus.publish('xmpp-client-connected', self)
+        self.start_scenario()
+
+    def start_scenario(self):
+        """
+        Override this method to start what the client does once
+        connected. Overriding methods should call this one which
+        publishes the task to ``"xmpp-scenario-started"``.
+        """
+        self.bus.publish('xmpp-scenario-started', self)
+
     def start_client(self):
         """
         If `self.client` is not `None`, calls `start()` on it.
         """
         if self.client:
             self._log("Starting XMPP client")
-            self.bus.subscribe('main', self._restart)
             self.client.start()
 
     def stop_client(self):
@@ -95,14 +130,53 @@ class XMPPProcessTask(Task):
         Sets `self.client` to `None` afterwards.
         """
         if self.client:
-            self.bus.unsubscribe('main', self._restart)
             self._log("Stopping XMPP client")
             self.client.stop()
-            while self.client and self.client.running:
+            # we may be called from a main listener, don't pump
+            deadline = time.time() + self.stop_timeout
+            while self._check() and time.time() < deadline:
                 time.sleep(0.005)
+            if self._check():
+                self.force_stop()
             self.client = None
             self._log("XMPP client stopped")
 
+    def disconnect(self):
+        """
+        Asks the client to unregister, when `self.settings.unregister`
+        is set, or to stop. Doesn't wait for the client to stop.
+        """
+        if self.settings.unregister:
+            self._log("Unregistering XMPP client")
+            self.unregister()
+        else:
+            self._log("Stopping XMPP client")
+            self.client.stop()
+
+    def wait_stopped(self, deadline):
+        """
+        Lets the process loop run until the client stops or
+        `deadline` is reached, in which case the client is
+        stopped forcefully. Sets `self.client` to `None` afterwards.
+        """
+        while self._check() and time.time() < deadline:
+            self._pump(0.005)
+        if self._check():
+            self.force_stop()
+        self.client = None
+        self._log("XMPP client stopped")
+
+    def force_stop(self):
+        """
+        Stops a client which didn't stop in time. The client
+        is closed if it supports it.
+        """
+        self._log("XMPP client didn't stop in time, forcing it", level=30)
+        self.client.stop()
+        close = getattr(self.client, 'close', None)
+        if close:
+            close()
+
     def restart_client(self):
         """
         Performs the following actions:
@@ -145,6 +219,22 @@ class XMPPProcessTask(Task):
     def _restart(self):
         if not self.client or not self.client.running:
             self.restart_client()
+
+    def _supervise(self):
+        # falls back to watching the client ourselves
+        # when no supervisor is registered
+        if any(self.bus.publish('supervise-xmpp-client', self)):
+            self._supervised = True
+        else:
+            self._watch = self._schedule(self._restart, self.watch_period)
+
+    def _unsupervise(self):
+        if self._supervised:
+            self.bus.publish('unsupervise-xmpp-client', self)
+            self._supervised = False
+        elif self._watch is not None:
+            self._unschedule(self._watch, self._restart)
+            self._watch = None
     
     def _check(self):
         if not self.client:
@@ -244,6 +334,7 @@ if __name__ == '__main__':
     
     p = AsyncoreProcess()
     p.logger = open_logger(stdout=True)
+    p.register_task(XMPPSupervisorTask())
 
     for i in range(0, 1000):
         t = XMPPProcessTask()
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+__docformat__ = "restructuredtext en"
+import multiprocessing
+import os
+import time
+from Queue import Empty
+
+from conductor.process import SynchronizingProcess, SynchronizedAsyncoreProcess
+from conductor.task import Task
+from conductor.protocol.xmpp.supervisor import XMPPSupervisorTask
+from conductor.protocol.xmpp.ramp import XMPPRampTask, ScaledRamp
+
+__all__ = ['XMPPLoadTestRunner', 'XMPPShardProcess', 'ShardReportTask']
+
+class ShardReportTask(Task):
+    """
+    Sends a report about its shard to the parent process
+    through `queue` when the shard stops.
+    """
+    def __init__(self, bus=None, queue=None, shard=0, tasks=None):
+        Task.__init__(self, bus)
+        self.queue = queue
+        self.shard = shard
+        self.tasks = tasks or []
+        self.started = None
+
+    def start_task(self):
+        self.started = time.time()
+        self.bus.subscribe('get-shard-report', self.report)
+
+    def stop_task(self):
+        self.bus.unsubscribe('get-shard-report', self.report)
+        try:
+            self.queue.put(self.report())
+        except:
+            self._log("Couldn't send the report of shard %d" % self.shard,
+                      level=40, traceback=True)
+    # before the supervisor stops the clients
+    stop_task.priority = 30
+
+    def report(self):
+        """
+        Returns a dictionary describing the shard.
+        """
+        supervisor = self.bus.publish('get-xmpp-supervisor-stats')
+        ramp = self.bus.publish('get-xmpp-ramp-stats')
+        return {'shard': self.shard,
+                'pid': os.getpid(),
+                'users': len(self.tasks),
+                'running': len([t for t in self.tasks if t._check()]),
+                'started': self.started,
+                'stopped': time.time(),
+                'supervisor': supervisor and supervisor.pop() or None,
+                'ramp': ramp and ramp.pop() or None}
+
+class XMPPShardProcess(SynchronizedAsyncoreProcess):
+    """
+    Child process running the XMPP tasks of one shard.
+
+    The tasks are created by `factory`, one per user, once the
+    process is running so that the parent never holds them.
+    """
+    def __init__(self, condition, queue, shard, users, factory):
+        SynchronizedAsyncoreProcess.__init__(self, condition)
+        self.queue = queue
+        self.shard = shard
+        self.users = users
+        self.factory = factory
+        self.supervise = True
+        self.ramp = None
+        self.open_loop = True
+        self.duration = None
+
+    def run(self):
+        if self.supervise:
+            self.register_task(XMPPSupervisorTask())
+        if self.ramp is not None:
+            ramp = XMPPRampTask(profile=self.ramp)
+            ramp.open_loop = self.open_loop
+            self.register_task(ramp)
+
+        tasks = []
+        for user in self.users:
+            task = self.factory(user)
+            self.register_task(task)
+            tasks.append(task)
+
+        self.register_task(ShardReportTask(queue=self.queue, shard=self.shard,
+                                           tasks=tasks))
+        if self.duration:
+            self.bus.subscribe('start', self._schedule_exit)
+
+        SynchronizedAsyncoreProcess.run(self)
+
+    def _schedule_exit(self):
+        self.bus.publish('schedule', self.bus.exit,
+                         deadline=time.time() + self.duration)
+    # once the scheduler is started
+    _schedule_exit.priority = 90
+
+class XMPPLoadTestRunner(object):
+    """
+    Runs a XMPP load test across several child processes.
+
+    `users` is split into `shards` slices (one per CPU by default),
+    each run by a :class:`XMPPShardProcess`. `factory` is called
+    within the children with each user and must return the
+    :class:`conductor.protocol.xmpp.XMPPProcessTask` simulating it.
+
+    The children are released together once they are all
+    started and report back to the parent when they stop.
+    :meth:`run` returns their reports sorted by shard.
+
+    When `ramp` is set to a rate or a profile (see
+    :mod:`conductor.protocol.xmpp.ramp`) the users are launched at
+    that overall arrival rate, each shard taking its share of it.
+
+    .. code-block :: python
+
+        def make_task(i):
+            t = XMPPProcessTask()
+            t.settings.username = "test%d" % i
+            ...
+            return t
+
+        runner = XMPPLoadTestRunner(make_task, range(0, 10000))
+        runner.duration = 60
+        for report in runner.run():
+            print report
+    """
+    def __init__(self, factory, users, shards=None):
+        self.factory = factory
+        self.users = list(users)
+        self.shards = shards or multiprocessing.cpu_count()
+        self.logger = None
+        self.supervise = True
+        self.ramp = None
+        self.open_loop = True
+        self.duration = None
+        self.sync_timeout = 30.0
+        self.results = []
+
+    def split(self):
+        """
+        Returns the users of each shard.
+        """
+        shards = min(self.shards, len(self.users)) or 1
+        return [self.users[i::shards] for i in range(shards)]
+
+    def run(self):
+        """
+        Runs the load test and blocks until all the
+        children have exited.
+        """
+        queue = multiprocessing.Queue()
+
+        parent = SynchronizingProcess()
+        parent.bus.sync_timeout = self.sync_timeout
+        parent.logger = self.logger
+        parent.bus.subscribe('main', lambda: self._collect(queue))
+
+        shards = self.split()
+        children = []
+        for shard, users in enumerate(shards):
+            child = XMPPShardProcess(parent.bus.condition, queue,
+                                     shard, users, self.factory)
+            child.logger = self.logger
+            child.supervise = self.supervise
+            if self.ramp is not None:
+                child.ramp = ScaledRamp(self.ramp, float(len(users)) / len(self.users))
+                child.open_loop = self.open_loop
+            child.duration = self.duration
+            children.append(child)
+
+        parent.bus.parties = len(children)
+        for child in children:
+            child.start()
+        parent.log("Started %d shards for %d users" % (len(children), len(self.users)))
+
+        try:
+            parent.run()
+        finally:
+            for child in children:
+                child.join()
+
+        # reports may still be in the pipe when the last child exits
+        while len(self.results) < len(children):
+            try:
+                self.results.append(queue.get(timeout=1.0))
+            except Empty:
+                break
+
+        self.results.sort(key=lambda report: report['shard'])
+        return self.results
+
+    def _collect(self, queue):
+        collected = False
+        while 1:
+            try:
+                self.results.append(queue.get_nowait())
+            except Empty:
+                return collected
+            collected = True
+
+if __name__ == '__main__':
+    from conductor.lib.logger import open_logger
+    from conductor.protocol.xmpp import XMPPProcessTask
+
+    def make_task(i):
+        t = XMPPProcessTask()
+        t.settings.username = "test%d" % i
+        t.settings.password = "test"
+        t.settings.domain = "localhost"
+        t.settings.resource = "conductor"
+        t.settings.hostname = "localhost"
+        t.settings.register = False
+        t.settings.unregister = True
+        return t
+
+    runner = XMPPLoadTestRunner(make_task, range(0, 10000))
+    runner.logger = open_logger(stdout=True)
+    runner.duration = 60
+    for report in runner.run():
+        print report
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+__docformat__ = "restructuredtext en"
+import time
+from collections import deque
+
+from conductor.task import Task
+
+__all__ = ['TokenBucket', 'LinearRamp', 'StepRamp', 'SpikeRamp',
+           'ScaledRamp', 'XMPPRampTask']
+
+class LinearRamp(object):
+    """
+    Rate going from `start` to `end` arrivals per second
+    over `duration` seconds and staying at `end` afterwards.
+    """
+    def __init__(self, start, end, duration):
+        self.start = float(start)
+        self.end = float(end)
+        self.duration = float(duration)
+
+    def __call__(self, elapsed):
+        if elapsed >= self.duration:
+            return self.end
+        return self.start + (self.end - self.start) * elapsed / self.duration
+
+class StepRamp(object):
+    """
+    Rate following `steps`, a sequence of ``(duration, rate)``
+    pairs. The last rate is kept once all the steps are done.
+    """
+    def __init__(self, steps):
+        self.steps = list(steps)
+
+    def __call__(self, elapsed):
+        for duration, rate in self.steps:
+            if elapsed < duration:
+                return rate
+            elapsed -= duration
+        return self.steps[-1][1]
+
+class SpikeRamp(object):
+    """
+    Rate of `base` arrivals per second, jumping to `spike` for
+    `length` seconds once `at` seconds have elapsed.
+    """
+    def __init__(self, base, spike, at, length):
+        self.base = base
+        self.spike = spike
+        self.at = at
+        self.length = length
+
+    def __call__(self, elapsed):
+        if self.at <= elapsed < self.at + self.length:
+            return self.spike
+        return self.base
+
+class ScaledRamp(object):
+    """
+    Rate of `profile` (a number or a profile) multiplied
+    by `factor`.
+    """
+    def __init__(self, profile, factor):
+        self.profile = profile
+        self.factor = factor
+
+    def __call__(self, elapsed):
+        rate = self.profile
+        if callable(rate):
+            rate = rate(elapsed)
+        return rate * self.factor
+
+class TokenBucket(object):
+    """
+    Hands out tokens at `rate` per second, `rate` being either a
+    number or a callable returning the rate for the number of
+    seconds elapsed since `start`.
+
+    Each token has the time at which it was scheduled. Up to
+    `burst` tokens are kept when they aren't taken on time, the
+    others are dropped. With `burst` set to ``None`` no token is
+    ever dropped so that late takers catch up with the schedule.
+
+    When the rate varies, the time of the next token is found by
+    integrating it over slices of `resolution` seconds, looking at
+    most `max_slices` slices ahead.
+    """
+    max_slices = 100000
+
+    def __init__(self, rate, burst=1.0, start=None, resolution=0.01):
+        self.rate = rate
+        self.burst = burst
+        self.resolution = resolution
+        self.start = start if start is not None else time.time()
+        self.next = self.start
+
+    def rate_at(self, when):
+        rate = self.rate
+        if callable(rate):
+            rate = rate(when - self.start)
+        return rate
+
+    def peek(self, now):
+        """
+        Returns the scheduled time of the next token if it is
+        available at `now`, ``None`` otherwise.
+        """
+        # skip the periods during which the rate is null
+        while self.next <= now and self.rate_at(self.next) <= 0:
+            self.next += self.resolution
+
+        if self.next > now:
+            return None
+
+        rate = self.rate_at(now)
+        if self.burst is not None and rate > 0:
+            oldest = now - self.burst / rate
+            if self.next < oldest:
+                self.next = oldest
+        return self.next
+
+    def take(self):
+        """
+        Takes the next token and returns its scheduled time.
+        """
+        scheduled = self.next
+        self.next = self._next_after(scheduled)
+        return scheduled
+
+    def _next_after(self, when):
+        # the next token is due once the rate integrated from
+        # `when` reaches one, by slices of `resolution` seconds
+        if not callable(self.rate):
+            if self.rate > 0:
+                return when + 1.0 / self.rate
+            return when + self.resolution
+
+        step = self.resolution
+        needed = 1.0
+        for i in xrange(0, self.max_slices):
+            rate = self.rate_at(when + step / 2)
+            if rate > 0:
+                if rate * step >= needed:
+                    return when + needed / rate
+                needed -= rate * step
+            when += step
+        return when
+
+def _percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+    count = len(values)
+    return {'min': values[0],
+            'median': values[count // 2],
+            'p99': values[min(count - 1, int(count * 0.99))],
+            'max': values[-1]}
+
+class XMPPRampTask(Task):
+    """
+    Launches the XMPP tasks of a process progressively rather
+    than all at once when the process starts.
+
+    XMPP tasks queue themselves by publishing to
+    ``"ramp-xmpp-client"`` and are launched at the arrival rate
+    given by `profile`: a number of arrivals per second or a callable
+    such as :class:`LinearRamp`, :class:`StepRamp` or
+    :class:`SpikeRamp` returning the rate for the elapsed time.
+
+    In open loop mode (the default) arrivals follow the schedule
+    whatever happens to the ones before them: when the process
+    falls behind it catches up, so the server is not given any
+    slack. In closed loop mode at most `max_pending` clients may be
+    connecting at the same time and at most `burst` missed
+    arrivals are caught up with. A client which isn't connected
+    after `connect_timeout` seconds stops counting as connecting.
+
+    Launch and connection times as well as scenario start times
+    are recorded against the scheduled arrival times and returned
+    by ``"get-xmpp-ramp-stats"``.
+    """
+    def __init__(self, bus=None, profile=1.0):
+        Task.__init__(self, bus)
+        self.profile = profile
+        self.open_loop = True
+        self.burst = 1.0
+        self.max_pending = 10
+        self.connect_timeout = 30.0
+        self.tick_period = 0.01
+
+        self.bucket = None
+        self.queue = deque()
+        self.pending = {}
+        self.records = {}
+        self.timeouts = 0
+
+        self._timer = None
+
+    def start_task(self):
+        self.bucket = TokenBucket(self.profile,
+                                  burst=None if self.open_loop else self.burst)
+        self.bus.subscribe('ramp-xmpp-client', self.enqueue)
+        self.bus.subscribe('xmpp-client-connected', self.connected)
+        self.bus.subscribe('xmpp-scenario-started', self.scenario_started)
+        self.bus.subscribe('get-xmpp-ramp-stats', self.stats)
+        self._timer = self._schedule(self.tick, self.tick_period)
+    start_task.priority = 15
+
+    def stop_task(self):
+        self._unschedule(self._timer, self.tick)
+        self._timer = None
+        if self.queue:
+            self._log("%d XMPP clients were never launched" % len(self.queue))
+            self.queue.clear()
+        self.bus.unsubscribe('ramp-xmpp-client', self.enqueue)
+        self.bus.unsubscribe('xmpp-client-connected', self.connected)
+        self.bus.unsubscribe('xmpp-scenario-started', self.scenario_started)
+        self.bus.unsubscribe('get-xmpp-ramp-stats', self.stats)
+    # before the XMPP clients are stopped
+    stop_task.priority = 35
+
+    def enqueue(self, task):
+        self.queue.append(task)
+        return True
+
+    def tick(self):
+        now = time.time()
+        if self.pending:
+            expired = now - self.connect_timeout
+            for task, record in self.pending.items():
+                if record['launched'] < expired:
+                    del self.pending[task]
+                    self.timeouts += 1
+
+        bucket = self.bucket
+        while self.queue:
+            if not self.open_loop and len(self.pending) >= self.max_pending:
+                break
+            if bucket.peek(now) is None:
+                break
+
+            scheduled = bucket.take()
+            task = self.queue.popleft()
+            record = {'scheduled': scheduled, 'launched': time.time(),
+                      'connected': None, 'scenario': None}
+            self.records[task] = record
+            self.pending[task] = record
+            try:
+                task.launch()
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except:
+                del self.pending[task]
+                self._log("Couldn't launch XMPP client %s" % task.settings.username,
+                          level=40, traceback=True)
+
+    def connected(self, task):
+        record = self.pending.pop(task, None)
+        if record is not None:
+            record['connected'] = time.time()
+
+    def scenario_started(self, task):
+        record = self.records.get(task)
+        if record is not None and record['scenario'] is None:
+            record['scenario'] = time.time()
+
+    def stats(self):
+        """
+        Returns the number of queued, connecting and connected
+        clients along with the distribution of the launch, connection
+        and scenario start delays relative to the scheduled times.
+        """
+        records = self.records.values()
+        return {'queued': len(self.queue),
+                'pending': len(self.pending),
+                'launched': len(records),
+                'connected': len([r for r in records if r['connected']]),
+                'timeouts': self.timeouts,
+                'launch_lag': _percentiles([r['launched'] - r['scheduled'] for r in records]),
+                'connect': _percentiles([r['connected'] - r['scheduled']
+                                         for r in records if r['connected']]),
+                'scenario': _percentiles([r['scenario'] - r['scheduled']
+                                          for r in records if r['scenario']])}
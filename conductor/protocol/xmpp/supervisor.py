@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+__docformat__ = "restructuredtext en"
+import random
+import time
+
+from conductor.task import Task
+
+__all__ = ['XMPPSupervisorTask']
+
+class _Supervised(object):
+    def __init__(self, task):
+        self.task = task
+        self.attempts = 0
+        self.down_since = None
+        self.next_attempt = None
+        self.restarted_at = None
+
+class XMPPSupervisorTask(Task):
+    """
+    Watches the clients of all the XMPP tasks of a process and
+    restarts the ones which stopped running.
+
+    Restarts are delayed with an exponential backoff and a full
+    jitter: the n-th attempt in a row happens after a random delay
+    between 0 and ``min(max_backoff, min_backoff * 2 ** (n - 1))``
+    seconds so that clients which lost the same server don't all
+    come back at once. At most `max_concurrent` clients are being
+    restarted at any time, a client counts as such until it has
+    been running for `stable_period` seconds.
+
+    XMPP tasks register themselves by publishing to
+    ``"supervise-xmpp-client"``. Statistics are returned by
+    ``"get-xmpp-supervisor-stats"``.
+
+    When the process stops, the supervisor stops all the clients
+    at once, before the XMPP tasks themselves are stopped. The
+    clients which haven't stopped after `shutdown_timeout` seconds
+    are stopped forcefully.
+    """
+    def __init__(self, bus=None):
+        Task.__init__(self, bus)
+        self.check_period = 0.5
+        self.min_backoff = 0.5
+        self.max_backoff = 60.0
+        self.max_concurrent = 10
+        self.stable_period = 5.0
+        self.shutdown_timeout = 10.0
+
+        self.supervised = {}
+        self.reconnects = 0
+        self.failures = 0
+        self.latencies = []
+        self.max_latencies = 1000
+
+        self._timer = None
+        self._last = 0
+
+    def start_task(self):
+        self.bus.subscribe('supervise-xmpp-client', self.supervise)
+        self.bus.subscribe('unsupervise-xmpp-client', self.unsupervise)
+        self.bus.subscribe('get-xmpp-supervisor-stats', self.stats)
+        self._timer = self._schedule(self.check, self.check_period,
+                                     fallback=self.monitor_task)
+    start_task.priority = 10
+
+    def stop_task(self):
+        self._unschedule(self._timer, self.check, fallback=self.monitor_task)
+        self._timer = None
+        self.shutdown()
+        self.bus.unsubscribe('supervise-xmpp-client', self.supervise)
+        self.bus.unsubscribe('unsupervise-xmpp-client', self.unsupervise)
+        self.bus.unsubscribe('get-xmpp-supervisor-stats', self.stats)
+    # before the XMPP tasks are stopped
+    stop_task.priority = 40
+
+    def shutdown(self):
+        """
+        Asks all the supervised clients to disconnect and lets the
+        process loop run until they have all stopped or until
+        `shutdown_timeout` seconds have elapsed. Stragglers are
+        then stopped forcefully.
+        """
+        tasks = [record.task for record in self.supervised.values()]
+        self.supervised.clear()
+        if not tasks:
+            return
+
+        started = time.time()
+        deadline = started + self.shutdown_timeout
+        pending = []
+        for task in tasks:
+            if not task._check():
+                task.client = None
+                continue
+            try:
+                task.disconnect()
+                pending.append(task)
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except:
+                self._log("Couldn't disconnect XMPP client %s" % task.settings.username,
+                          level=40, traceback=True)
+                pending.append(task)
+
+        self._log("Waiting for %d XMPP clients to stop" % len(pending))
+        while pending and time.time() < deadline:
+            self._pump(0.005)
+            pending = [task for task in pending if task._check()]
+
+        for task in pending:
+            try:
+                task.force_stop()
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except:
+                self._log("Couldn't force XMPP client %s to stop" % task.settings.username,
+                          level=40, traceback=True)
+        for task in tasks:
+            task.client = None
+
+        self._log("Stopped %d XMPP clients in %.2fs (%d forced)" % \
+                  (len(tasks), time.time() - started, len(pending)))
+
+    def supervise(self, task):
+        """
+        Starts watching the client of `task`.
+        """
+        if task not in self.supervised:
+            self.supervised[task] = _Supervised(task)
+        return True
+
+    def unsupervise(self, task):
+        """
+        Stops watching the client of `task`.
+        """
+        self.supervised.pop(task, None)
+
+    def monitor_task(self):
+        now = time.time()
+        if now - self._last >= self.check_period:
+            self._last = now
+            self.check()
+
+    def check(self):
+        """
+        Schedules a restart of the clients which stopped and
+        restarts the ones whose backoff delay has elapsed.
+        """
+        now = time.time()
+        restarting = 0
+        due = []
+        for record in self.supervised.values():
+            if record.task._check():
+                if record.restarted_at is not None:
+                    if now - record.restarted_at < self.stable_period:
+                        restarting += 1
+                    else:
+                        record.restarted_at = None
+                        record.attempts = 0
+                continue
+
+            if record.next_attempt is None:
+                if record.down_since is None:
+                    record.down_since = now
+                    self._log("XMPP client %s is down" % record.task.settings.username)
+                record.restarted_at = None
+                record.attempts += 1
+                record.next_attempt = now + self.backoff(record.attempts)
+            elif record.next_attempt <= now:
+                due.append(record)
+
+        due.sort(key=lambda record: record.next_attempt)
+        for record in due[:max(0, self.max_concurrent - restarting)]:
+            self.restart(record)
+
+    def backoff(self, attempts):
+        """
+        Returns how long to wait before the restart attempt
+        number `attempts`.
+        """
+        ceiling = min(self.max_backoff, self.min_backoff * 2 ** (attempts - 1))
+        return random.uniform(0, ceiling)
+
+    def restart(self, record):
+        task = record.task
+        record.next_attempt = None
+        try:
+            task.restart_client()
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.failures += 1
+            self._log("Couldn't restart XMPP client %s" % task.settings.username,
+                      level=40, traceback=True)
+            return
+
+        if not task._check():
+            self.failures += 1
+            return
+
+        now = time.time()
+        self.reconnects += 1
+        self.latencies.append(now - record.down_since)
+        if len(self.latencies) > self.max_latencies:
+            del self.latencies[0]
+        record.down_since = None
+        record.restarted_at = now
+
+    def stats(self):
+        """
+        Returns a dictionary with the number of supervised clients,
+        of those which are down and the restart counts and latencies
+        (from the moment the client was found down until it was
+        running again).
+        """
+        latencies = sorted(self.latencies)
+        count = len(latencies)
+        stats = {'supervised': len(self.supervised),
+                 'down': len([r for r in self.supervised.values()
+                              if r.down_since is not None]),
+                 'reconnects': self.reconnects,
+                 'failures': self.failures,
+                 'latency': None}
+        if count:
+            stats['latency'] = {'min': latencies[0],
+                                'median': latencies[count // 2],
+                                'p99': latencies[min(count - 1, int(count * 0.99))],
+                                'max': latencies[-1]}
+        return stats
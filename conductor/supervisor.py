@@ -1,24 +1,350 @@
 # -*- coding: utf-8 -*-
+__docformat__ = "restructuredtext en"
+import multiprocessing
+import os
+import signal
+import time
+from collections import deque
+
 from conductor.task import Task
 from conductor.lib.system import kill_proc
 
 __all__ = ['Supervisor']
 
+def _prepare(proc, event=None, parent_pid=None):
+    # resets, in the child, the signal handlers inherited from the
+    # parent which would act on its bus and, for a spare process,
+    # waits for `event` before running
+    run = proc.run
+    def prepared():
+        for name in ('SIGTERM', 'SIGHUP', 'SIGUSR1', 'SIGINT'):
+            if hasattr(signal, name):
+                signal.signal(getattr(signal, name), signal.SIG_DFL)
+        if event is not None:
+            while not event.wait(1.0):
+                if os.getppid() != parent_pid:
+                    return
+        run()
+    proc.run = prepared
+
+class _Supervised(object):
+    def __init__(self, proc, factory, restart):
+        self.proc = proc
+        self.factory = factory
+        self.restart = restart
+        self.attempts = 0
+        self.next_attempt = None
+        self.started_at = time.time()
+        self.exitcode = None
+
 class Supervisor(Task):
+    """
+    Watches child processes and kills them when the process stops.
+
+    A child supervised along with a `factory`, a callable returning
+    a new process which isn't started yet, is replaced when it exits,
+    according to its `restart` policy: ``"permanent"`` children are
+    always replaced, ``"transient"`` ones only when they fail and
+    ``"temporary"`` ones never.
+
+    With the ``"one_for_one"`` `strategy`, only the child which exited
+    is replaced. With ``"one_for_all"``, the other children are killed
+    and replaced along with it, which counts as a single replacement
+    against `max_restarts`. The n-th replacement in a row of a
+    child happens after ``min(max_backoff, min_backoff * 2 ** (n - 1))``
+    seconds, its count being reset once the child has been running for
+    `stable_period` seconds. When more than `max_restarts` replacements
+    happen within `max_seconds`, the supervisor gives up and exits
+    the bus.
+
+    `spares` processes per factory are started ahead and kept waiting
+    so that they take over as soon as a child exits, without any
+    backoff. ``"get-supervisor-stats"`` returns the restart counters.
+
+    Children are stopped all at once: they are sent ``SIGTERM`` and
+    those still running after `stop_timeout` seconds are killed.
+    """
     def __init__(self, bus=None):
         Task.__init__(self, bus)
+        self.strategy = 'one_for_one'
+        self.check_period = 0.5
+        self.min_backoff = 0.1
+        self.max_backoff = 30.0
+        self.stable_period = 10.0
+        self.max_restarts = 10
+        self.max_seconds = 60.0
+        self.spares = 0
+        self.stop_timeout = 10.0
+        self.kill_timeout = 1.0
+
         self.supervised = []
+        self.spare_pool = {}
+        self.restarts = deque()
+        self.restarted = 0
+        self.failovers = 0
+        self.exits = {}
+        self.last_stop = []
+
+        self._timer = None
+        self._last = 0
+        self._running = False
 
-    def supervise(self, proc):
-        self.supervised.append(proc)
+    def supervise(self, proc, factory=None, restart='permanent'):
+        """
+        Starts watching `proc`. When `proc` is ``None``, it is
+        created with `factory` and started.
+        """
+        if proc is None:
+            proc = factory()
+            _prepare(proc)
+            proc.start()
+        self.supervised.append(_Supervised(proc, factory, restart))
+        if factory is not None and self._running:
+            self._fill_spares(factory)
+        return proc
+
+    def unsupervise(self, proc):
+        """
+        Stops watching `proc` which is left running.
+        """
+        self.supervised = [record for record in self.supervised
+                           if record.proc is not proc]
+
+    def start_task(self):
+        self._running = True
+        self.bus.subscribe('get-supervisor-stats', self.stats)
+        for factory in self._factories():
+            self._fill_spares(factory)
+        self._timer = self._schedule(self.check, self.check_period,
+                                     fallback=self.monitor_task)
 
     def stop_task(self):
+        self._running = False
+        self._unschedule(self._timer, self.check, fallback=self.monitor_task)
+        self._timer = None
+        self.bus.unsubscribe('get-supervisor-stats', self.stats)
         self._kill_supervised()
-        
+
+    def monitor_task(self):
+        now = time.time()
+        if now - self._last >= self.check_period:
+            self._last = now
+            self.check()
+
+    def check(self):
+        """
+        Schedules the replacement of the children which exited and
+        replaces the ones whose backoff delay has elapsed.
+        """
+        now = time.time()
+        exited = []
+        for record in self.supervised:
+            if record.next_attempt is not None:
+                continue
+            if record.proc.is_alive():
+                if record.attempts and now - record.started_at >= self.stable_period:
+                    record.attempts = 0
+                continue
+            record.proc.join(0)
+            record.exitcode = record.proc.exitcode
+            self.exits[record.exitcode] = self.exits.get(record.exitcode, 0) + 1
+            self._log("Process %s exited with %s" % (record.proc.pid, record.exitcode),
+                      level=record.exitcode and 30 or 20)
+            exited.append(record)
+
+        for record in exited:
+            if not self._restartable(record):
+                self.supervised.remove(record)
+                continue
+            record.attempts += 1
+            record.next_attempt = now + self.backoff(record.attempts)
+
+            if self.strategy == 'one_for_all':
+                others = [r for r in self.supervised
+                          if r.next_attempt is None and r.proc.is_alive()]
+                if others:
+                    self._log("Restarting all the processes after %s exited" % record.proc.pid)
+                    self._kill([r.proc for r in others])
+                for other in others:
+                    other.exitcode = other.proc.exitcode
+                    if other.factory is None:
+                        self.supervised.remove(other)
+                    else:
+                        other.next_attempt = record.next_attempt
+                        other.attempts = record.attempts
+
+        # with one_for_all, the children restarted together
+        # count as a single restart
+        counted = False
+        for record in list(self.supervised):
+            if record.next_attempt is None:
+                continue
+            if record.next_attempt > now and not self._has_spare(record.factory):
+                continue
+            if not counted:
+                if not self._allow_restart(now):
+                    return
+            if self.restart(record):
+                if not counted:
+                    self.restarts.append(now)
+                counted = self.strategy == 'one_for_all'
+
+        for factory in self._factories():
+            self._fill_spares(factory)
+
+    def backoff(self, attempts):
+        """
+        Returns how long to wait before the replacement
+        number `attempts` of a child.
+        """
+        return min(self.max_backoff, self.min_backoff * 2 ** (attempts - 1))
+
+    def restart(self, record):
+        """
+        Replaces the process of `record` by a spare or
+        by a new one. Returns whether it could.
+        """
+        old = record.proc
+        spares = self.spare_pool.get(record.factory)
+        if spares:
+            proc, event = spares.pop(0)
+            event.set()
+            self.failovers += 1
+        else:
+            try:
+                proc = record.factory()
+                _prepare(proc)
+                proc.start()
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except:
+                self._log("Couldn't replace process %s" % old.pid, level=40, traceback=True)
+                record.next_attempt = time.time() + self.backoff(record.attempts)
+                return False
+
+        self.restarted += 1
+        record.proc = proc
+        record.next_attempt = None
+        record.started_at = time.time()
+        self._log("Replaced process %s by %s" % (old.pid, proc.pid))
+        return True
+
+    def stats(self):
+        """
+        Returns a dictionary with the number of supervised processes,
+        of those which are running and waiting to be replaced, of the
+        spare processes, the replacement counters and the exit codes.
+        """
+        return {'supervised': len(self.supervised),
+                'alive': len([r for r in self.supervised if r.next_attempt is None
+                              and r.proc.is_alive()]),
+                'pending': len([r for r in self.supervised if r.next_attempt is not None]),
+                'spares': sum([len(spares) for spares in self.spare_pool.values()]),
+                'restarted': self.restarted,
+                'failovers': self.failovers,
+                'exits': dict(self.exits),
+                'last_stop': list(self.last_stop)}
+
+    def _restartable(self, record):
+        if not self._running or record.factory is None:
+            return False
+        if record.restart == 'temporary':
+            return False
+        if record.restart == 'transient' and record.exitcode == 0:
+            return False
+        return True
+
+    def _allow_restart(self, now):
+        restarts = self.restarts
+        while restarts and restarts[0] < now - self.max_seconds:
+            restarts.popleft()
+        if len(restarts) < self.max_restarts:
+            return True
+
+        self._log("%d restarts within %ds, giving up" % \
+                  (len(restarts), self.max_seconds), level=50)
+        self._running = False
+        self.bus.exit()
+        return False
+
+    def _factories(self):
+        factories = []
+        for record in self.supervised:
+            if record.factory is not None and record.factory not in factories:
+                factories.append(record.factory)
+        return factories
+
+    def _has_spare(self, factory):
+        return bool(self.spare_pool.get(factory))
+
+    def _fill_spares(self, factory):
+        spares = self.spare_pool.setdefault(factory, [])
+        spares[:] = [(proc, event) for (proc, event) in spares if proc.is_alive()]
+        while self._running and len(spares) < self.spares:
+            proc = factory()
+            event = multiprocessing.Event()
+            _prepare(proc, event, os.getpid())
+            proc.start()
+            spares.append((proc, event))
+
     def _kill_supervised(self):
-        for proc in self.supervised:
-            self.bus.log("Killing %d" % proc.pid)
-            if proc.is_alive():
-                kill_proc(proc.pid)
-                proc.join()
+        procs = [record.proc for record in self.supervised]
+        for spares in self.spare_pool.values():
+            procs.extend([proc for (proc, event) in spares])
+        self._kill(procs)
         self.supervised = []
+        self.spare_pool = {}
+
+    def _kill(self, procs):
+        """
+        Asks all of `procs` to terminate at once and waits for them
+        for at most `stop_timeout` seconds altogether. Those still
+        running are then killed. Returns, for each process, its pid,
+        exit code, how long it took to exit and whether it was killed.
+        """
+        started = time.time()
+        pending = []
+        for proc in procs:
+            if proc.is_alive():
+                self.bus.log("Terminating %d" % proc.pid)
+                try:
+                    kill_proc(proc.pid)
+                except OSError:
+                    pass
+                pending.append(proc)
+
+        exits = {}
+        deadline = started + self.stop_timeout
+        while pending and time.time() < deadline:
+            time.sleep(0.005)
+            for proc in pending[:]:
+                if not proc.is_alive():
+                    exits[proc] = time.time() - started
+                    pending.remove(proc)
+
+        for proc in pending:
+            self.bus.log("Killing %d which didn't exit within %.1fs" % \
+                         (proc.pid, self.stop_timeout), level=30)
+            try:
+                kill_proc(proc.pid, force=True)
+            except OSError:
+                pass
+        for proc in pending:
+            proc.join(self.kill_timeout)
+            exits[proc] = time.time() - started
+
+        report = []
+        for proc in procs:
+            proc.join(0)
+            report.append({'pid': proc.pid,
+                           'exitcode': proc.exitcode,
+                           'elapsed': exits.get(proc, 0.0),
+                           'killed': proc in pending})
+            self.bus.log("Process %s exited with %s after %.3fs%s" % \
+                         (proc.pid, proc.exitcode, exits.get(proc, 0.0),
+                          proc in pending and " (killed)" or ""))
+        if procs:
+            self.bus.log("Stopped %d processes in %.2fs (%d killed)" % \
+                         (len(procs), time.time() - started, len(pending)))
+        self.last_stop = report
+        return report
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 import os
+import time
+
 from cherrypy.process import plugins
 
 __all__ = ['Task']
@@ -33,6 +35,50 @@ class Task(plugins.SimplePlugin):
         if self.bus:
             self.bus.log(msg, level=level, traceback=traceback)
 
+    def _schedule(self, callback, period, fallback=None):
+        """
+        Asks the bus scheduler to call `callback` every `period`
+        seconds and returns the timer. When no scheduler is listening
+        `fallback` (or `callback`) is subscribed to ``main`` instead
+        and ``None`` is returned.
+        """
+        timers = [t for t in self.bus.publish('schedule', callback, period=period) if t]
+        if timers:
+            return timers.pop()
+        self.bus.subscribe('main', fallback or callback)
+
+    def _unschedule(self, timer, callback, fallback=None):
+        """
+        Undoes :meth:`_schedule`.
+        """
+        if timer is not None:
+            self.bus.publish('cancel-schedule', timer)
+        else:
+            self.bus.unsubscribe('main', fallback or callback)
+
+    def _execute(self, func, *args, **kwargs):
+        """
+        Runs `func` in a thread of the executor task and returns
+        its :class:`conductor.lib.executor.Future`. When no executor
+        is listening to ``execute``, `func` is run right away.
+        """
+        futures = [f for f in self.bus.publish('execute', func, args, kwargs) if f]
+        if futures:
+            return futures.pop()
+        from conductor.lib.executor import Future
+        future = Future(func, args, kwargs)
+        future.run()
+        return future
+
+    def _pump(self, timeout=0):
+        # lets the process loop run while we wait
+        # from within a bus listener
+        if hasattr(self.bus, 'pump'):
+            self.bus.pump(timeout)
+        else:
+            self.bus.publish("main")
+            time.sleep(timeout)
+
     # Override those methods in your subclass
     def start_task(self):
         pass
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Measures the overhead of the AMQP tasks against the in-process
+broker of ``conductor.protocol.amqp.memory`` so that it runs
+without any AMQP server.
+
+It reports the publishing rate of plain and batch publishers,
+the consuming rate of polling and push consumers, and the
+connection checkout latency of pools of various sizes under
+contention::
+
+  $ python amqpbench.py
+  $ python amqpbench.py --messages 50000 --batches 10,100,1000
+  $ python amqpbench.py --latency 0.0005 --pool-sizes 1,4,16 --threads 16
+
+``--latency`` makes every synchronous AMQP operation (declarations,
+basic get, transaction commits...) take that many seconds, as a
+round-trip to a remote broker would.
+"""
+import optparse
+import threading
+import time
+
+from conductor.process import Process
+from conductor.task import Task
+from conductor.protocol.amqp.broker import AMQPBrokerTask, BrokerPool
+from conductor.protocol.amqp.consumer import ConsumerTask
+from conductor.protocol.amqp.publisher import PublisherTask
+from conductor.protocol.amqp.memory import get_memory_broker
+
+BACKEND = "conductor.protocol.amqp.memory.MemoryBackend"
+
+def report(name, count, elapsed):
+    print "%-44s %10.0f msg/s %8.2f us/msg" % \
+          (name, count / elapsed, elapsed * 1000000.0 / count)
+
+def bench_checkout(pool_size, threads, checkouts):
+    pool = BrokerPool(None, 5672, None, None, "/", pool_size, backend_cls=BACKEND)
+    latencies = []
+    def checkout():
+        measured = []
+        for _ in range(0, checkouts):
+            started = time.time()
+            broker = pool.get()
+            measured.append(time.time() - started)
+            pool.release(broker)
+        latencies.extend(measured)
+
+    workers = [threading.Thread(target=checkout) for _ in range(0, threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    pool.release_all()
+
+    latencies.sort()
+    count = len(latencies)
+    print "%-44s median %7.1f us, p99 %8.1f us, waits %d" % \
+          ("checkout pool_size=%d threads=%d" % (pool_size, threads),
+           latencies[count // 2] * 1000000, latencies[min(count - 1, int(count * 0.99))] * 1000000,
+           pool.stats()['waits'])
+
+class BenchmarkTask(Task):
+    def __init__(self, bus=None, options=None):
+        Task.__init__(self, bus)
+        self.options = options
+        self.received = 0
+        self.started = None
+        self.consumer = None
+
+    def start_task(self):
+        options = self.options
+        count = options.messages
+        bus = self.bus
+
+        started = time.time()
+        for _ in range(0, 1000):
+            bus.publish("release-amqp-broker", bus.publish("get-amqp-broker").pop())
+        report("broker checkout through the bus", 1000, time.time() - started)
+
+        broker = bus.publish("get-amqp-broker").pop()
+        consumer = bus.publish("get-amqp-consumer", broker, queue="bench",
+                               exchange="bench", routing_key="bench").pop()
+
+        publisher = bus.publish("get-amqp-publisher", broker, exchange="bench",
+                                routing_key="bench").pop()
+        started = time.time()
+        for i in range(0, count):
+            publisher.send(i)
+        report("publish", count, time.time() - started)
+        bus.publish("release-amqp-publisher", publisher)
+
+        started = time.time()
+        for _ in range(0, count):
+            consumer.fetch().ack()
+        report("consume with fetch()", count, time.time() - started)
+
+        for confirm in (False, True):
+            for max_batch in options.batches:
+                batcher = bus.publish("get-amqp-batch-publisher", broker,
+                                      max_batch=max_batch, confirm=confirm,
+                                      exchange="bench", routing_key="bench").pop()
+                started = time.time()
+                for i in range(0, count):
+                    batcher.send(i)
+                bus.publish("release-amqp-batch-publisher", batcher)
+                report("batch publish max_batch=%d confirm=%s" % (max_batch, confirm),
+                       count, time.time() - started)
+                consumer.discard_all()
+
+        bus.publish("release-amqp-consumer", consumer)
+        bus.publish("release-amqp-broker", broker)
+
+        # the push consumer gets a connection of its own
+        broker = bus.publish("get-amqp-broker").pop()
+        publisher = bus.publish("get-amqp-publisher", broker, exchange="bench",
+                                routing_key="bench").pop()
+        for i in range(0, count):
+            publisher.send(i)
+        bus.publish("release-amqp-publisher", publisher)
+        bus.publish("release-amqp-broker", broker)
+
+        self.push_broker = bus.publish("get-amqp-broker").pop()
+        bus.subscribe("bench-messages", self.received_messages)
+        self.started = time.time()
+        self.consumer = bus.publish("get-amqp-push-consumer", self.push_broker,
+                                    "bench-messages", prefetch_count=options.prefetch,
+                                    queue="bench", exchange="bench",
+                                    routing_key="bench").pop()
+
+    def received_messages(self, messages):
+        self.received += len(messages)
+        if self.received >= self.options.messages:
+            report("consume with a push consumer prefetch=%d" % self.options.prefetch,
+                   self.received, time.time() - self.started)
+            self.bus.publish("release-amqp-push-consumer", self.consumer)
+            self.bus.publish("release-amqp-broker", self.push_broker)
+            self.bus.exit()
+
+def run():
+    parser = optparse.OptionParser()
+    parser.add_option("--messages", type="int", default=20000)
+    parser.add_option("--batches", default="10,100,1000",
+                      help="comma separated batch sizes")
+    parser.add_option("--prefetch", type="int", default=100)
+    parser.add_option("--pool-sizes", default="1,4,16",
+                      help="comma separated pool sizes")
+    parser.add_option("--threads", type="int", default=8,
+                      help="threads checking connections out concurrently")
+    parser.add_option("--latency", type="float", default=0.0,
+                      help="seconds taken by each synchronous AMQP operation")
+    options, args = parser.parse_args()
+    options.batches = [int(size) for size in options.batches.split(",")]
+
+    get_memory_broker("/").latency = options.latency
+
+    for pool_size in [int(size) for size in options.pool_sizes.split(",")]:
+        bench_checkout(pool_size, options.threads, 2000)
+
+    p = Process()
+    p.interval = None
+    p.notatexit()
+
+    t = AMQPBrokerTask()
+    t.settings.backend_cls = BACKEND
+    p.register_task(t)
+    p.register_task(PublisherTask())
+    p.register_task(ConsumerTask())
+    p.register_task(BenchmarkTask(options=options))
+    p.run()
+
+if __name__ == '__main__':
+    run()
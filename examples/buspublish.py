@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Measures the cost of a publish against the number of listeners
+of the channel for CherryPy's bus, which sorts the listeners on
+every publish, and for :class:`conductor.lib.bus.DispatchBus`
+which keeps them sorted::
+
+  $ python buspublish.py
+  $ python buspublish.py --listeners 1,10,100,1000,5000 --publishes 2000
+"""
+import optparse
+import time
+
+from cherrypy.process.wspbus import Bus
+
+from conductor.lib.bus import DispatchBus
+
+class Listener(object):
+    def __init__(self, priority):
+        self.priority = priority
+
+    def __call__(self):
+        pass
+
+def measure(bus_class, listeners, publishes):
+    bus = bus_class()
+    for i in range(0, listeners):
+        bus.subscribe("main", Listener(i % 100))
+    # a single listener channel, like "get-amqp-broker"
+    bus.subscribe("get-value", lambda: 42)
+
+    started = time.time()
+    for _ in range(0, publishes):
+        bus.publish("main")
+    main = (time.time() - started) / publishes
+
+    started = time.time()
+    for _ in range(0, publishes):
+        bus.publish("get-value").pop()
+    get = (time.time() - started) / publishes
+    return main, get
+
+def run():
+    parser = optparse.OptionParser()
+    parser.add_option("--listeners", default="1,10,100,1000",
+                      help="comma separated numbers of listeners")
+    parser.add_option("--publishes", type="int", default=5000)
+    options, args = parser.parse_args()
+
+    print "%10s %14s %14s %8s %14s %14s" % ("listeners", "Bus main", "Dispatch main",
+                                            "speedup", "Bus get", "Dispatch get")
+    for listeners in [int(count) for count in options.listeners.split(",")]:
+        publishes = max(10, options.publishes // max(1, listeners // 100))
+        bus_main, bus_get = measure(Bus, listeners, publishes)
+        dispatch_main, dispatch_get = measure(DispatchBus, listeners, publishes)
+        print "%10d %11.2f us %11.2f us %7.1fx %11.2f us %11.2f us" % \
+              (listeners, bus_main * 1000000, dispatch_main * 1000000,
+               bus_main / dispatch_main, bus_get * 1000000, dispatch_get * 1000000)
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Measures the idle CPU usage and the request latency of the
+``webtornado`` demo served by a TornadoProcess.
+
+Run it once with ``--spin`` to get the figures of the former
+busy-looping ``main`` publisher and once without to get the
+figures of the timer driven one::
+
+  $ python tornadoidle.py --spin
+  $ python tornadoidle.py --interval 0.02
+  $ python tornadoidle.py --interval 0.02 --max-interval 0.5
+"""
+import optparse
+import time
+import urllib2
+
+import psutil
+import tornado.web
+
+from conductor.process import TornadoProcess
+from conductor.task import Task
+from conductor.lib.system import kill_proc
+from conductor.protocol.http.webtornado import TornadoServerTask, \
+     TornadoApplicationTask
+
+class SpinningTornadoProcess(TornadoProcess):
+    def publish_main(self):
+        self.bus.publish("main")
+        self.ioloop.add_callback(self.publish_main)
+
+class MainHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.write("Hello, world")
+
+class DemoTask(Task):
+    def start_task(self):
+        self.bus.publish("mount-webapp", r"/", MainHandler, host=".*$")
+
+def cpu_time(proc):
+    times = proc.cpu_times()
+    return times[0] + times[1]
+
+def run():
+    parser = optparse.OptionParser()
+    parser.add_option("--spin", action="store_true", default=False)
+    parser.add_option("--interval", type="float", default=0.02)
+    parser.add_option("--max-interval", type="float", default=None)
+    parser.add_option("--port", type="int", default=8888)
+    parser.add_option("--idle", type="float", default=5.0,
+                      help="seconds during which idle CPU is sampled")
+    parser.add_option("--requests", type="int", default=500)
+    options, args = parser.parse_args()
+
+    if options.spin:
+        p = SpinningTornadoProcess()
+    else:
+        p = TornadoProcess()
+        p.interval = options.interval
+        p.max_interval = options.max_interval
+
+    s = TornadoServerTask()
+    s.port = options.port
+    p.register_task(s)
+    p.register_task(TornadoApplicationTask())
+    p.register_task(DemoTask())
+    p.start()
+
+    url = "http://127.0.0.1:%d/" % options.port
+    try:
+        for _ in range(0, 50):
+            try:
+                urllib2.urlopen(url).read()
+                break
+            except IOError:
+                time.sleep(0.1)
+
+        proc = psutil.Process(p.pid)
+        time.sleep(0.5)
+        before = cpu_time(proc)
+        time.sleep(options.idle)
+        idle_cpu = (cpu_time(proc) - before) * 100.0 / options.idle
+
+        latencies = []
+        for _ in range(0, options.requests):
+            start = time.time()
+            urllib2.urlopen(url).read()
+            latencies.append(time.time() - start)
+        latencies.sort()
+    finally:
+        kill_proc(p.pid)
+        p.join()
+
+    count = len(latencies)
+    print "mode: %s" % ("spin" if options.spin else "interval=%s max_interval=%s" % \
+                        (options.interval, options.max_interval))
+    print "idle CPU: %.1f%%" % idle_cpu
+    print "latency over %d requests: median %.2f ms, p99 %.2f ms, max %.2f ms" % \
+          (count, latencies[count // 2] * 1000,
+           latencies[min(count - 1, int(count * 0.99))] * 1000,
+           latencies[-1] * 1000)
+
+if __name__ == '__main__':
+    run()
@@ -1,10 +1,12 @@
 # -*- coding: utf-8 -*-
+import optparse
 import os, os.path
 from glob import iglob
 
 from conductor.lib.logger import open_logger
-from conductor.process import AsyncoreProcess
 from conductor.protocol.xmpp import XMPPProcessTask
+from conductor.protocol.xmpp.loadtest import XMPPLoadTestRunner
+from conductor.protocol.xmpp.ramp import LinearRamp
 
 from headstock.lib.cot import Cot
 
@@ -16,26 +18,43 @@ class LoadTestTask(XMPPProcessTask):
     def add_extensions(self):
         self.client.register(Cot(self.bus, self.cots))
     
+def make_task(i):
+    cots = iglob(os.path.join(os.curdir, 'cots', '*.cot'))
+    t = LoadTestTask(cots=cots)
+    t.settings.username = "test%d" % i
+    t.settings.password = "test"
+    t.settings.domain = "localhost"
+    t.settings.resource = "conductor"
+    t.settings.hostname = "localhost"
+    t.settings.log_stdout = True
+    t.settings.register = True
+    t.settings.unregister = True
+    return t
+
 def run():
-    p = AsyncoreProcess()
-    p.interval = 0.002
-    p.logger = open_logger(stdout=True)
+    parser = optparse.OptionParser()
+    parser.add_option("--users", type="int", default=1)
+    parser.add_option("--shards", type="int", default=None,
+                      help="number of child processes, one per CPU by default")
+    parser.add_option("--duration", type="float", default=None)
+    parser.add_option("--rate", type="float", default=None,
+                      help="users connecting per second, all at once by default")
+    parser.add_option("--ramp-up", type="float", default=None,
+                      help="seconds to linearly ramp up to --rate")
+    parser.add_option("--closed-loop", action="store_true", default=False)
+    options, args = parser.parse_args()
 
-    ids = range(0, 1)
-    for i in ids:
-        cots = iglob(os.path.join(os.curdir, 'cots', '*.cot'))
-        t = LoadTestTask(cots=cots)
-        t.settings.username = "test%d" % i
-        t.settings.password = "test"
-        t.settings.domain = "localhost"
-        t.settings.resource = "conductor"
-        t.settings.hostname = "localhost"
-        t.settings.log_stdout = True
-        t.settings.register = True
-        t.settings.unregister = True
-        p.register_task(t)
-    
-    p.run ()
+    runner = XMPPLoadTestRunner(make_task, range(0, options.users),
+                                shards=options.shards)
+    runner.logger = open_logger(stdout=True)
+    runner.duration = options.duration
+    if options.rate:
+        runner.ramp = options.rate
+        if options.ramp_up:
+            runner.ramp = LinearRamp(options.rate / 10.0, options.rate, options.ramp_up)
+        runner.open_loop = not options.closed_loop
+    for report in runner.run():
+        print report
 
 if __name__ == '__main__':
     run()